@@ -352,6 +352,9 @@ def parse():
                         help='tsv file paths for the evaluation sets')
     parser.add_argument('--recog_model', type=str, default=False, nargs='+',
                         help='model path')
+    parser.add_argument('--recog_bundle', type=str, default=False, nargs='?',
+                        help='path to a bundle of the ASR model and LMs made by bin/asr/make_bundle.py '
+                             '(used instead of recog_model and recog_lm*)')
     parser.add_argument('--recog_model_bwd', type=str, default=False, nargs='?',
                         help='model path in the reverse direction')
     parser.add_argument('--recog_dir', type=str, default=False,
@@ -382,16 +385,30 @@ def parse():
                         help='coverage threshold')
     parser.add_argument('--recog_gnmt_decoding', type=strtobool, default=False, nargs='?',
                         help='adopt Google NMT beam search decoding')
+    parser.add_argument('--recog_beam_threshold', type=float, default=0.,
+                        help='prune hypotheses whose score is lower than the best one by this value (0 disables)')
+    parser.add_argument('--recog_early_termination', type=strtobool, default=False,
+                        help='stop beam search when no active hypothesis can outperform the best complete one')
+    parser.add_argument('--recog_max_symbols_per_frame', type=int, default=1,
+                        help='maximum number of labels emitted per frame in greedy decoding of RNN transducer')
     parser.add_argument('--recog_eos_threshold', type=float, default=1.5,
                         help='threshold for emitting a EOS token')
     parser.add_argument('--recog_lm_weight', type=float, default=0.0,
                         help='weight of fisrt-path LM score')
+    parser.add_argument('--recog_lm_normalizer_size', type=int, default=0,
+                        help='approximate the first-path LM normalizer with this number of shortlisted tokens and the candidates (0 means the exact normalizer)')
     parser.add_argument('--recog_lm_second_weight', type=float, default=0.0,
                         help='weight of second-path LM score')
     parser.add_argument('--recog_lm_rev_weight', type=float, default=0.0,
                         help='weight of second-path bakward LM score')
     parser.add_argument('--recog_ctc_weight', type=float, default=0.0,
                         help='weight of CTC score')
+    parser.add_argument('--recog_ctc_window_margin', type=int, default=0,
+                        help='number of frames around attention peaks to compute CTC prefix scores in joint CTC/attention decoding (0 means all frames)')
+    parser.add_argument('--recog_ctc_blank_skip_threshold', type=float, default=1.0,
+                        help='skip label expansion in CTC prefix beam search at frames whose blank probability exceeds this value')
+    parser.add_argument('--recog_ctc_shortlist_threshold', type=float, default=0.,
+                        help='restrict the attention output layer in beam search to tokens whose maximum CTC posterior exceeds this value (0 disables)')
     parser.add_argument('--recog_lm', type=str, default=False, nargs='?',
                         help='path to first path LM for shallow fusion')
     parser.add_argument('--recog_lm_second', type=str, default=False, nargs='?',
@@ -416,6 +433,9 @@ def parse():
                         help='')
     parser.add_argument('--recog_n_average', type=int, default=1,
                         help='number of models for the model averaging of Transformer')
+    parser.add_argument('--recog_nbest_export', type=strtobool, default=False,
+                        help='write N-best lists with component scores (and lattices for CTC and RNN transducer) '
+                             'to a binary file in recog_dir for offline rescoring')
     parser.add_argument('--recog_streaming', type=strtobool, default=False,
                         help='streaming decoding')
     parser.add_argument('--recog_chunk_sync', type=strtobool, default=False,
@@ -428,6 +448,19 @@ def parse():
                         help='')
     parser.add_argument('--recog_ctc_vad_n_accum_frames', type=float, default=800,
                         help='')
+    parser.add_argument('--recog_latency_report', type=strtobool, default=False,
+                        help='write percentiles of per-chunk compute time, real-time factor, time to first token '
+                             'and endpoint delay of streaming decoding to a JSON file in recog_dir')
+    parser.add_argument('--recog_server_socket', type=str, default='asr_streaming.sock',
+                        help='path to the Unix domain socket of the recognition server')
+    parser.add_argument('--recog_server_max_wait', type=int, default=10,
+                        help='maximum waiting time [ms] of a request before decoding in the recognition server')
+    parser.add_argument('--recog_segment_chunk_size', type=int, default=2000,
+                        help='number of input frames per chunk to compute CTC probabilities for segmentation')
+    parser.add_argument('--recog_segment_min_len', type=int, default=0,
+                        help='minimum number of input frames per segment for long-form decoding')
+    parser.add_argument('--recog_segment_max_len', type=int, default=3000,
+                        help='maximum number of input frames per segment for long-form decoding (0 means no limit)')
     # distillation related
     parser.add_argument('--teacher', default=False, nargs='?',
                         help='Teacher ASR model for knowledge distillation')
@@ -182,6 +182,15 @@ def parse():
                         help='size of mini-batch in evaluation')
     parser.add_argument('--recog_n_average', type=int, default=5,
                         help='number of models for the model averaging of Transformer')
+    # N-best rescoring parameters
+    parser.add_argument('--recog_lm_weight', type=float, default=0.3,
+                        help='weight of LM score in N-best rescoring')
+    parser.add_argument('--recog_length_norm', type=strtobool, default=False, nargs='?',
+                        help='normalize LM score by length in N-best rescoring')
+    parser.add_argument('--recog_use_lattice', type=strtobool, default=False, nargs='?',
+                        help='rescore all paths in lattices instead of N-best lists if available')
+    parser.add_argument('--recog_n_workers', type=int, default=1,
+                        help='number of worker processes for N-best rescoring')
     # cache parameters
     parser.add_argument('--recog_n_caches', type=int, default=0,
                         help='number of tokens for cache')
@@ -22,7 +22,9 @@ from neural_sp.bin.train_utils import load_checkpoint
 from neural_sp.bin.train_utils import load_config
 from neural_sp.bin.train_utils import set_logger
 from neural_sp.datasets.asr import Dataset
+from neural_sp.datasets.nbest import NBestWriter
 from neural_sp.evaluators.character import eval_char
+from neural_sp.evaluators.latency import StreamingLatency
 from neural_sp.evaluators.phone import eval_phone
 from neural_sp.evaluators.ppl import eval_ppl
 from neural_sp.evaluators.word import eval_word
@@ -168,6 +170,15 @@ def main():
             if args.recog_n_gpus >= 1:
                 model.cuda()
 
+        # Export N-best lists for offline rescoring
+        if args.recog_nbest_export:
+            model.nbest_writer = NBestWriter(os.path.join(
+                args.recog_dir, 'nbest_' + os.path.basename(s).split('.')[0] + '.bin'))
+
+        # Latency statistics of streaming decoding
+        if args.recog_latency_report and (args.recog_streaming or args.recog_chunk_sync):
+            model.latency_recorder = StreamingLatency(synchronize=args.recog_n_gpus >= 1)
+
         start_time = time.time()
 
         if args.recog_metric == 'edit_distance':
@@ -216,6 +227,15 @@ def main():
             raise NotImplementedError
         logger.info('Elasped time: %.2f [sec]:' % (time.time() - start_time))
 
+        if args.recog_nbest_export:
+            model.nbest_writer.close()
+            logger.info('N-best lists of %d utterances are saved.' % model.nbest_writer.n_utts)
+
+        if getattr(model, 'latency_recorder', None) is not None:
+            model.latency_recorder.save(os.path.join(
+                args.recog_dir, 'latency_' + os.path.basename(s).split('.')[0] + '.json'))
+            model.latency_recorder = None
+
     if args.recog_metric == 'edit_distance':
         if 'phone' in args.recog_unit:
             logger.info('PER (avg.): %.2f %%\n' % (per_avg / len(args.recog_sets)))
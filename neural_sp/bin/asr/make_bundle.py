@@ -0,0 +1,60 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Package the ASR model and LMs into a single bundle for inference."""
+
+import argparse
+import logging
+import os
+
+from neural_sp.bin.bundle_utils import load_state_dict
+from neural_sp.bin.bundle_utils import read_files
+from neural_sp.bin.bundle_utils import write_bundle
+from neural_sp.bin.train_utils import load_config
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('bundle', type=str,
+                    help='output bundle path')
+parser.add_argument('--model', type=str, required=True,
+                    help='ASR model path')
+parser.add_argument('--n_average', type=int, default=1,
+                    help='number of checkpoints of the ASR model to average')
+parser.add_argument('--lm', type=str, default=None,
+                    help='LM path for the first path')
+parser.add_argument('--lm_second', type=str, default=None,
+                    help='LM path for the second path (forward)')
+parser.add_argument('--lm_bwd', type=str, default=None,
+                    help='LM path for the second path (backward)')
+
+
+def main():
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    entries = {}
+    for name, path, n_average in [('asr', args.model, args.n_average),
+                                  ('lm', args.lm, 1),
+                                  ('lm_second', args.lm_second, 1),
+                                  ('lm_bwd', args.lm_bwd, 1)]:
+        if path is None:
+            continue
+        model_dir = os.path.dirname(path)
+        conf = load_config(os.path.join(model_dir, 'conf.yml'))
+        if name == 'asr' and conf.get('lm_fusion'):
+            raise NotImplementedError('LM fusion is not supported.')
+        entries[name] = {'conf': conf,
+                         'files': read_files(model_dir),
+                         'state_dict': load_state_dict(path, n_average)}
+        logger.info('%s: %s (%s)' % (name, path, ', '.join(sorted(entries[name]['files'].keys()))))
+
+    write_bundle(args.bundle, entries)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Resident recognition server with dynamic batching of utterances.
+
+The ASR model and LMs are loaded once and kept in memory.
+A client connects to the Unix domain socket and sends any number of
+utterances as messages of a 4-byte big-endian length followed by float32
+(little-endian) features of size `[T, input_dim]` in the row-major order.
+A message of length 0 marks the end of requests. The server returns the
+results as JSON lines of
+    {"id": int, "text": str} (or {"id": int, "error": str})
+in the order of completion, where `id` is the index of the utterance in
+the connection. A message whose length is not a multiple of
+`4 * input_dim` bytes is answered with an error. Pending utterances of all connections are decoded in
+batches: the oldest utterance is decoded with the utterances closest
+to it in length as soon as `recog_batch_size` utterances are pending or
+it has waited for `recog_server_max_wait` milliseconds.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import numpy as np
+import os
+import struct
+import tempfile
+import time
+
+from neural_sp.bin.args_asr import parse
+from neural_sp.bin.bundle_utils import load_bundle
+from neural_sp.bin.eval_utils import load_lm
+from neural_sp.bin.train_utils import load_checkpoint
+from neural_sp.bin.train_utils import load_config
+from neural_sp.bin.train_utils import set_logger
+from neural_sp.datasets.token_converter.character import Idx2char
+from neural_sp.datasets.token_converter.phone import Idx2phone
+from neural_sp.datasets.token_converter.word import Idx2word
+from neural_sp.datasets.token_converter.wordpiece import Idx2wp
+from neural_sp.models.seq2seq.speech2text import Speech2Text
+
+logger = logging.getLogger(__name__)
+
+
+class BatchingServer(object):
+    """Asynchronous front end which batches concurrent requests.
+
+    Args:
+        model (Speech2Text):
+        params (dict): hyper-parameters for decoding
+        idx2token (): converter from index to token
+        input_dim (int): dimension of input features
+        batch_size (int): maximum number of utterances in a batch
+        max_wait (float): maximum waiting time of an utterance before decoding [sec]
+
+    """
+
+    def __init__(self, model, params, idx2token, input_dim, batch_size, max_wait):
+        self.model = model
+        self.params = params
+        self.idx2token = idx2token
+        self.input_dim = input_dim
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = []  # A list of tuples of (arrival time, features, future)
+        self.wakeup = asyncio.Event()
+        # NOTE: computation runs in a single thread outside the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.n_connections = 0
+        self.n_utts = 0
+        self.n_batches = 0
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        conn_id = self.n_connections
+        self.n_connections += 1
+        replies = []
+        try:
+            while True:
+                n_bytes = struct.unpack('>I', await reader.readexactly(4))[0]
+                if n_bytes == 0:
+                    break
+                data = await reader.readexactly(n_bytes)
+                future = loop.create_future()
+                if n_bytes % (4 * self.input_dim) != 0:
+                    # NOTE: the payload has been consumed, so the following requests are still valid
+                    future.set_exception(ValueError('%d bytes are not float32 features of %d dimensions'
+                                                    % (n_bytes, self.input_dim)))
+                else:
+                    x = np.frombuffer(data, dtype='<f4').reshape(-1, self.input_dim)
+                    self.queue.append((loop.time(), x, future))
+                    self.wakeup.set()
+                replies.append(asyncio.ensure_future(self._reply(writer, len(replies), future)))
+        except asyncio.IncompleteReadError:
+            logger.info('Connection %d: disconnected before the end of requests' % conn_id)
+        await asyncio.gather(*replies)
+        writer.close()
+
+    async def _reply(self, writer, utt_idx, future):
+        try:
+            msg = {'id': utt_idx, 'text': await future}
+        except Exception as e:
+            msg = {'id': utt_idx, 'error': str(e)}
+        writer.write((json.dumps(msg, ensure_ascii=False) + '\n').encode('utf-8'))
+
+    def _next_batch(self):
+        """Pop the oldest utterance and utterances closest to it in length."""
+        xlen = len(self.queue[0][1])
+        order = sorted(range(len(self.queue)), key=lambda i: abs(len(self.queue[i][1]) - xlen))
+        ids = set(order[:self.batch_size])
+        batch = [req for i, req in enumerate(self.queue) if i in ids]
+        self.queue = [req for i, req in enumerate(self.queue) if i not in ids]
+        return batch
+
+    def _decode(self, xs):
+        best_hyps_id, _ = self.model.decode(xs, self.params, self.idx2token, exclude_eos=True)
+        return [self.idx2token(hyp_id) for hyp_id in best_hyps_id]
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if len(self.queue) == 0:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            wait = self.queue[0][0] + self.max_wait - loop.time()
+            if len(self.queue) < self.batch_size and wait > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+
+            batch = self._next_batch()
+            waited = loop.time() - batch[0][0]
+            start_time = time.time()
+            try:
+                hyps = await loop.run_in_executor(self.executor, self._decode, [x for _, x, _ in batch])
+                for (_, _, future), hyp in zip(batch, hyps):
+                    if not future.cancelled():
+                        future.set_result(hyp)
+            except Exception as e:
+                logger.exception('Decoding failed')
+                if len(batch) == 1:
+                    if not batch[0][2].cancelled():
+                        batch[0][2].set_exception(e)
+                else:
+                    # decode utterances one by one so that only the failed ones get an error
+                    for _, x, future in batch:
+                        try:
+                            hyp = (await loop.run_in_executor(self.executor, self._decode, [x]))[0]
+                        except Exception as e_utt:
+                            if not future.cancelled():
+                                future.set_exception(e_utt)
+                        else:
+                            if not future.cancelled():
+                                future.set_result(hyp)
+            self.n_utts += len(batch)
+            self.n_batches += 1
+            logger.debug('batch size: %d, lengths: %s, waited: %.3f [sec], decoded: %.3f [sec]' %
+                         (len(batch), [len(x) for _, x, _ in batch], waited, time.time() - start_time))
+            if self.n_batches % 100 == 0:
+                logger.info('%d utterances in %d batches' % (self.n_utts, self.n_batches))
+
+
+def main():
+
+    args = parse()
+    set_logger(os.path.join(args.recog_dir, 'serve.log'), stdout=args.recog_stdout)
+
+    if args.recog_bundle:
+        # Load the ASR model and LMs from a single file
+        dir_name = tempfile.mkdtemp()
+        model = load_bundle(args.recog_bundle, args, dir_name)
+    else:
+        # Load a conf file
+        dir_name = os.path.dirname(args.recog_model[0])
+        conf = load_config(os.path.join(dir_name, 'conf.yml'))
+
+        # Overwrite conf
+        for k, v in conf.items():
+            if 'recog' not in k:
+                setattr(args, k, v)
+
+        # Load the ASR model
+        model = Speech2Text(args, dir_name)
+        load_checkpoint(model, args.recog_model[0])
+
+        # Load the LM for shallow fusion
+        if not args.lm_fusion:
+            if args.recog_lm is not None and args.recog_lm_weight > 0:
+                model.lm_fwd = load_lm(args.recog_lm, wordlm=args.recog_wordlm,
+                                       lm_dict_path=os.path.join(os.path.dirname(args.recog_lm), 'dict.txt'),
+                                       asr_dict_path=os.path.join(dir_name, 'dict.txt'))
+            if args.recog_lm_second is not None and args.recog_lm_second_weight > 0:
+                model.lm_2nd = load_lm(args.recog_lm_second)
+            if args.recog_lm_bwd is not None and args.recog_lm_rev_weight > 0:
+                model.lm_bwd = load_lm(args.recog_lm_bwd)
+    recog_params = vars(args)
+
+    dict_path = os.path.join(dir_name, 'dict.txt')
+    if args.unit in ['word', 'word_char']:
+        idx2token = Idx2word(dict_path)
+    elif args.unit == 'wp':
+        idx2token = Idx2wp(dict_path, os.path.join(dir_name, 'wp.model'))
+    elif args.unit == 'char':
+        idx2token = Idx2char(dict_path)
+    elif 'phone' in args.unit:
+        idx2token = Idx2phone(dict_path)
+    else:
+        raise ValueError(args.unit)
+
+    if args.recog_n_gpus >= 1:
+        model.cuda()
+
+    logger.info('socket: %s' % args.recog_server_socket)
+    logger.info('batch size: %d' % args.recog_batch_size)
+    logger.info('max wait: %d [ms]' % args.recog_server_max_wait)
+    logger.info('beam width: %d' % args.recog_beam_width)
+    logger.info('CTC weight: %.3f' % args.recog_ctc_weight)
+    logger.info('LM weight: %.3f' % args.recog_lm_weight)
+
+    if os.path.exists(args.recog_server_socket):
+        os.remove(args.recog_server_socket)
+
+    loop = asyncio.get_event_loop()
+    server = BatchingServer(model, recog_params, idx2token, args.input_dim,
+                            args.recog_batch_size, args.recog_server_max_wait / 1000)
+    unix_server = loop.run_until_complete(asyncio.start_unix_server(server.handle, path=args.recog_server_socket))
+    try:
+        loop.run_until_complete(server.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        unix_server.close()
+        loop.run_until_complete(unix_server.wait_closed())
+        os.remove(args.recog_server_socket)
+
+
+if __name__ == '__main__':
+    main()
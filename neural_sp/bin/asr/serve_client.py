@@ -0,0 +1,87 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Client of the recognition server (bin/asr/serve.py).
+
+Utterances in a tsv file are sent over concurrent connections
+and hypotheses are written in the trn format.
+"""
+
+import argparse
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+import json
+import kaldiio
+import numpy as np
+import pandas as pd
+import socket
+import struct
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('tsv', type=str,
+                    help='tsv file of utterances')
+parser.add_argument('--socket', type=str, default='asr_streaming.sock',
+                    help='path to the Unix domain socket of the recognition server')
+parser.add_argument('--n_connections', type=int, default=1,
+                    help='number of concurrent connections')
+parser.add_argument('--out', type=str, default='hyp.trn',
+                    help='output trn file')
+
+
+def transcribe(socket_path, xs):
+    """Transcribe utterances over a single connection.
+
+    Args:
+        socket_path (str): path to the Unix domain socket
+        xs (list): A list of length `[B]`, which contains arrays of size `[T, input_dim]`
+    Returns:
+        hyps (list): A list of length `[B]`, which contains hypotheses
+
+    """
+    hyps = [None] * len(xs)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        for x in xs:
+            data = np.ascontiguousarray(x, dtype='<f4').tobytes()
+            sock.sendall(struct.pack('>I', len(data)) + data)
+        sock.sendall(struct.pack('>I', 0))
+        with sock.makefile('r', encoding='utf-8') as f:
+            for line in f:
+                msg = json.loads(line)
+                if 'error' in msg:
+                    raise RuntimeError('utterance %d: %s' % (msg['id'], msg['error']))
+                hyps[msg['id']] = msg['text']
+    return hyps
+
+
+def main():
+
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.tsv, encoding='utf-8', delimiter='\t')
+    xs = [kaldiio.load_mat(path) for path in df['feat_path']]
+
+    start_time = time.time()
+    # Distribute utterances to connections
+    ids = [list(range(i, len(xs), args.n_connections)) for i in range(args.n_connections)]
+    with ThreadPoolExecutor(max_workers=args.n_connections) as executor:
+        results = list(executor.map(lambda ids_i: transcribe(args.socket, [xs[j] for j in ids_i]), ids))
+    hyps = [None] * len(xs)
+    for ids_i, hyps_i in zip(ids, results):
+        for j, hyp in zip(ids_i, hyps_i):
+            hyps[j] = hyp
+    elapsed = time.time() - start_time
+
+    with codecs.open(args.out, 'w', 'utf-8') as f:
+        for i, hyp in enumerate(hyps):
+            speaker = str(df['speaker'][i]).replace('-', '_')
+            f.write('%s (%s-%s)\n' % (hyp, speaker, df['utt_id'][i]))
+    print('%d utterances: %.2f [sec] (%.1f utterances/sec)' % (len(xs), elapsed, len(xs) / max(elapsed, 1e-8)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Streaming recognition server for multiple concurrent streams.
+
+Each connection to the Unix domain socket is a single stream.
+A client sends acoustic features as messages of a 4-byte big-endian length
+followed by float32 (little-endian) features of size `[T, input_dim]`
+in the row-major order. A message of length 0 marks the end of the stream.
+The server returns the results as JSON lines of
+    {"partial": str, "final": [str, ...], "segments": [[int, int], ...], "offset": int, "done": bool}
+where `final` contains segments finalized since the last message, `segments`
+contains their start and end input frames and `offset` is the number of
+processed input frames.
+Current chunks of all streams are processed in a batch at each step.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import numpy as np
+import os
+import struct
+
+from neural_sp.bin.args_asr import parse
+from neural_sp.bin.eval_utils import load_lm
+from neural_sp.bin.train_utils import load_checkpoint
+from neural_sp.bin.train_utils import load_config
+from neural_sp.bin.train_utils import set_logger
+from neural_sp.datasets.token_converter.character import Idx2char
+from neural_sp.datasets.token_converter.phone import Idx2phone
+from neural_sp.datasets.token_converter.word import Idx2word
+from neural_sp.datasets.token_converter.wordpiece import Idx2wp
+from neural_sp.models.seq2seq.speech2text import Speech2Text
+from neural_sp.models.seq2seq.streaming import StreamingRecognizer
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingServer(object):
+    """Asynchronous front end of StreamingRecognizer.
+
+    Args:
+        recognizer (StreamingRecognizer):
+        input_dim (int): dimension of input features
+        idx2token (): converter from index to token
+
+    """
+
+    def __init__(self, recognizer, input_dim, idx2token):
+        self.recognizer = recognizer
+        self.input_dim = input_dim
+        self.idx2token = idx2token
+        self.writers = {}
+        self.pending = []  # A list of tuples of (event, stream_id, features)
+        self.wakeup = asyncio.Event()
+        # NOTE: computation runs in a single thread outside the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.n_streams = 0
+
+    async def handle(self, reader, writer):
+        stream_id = self.n_streams
+        self.n_streams += 1
+        self.writers[stream_id] = writer
+        self.pending.append(('open', stream_id, None))
+        logger.info('Stream %d: connected' % stream_id)
+        try:
+            while True:
+                n_bytes = struct.unpack('>I', await reader.readexactly(4))[0]
+                if n_bytes == 0:
+                    break
+                x = np.frombuffer(await reader.readexactly(n_bytes), dtype='<f4')
+                self.pending.append(('feed', stream_id, x.reshape(-1, self.input_dim)))
+                self.wakeup.set()
+        except asyncio.IncompleteReadError:
+            logger.info('Stream %d: disconnected before the end of stream' % stream_id)
+        self.pending.append(('close', stream_id, None))
+        self.wakeup.set()
+
+    def _flush_pending(self):
+        # NOTE: streams are updated only while no step is running
+        for event, stream_id, x in self.pending:
+            if event == 'open':
+                self.recognizer.add_stream(stream_id)
+            elif event == 'feed':
+                self.recognizer.feed(stream_id, x)
+            elif event == 'close':
+                self.recognizer.close(stream_id)
+        self.pending = []
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            self._flush_pending()
+            while self.recognizer.has_work():
+                results = await loop.run_in_executor(self.executor, self.recognizer.step)
+                for res in results:
+                    self._send(res)
+                # Receive features which arrived during the computation
+                self._flush_pending()
+
+    def _send(self, res):
+        stream_id = res['stream_id']
+        writer = self.writers[stream_id]
+        msg = {'partial': self.idx2token(res['partial']),
+               'final': [self.idx2token(hyp) for hyp in res['final']],
+               'segments': [list(seg) for seg in res['segments']],
+               'offset': res['offset'],
+               'done': res['done']}
+        writer.write((json.dumps(msg, ensure_ascii=False) + '\n').encode('utf-8'))
+        if res['done']:
+            writer.close()
+            del self.writers[stream_id]
+            self.recognizer.remove_stream(stream_id)
+            logger.info('Stream %d: finished' % stream_id)
+
+
+def main():
+
+    args = parse()
+
+    # Load a conf file
+    dir_name = os.path.dirname(args.recog_model[0])
+    conf = load_config(os.path.join(dir_name, 'conf.yml'))
+
+    # Overwrite conf
+    for k, v in conf.items():
+        if 'recog' not in k:
+            setattr(args, k, v)
+    recog_params = vars(args)
+
+    set_logger(os.path.join(args.recog_dir, 'serve_streaming.log'), stdout=args.recog_stdout)
+
+    dict_path = os.path.join(dir_name, 'dict.txt')
+    if args.unit in ['word', 'word_char']:
+        idx2token = Idx2word(dict_path)
+    elif args.unit == 'wp':
+        idx2token = Idx2wp(dict_path, os.path.join(dir_name, 'wp.model'))
+    elif args.unit == 'char':
+        idx2token = Idx2char(dict_path)
+    elif 'phone' in args.unit:
+        idx2token = Idx2phone(dict_path)
+    else:
+        raise ValueError(args.unit)
+
+    # Load the ASR model
+    model = Speech2Text(args, dir_name)
+    load_checkpoint(model, args.recog_model[0])
+
+    # Load the LM for shallow fusion
+    if not args.lm_fusion:
+        if args.recog_lm is not None and args.recog_lm_weight > 0:
+            model.lm_fwd = load_lm(args.recog_lm, wordlm=args.recog_wordlm,
+                                   lm_dict_path=os.path.join(os.path.dirname(args.recog_lm), 'dict.txt'),
+                                   asr_dict_path=dict_path)
+        if args.recog_lm_second is not None and args.recog_lm_second_weight > 0:
+            model.lm_2nd = load_lm(args.recog_lm_second)
+
+    if args.recog_n_gpus >= 1:
+        model.cuda()
+
+    logger.info('socket: %s' % args.recog_server_socket)
+    logger.info('beam width: %d' % args.recog_beam_width)
+    logger.info('CTC weight: %.3f' % args.recog_ctc_weight)
+    logger.info('LM weight: %.3f' % args.recog_lm_weight)
+    logger.info('chunk-synchronous decoding: %s' % args.recog_chunk_sync)
+    logger.info('CTC-based VAD: %s' % args.recog_ctc_vad)
+
+    recognizer = StreamingRecognizer(model, recog_params, idx2token)
+    if os.path.exists(args.recog_server_socket):
+        os.remove(args.recog_server_socket)
+
+    loop = asyncio.get_event_loop()
+    server = StreamingServer(recognizer, args.input_dim, idx2token)
+    unix_server = loop.run_until_complete(asyncio.start_unix_server(server.handle, path=args.recog_server_socket))
+    try:
+        loop.run_until_complete(server.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        unix_server.close()
+        loop.run_until_complete(unix_server.wait_closed())
+        os.remove(args.recog_server_socket)
+
+
+if __name__ == '__main__':
+    main()
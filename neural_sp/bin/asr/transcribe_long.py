@@ -0,0 +1,178 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Transcribe long recordings with CTC-based segmentation.
+
+Each recording is encoded chunk by chunk to compute CTC probabilities and
+segmented at runs of <blank> frames. Segments of all recordings are sorted
+by length and decoded in batches, and hypotheses are stitched back per
+recording with timestamps in the trn and ctm formats.
+"""
+
+import codecs
+import kaldiio
+import logging
+import numpy as np
+import os
+import pandas as pd
+import time
+
+from neural_sp.bin.args_asr import parse
+from neural_sp.bin.eval_utils import load_lm
+from neural_sp.bin.train_utils import load_checkpoint
+from neural_sp.bin.train_utils import load_config
+from neural_sp.bin.train_utils import set_logger
+from neural_sp.datasets.token_converter.character import Idx2char
+from neural_sp.datasets.token_converter.phone import Idx2phone
+from neural_sp.datasets.token_converter.word import Idx2word
+from neural_sp.datasets.token_converter.wordpiece import Idx2wp
+from neural_sp.models.seq2seq.decoders.ctc_vad import ctc_vad_segments
+from neural_sp.models.seq2seq.speech2text import Speech2Text
+
+logger = logging.getLogger(__name__)
+
+FRAME_RATE = 100  # input frames per second
+
+
+def segment(model, x, params):
+    """Split a recording at runs of <blank> frames.
+
+    Args:
+        model (Speech2Text):
+        x (np.ndarray): `[T, input_dim]`
+        params (dict): hyper-parameters for decoding
+    Returns:
+        segments (list): A list of tuples of (start, end, speech_start, speech_end) in input frames,
+            where speech_start and speech_end exclude leading and trailing <blank> frames.
+
+    """
+    ctc_probs, factor = model.ctc_probs_chunkwise([x], params['recog_segment_chunk_size'],
+                                                  params['recog_batch_size'])
+    boundaries, is_blank = ctc_vad_segments(ctc_probs[0], model.blank,
+                                            params['recog_ctc_vad_blank_threshold'] / factor,
+                                            params['recog_ctc_vad_spike_threshold'],
+                                            min_len=params['recog_segment_min_len'] // factor,
+                                            max_len=params['recog_segment_max_len'] // factor)
+    segments = []
+    for start, end in boundaries.tolist():
+        speech = np.where(~is_blank[start:end])[0]
+        if len(speech) == 0:
+            continue  # silence
+        segments.append((start * factor, min(end * factor, len(x)),
+                         (start + int(speech[0])) * factor, min((start + int(speech[-1]) + 1) * factor, len(x))))
+    return segments
+
+
+def write_ctm(f, rec_id, start, end, words, channel='1'):
+    """Write words in a segment, where the duration is divided evenly as utils/trn2ctm.py."""
+    start_t = round(start / FRAME_RATE, 2)
+    duration_t = round(end / FRAME_RATE, 2) - start_t
+    if len(words) > 0:
+        duration_t /= len(words)
+    confidence = 1  # Nist-1 manner in the ROVER paper
+    for w in words:
+        f.write('%s %s %.2f %.2f %s %.3f\n' % (rec_id, channel, start_t, duration_t, w, confidence))
+        start_t += duration_t
+
+
+def main():
+
+    args = parse()
+
+    # Load a conf file
+    dir_name = os.path.dirname(args.recog_model[0])
+    conf = load_config(os.path.join(dir_name, 'conf.yml'))
+
+    # Overwrite conf
+    for k, v in conf.items():
+        if 'recog' not in k:
+            setattr(args, k, v)
+    recog_params = vars(args)
+
+    # Setting for logging
+    if os.path.isfile(os.path.join(args.recog_dir, 'transcribe_long.log')):
+        os.remove(os.path.join(args.recog_dir, 'transcribe_long.log'))
+    set_logger(os.path.join(args.recog_dir, 'transcribe_long.log'), stdout=args.recog_stdout)
+
+    dict_path = os.path.join(dir_name, 'dict.txt')
+    if args.unit in ['word', 'word_char']:
+        idx2token = Idx2word(dict_path)
+    elif args.unit == 'wp':
+        idx2token = Idx2wp(dict_path, os.path.join(dir_name, 'wp.model'))
+    elif args.unit == 'char':
+        idx2token = Idx2char(dict_path)
+    elif 'phone' in args.unit:
+        idx2token = Idx2phone(dict_path)
+    else:
+        raise ValueError(args.unit)
+
+    # Load the ASR model
+    model = Speech2Text(args, dir_name)
+    load_checkpoint(model, args.recog_model[0])
+    assert model.ctc_weight > 0, 'CTC is necessary for segmentation.'
+
+    # Load the LM for shallow fusion
+    if not args.lm_fusion:
+        if args.recog_lm is not None and args.recog_lm_weight > 0:
+            model.lm_fwd = load_lm(args.recog_lm, wordlm=args.recog_wordlm,
+                                   lm_dict_path=os.path.join(os.path.dirname(args.recog_lm), 'dict.txt'),
+                                   asr_dict_path=dict_path)
+        if args.recog_lm_second is not None and args.recog_lm_second_weight > 0:
+            model.lm_2nd = load_lm(args.recog_lm_second)
+        if args.recog_lm_bwd is not None and args.recog_lm_rev_weight > 0:
+            model.lm_bwd = load_lm(args.recog_lm_bwd)
+
+    if args.recog_n_gpus >= 1:
+        model.cuda()
+
+    logger.info('batch size: %d' % args.recog_batch_size)
+    logger.info('beam width: %d' % args.recog_beam_width)
+    logger.info('CTC weight: %.3f' % args.recog_ctc_weight)
+    logger.info('LM weight: %.3f' % args.recog_lm_weight)
+    logger.info('blank threshold: %d' % args.recog_ctc_vad_blank_threshold)
+    logger.info('spike threshold: %.3f' % args.recog_ctc_vad_spike_threshold)
+    logger.info('segment length: [%d, %d]' % (args.recog_segment_min_len, args.recog_segment_max_len))
+
+    for s in args.recog_sets:
+        start_time = time.time()
+        df = pd.read_csv(s, encoding='utf-8', delimiter='\t')
+        recordings = [(str(df['utt_id'][i]), str(df['speaker'][i]), kaldiio.load_mat(df['feat_path'][i]))
+                      for i in range(len(df))]
+
+        # Segmentation with CTC probabilities
+        segments = []  # A list of tuples of (recording index, start, end, speech_start, speech_end)
+        for i, (rec_id, _, x) in enumerate(recordings):
+            segments_i = segment(model, x, recog_params)
+            segments += [(i,) + seg for seg in segments_i]
+            logger.info('%s: %d segments (%.2f [sec])' % (rec_id, len(segments_i), len(x) / FRAME_RATE))
+        logger.info('Segmentation time: %.2f [sec]' % (time.time() - start_time))
+
+        # Batch decoding of segments sorted by length
+        order = sorted(range(len(segments)), key=lambda j: segments[j][2] - segments[j][1], reverse=True)
+        hyps = [None] * len(segments)
+        for j in range(0, len(order), args.recog_batch_size):
+            ids = order[j:j + args.recog_batch_size]
+            xs = [recordings[segments[k][0]][2][segments[k][1]:segments[k][2]] for k in ids]
+            best_hyps_id, _ = model.decode(xs, recog_params, idx2token, exclude_eos=True)
+            for k, hyp_id in zip(ids, best_hyps_id):
+                hyps[k] = idx2token(hyp_id)
+
+        # Stitch hypotheses of each recording
+        name = os.path.basename(s).split('.')[0]
+        with codecs.open(os.path.join(args.recog_dir, name + '.trn'), 'w', 'utf-8') as f_trn, \
+                codecs.open(os.path.join(args.recog_dir, name + '.ctm'), 'w', 'utf-8') as f_ctm:
+            for k in sorted(range(len(segments)), key=lambda k: segments[k][:2]):
+                i, start, end, speech_start, speech_end = segments[k]
+                rec_id, speaker = recordings[i][:2]
+                utt_id = '%s_%07d_%07d' % (rec_id.replace('-', '_'), start, end)
+                f_trn.write('%s (%s-%s)\n' % (hyps[k], speaker.replace('-', '_'), utt_id))
+                write_ctm(f_ctm, rec_id, speech_start, speech_end, hyps[k].split())
+        logger.info('%s: %d recordings, %d segments' % (s, len(recordings), len(segments)))
+        logger.info('Elasped time: %.2f [sec]:' % (time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
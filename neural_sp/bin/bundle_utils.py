@@ -0,0 +1,304 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Single-file bundle of models for inference.
+
+A bundle consists of a header followed by a data region.
+    header: magic (8 bytes), version (uint32), header length (uint64)
+            and a utf-8 JSON header, which contains per entry
+            (asr, lm, lm_second and lm_bwd) the configuration, offsets
+            and sizes of files (vocabularies, sentencepiece models, etc.),
+            and dtypes, shapes and offsets of tensors
+    data:   raw bytes of files and tensors, each of which starts at
+            a multiple of `ALIGN` bytes from the beginning of the file
+Tensors are loaded as views of a copy-on-write memory map of the bundle,
+so weights are read from disk on demand and never copied on CPU.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+from collections import OrderedDict
+import json
+import logging
+import numpy as np
+import os
+import struct
+import torch
+import torch.nn as nn
+
+from neural_sp.models.lm.build import build_lm
+from neural_sp.models.seq2seq.speech2text import Speech2Text
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'NSPBUNDL'
+VERSION = 1
+ALIGN = 64
+ENTRIES = ('asr', 'lm', 'lm_second', 'lm_bwd')
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def load_state_dict(checkpoint_path, n_average=1):
+    """Load model parameters of a checkpoint, optionally averaged over previous epochs.
+
+    Unlike `average_checkpoints`, the averaged parameters are not saved.
+
+    Args:
+        checkpoint_path (str): path to the saved model (model.epoch-*)
+        n_average (int): number of checkpoints to average
+    Returns:
+        state_dict (OrderedDict):
+
+    """
+    def load(path):
+        checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+        return checkpoint['model_state_dict'] if 'model_state_dict' in checkpoint else checkpoint['state_dict']
+
+    logger.info("=> Loading checkpoint: %s" % checkpoint_path)
+    state_dict = load(checkpoint_path)
+    if n_average == 1:
+        return state_dict
+
+    epoch = int(checkpoint_path.split('-')[-1])
+    state_dicts = [state_dict]
+    for i in range(epoch - 1, 0, -1):
+        if len(state_dicts) == n_average:
+            break
+        path = checkpoint_path.replace('-' + str(epoch), '-' + str(i))
+        if os.path.isfile(path):
+            logger.info("=> Loading checkpoint (epoch:%d): %s" % (i, path))
+            state_dicts.append(load(path))
+
+    # take an average
+    logger.info('Take average for %d models' % len(state_dicts))
+    state_dict_avg = OrderedDict()
+    shared = {}  # keep tied parameters tied
+    for k, v in state_dict.items():
+        key = (v.data_ptr(), tuple(v.size()))
+        if key not in shared:
+            if v.is_floating_point():
+                shared[key] = sum([sd[k] for sd in state_dicts]) / len(state_dicts)
+            else:
+                shared[key] = v
+        state_dict_avg[k] = shared[key]
+    return state_dict_avg
+
+
+def read_files(model_dir):
+    """Read vocabularies and sentencepiece models in a model directory.
+
+    Args:
+        model_dir (str):
+    Returns:
+        files (dict): file name -> bytes
+
+    """
+    files = {}
+    for fname in sorted(os.listdir(model_dir)):
+        if (fname.startswith('dict') and fname.endswith('.txt')) or \
+                (fname.startswith('wp') and fname.endswith('.model')) or fname == 'nlsyms.txt':
+            with open(os.path.join(model_dir, fname), 'rb') as f:
+                files[fname] = f.read()
+    return files
+
+
+def write_bundle(bundle_path, entries):
+    """Write a bundle.
+
+    Args:
+        bundle_path (str): path to the bundle
+        entries (dict): entry name -> dict of
+            conf (dict): configuration
+            files (dict): file name -> bytes
+            state_dict (OrderedDict): model parameters
+
+    """
+    header = {'entries': {}}
+    blobs = []  # A list of tuples of (offset, bytes or np.ndarray)
+    offset = 0
+    for name, entry in entries.items():
+        assert name in ENTRIES, name
+        header_e = {'conf': entry['conf'], 'files': {}, 'tensors': OrderedDict()}
+        for fname, data in sorted(entry['files'].items()):
+            header_e['files'][fname] = [offset, len(data)]
+            blobs.append((offset, data))
+            offset = _align(offset + len(data))
+        shared = {}  # tied parameters are stored once
+        for k, v in entry['state_dict'].items():
+            key = (v.data_ptr(), tuple(v.size()), v.stride(), v.dtype)
+            if key not in shared:
+                array = v.detach().cpu().contiguous().numpy()
+                shared[key] = (offset, str(array.dtype))
+                blobs.append((offset, array))
+                offset = _align(offset + array.nbytes)
+            header_e['tensors'][k] = {'dtype': shared[key][1],
+                                      'shape': list(v.size()),
+                                      'offset': shared[key][0]}
+        header['entries'][name] = header_e
+
+    header = json.dumps(header).encode('utf-8')
+    data_offset = _align(len(MAGIC) + 12 + len(header))
+    tmp_path = bundle_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<IQ', VERSION, len(header)))
+        f.write(header)
+        for offset, data in blobs:
+            f.write(b'\0' * (data_offset + offset - f.tell()))
+            f.write(data if isinstance(data, bytes) else data.tobytes())
+    # NOTE: replace atomically for workers loading the same path
+    os.replace(tmp_path, bundle_path)
+    logger.info('Bundle is saved to %s (%.2f MB)' % (bundle_path, os.path.getsize(bundle_path) / (1024 ** 2)))
+
+
+class Bundle(object):
+    """Reader of a bundle with a copy-on-write memory map.
+
+    Args:
+        bundle_path (str): path to the bundle
+
+    """
+
+    def __init__(self, bundle_path):
+        with open(bundle_path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a bundle.' % bundle_path)
+            version, header_len = struct.unpack('<IQ', f.read(12))
+            if version != VERSION:
+                raise ValueError('Unsupported bundle version: %d' % version)
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        self.data_offset = _align(len(MAGIC) + 12 + header_len)
+        # NOTE: pages are read when accessed, and copied only when written
+        self.mmap = np.memmap(bundle_path, dtype=np.uint8, mode='c')
+
+    @property
+    def entries(self):
+        return list(self.header['entries'].keys())
+
+    def conf(self, name):
+        return self.header['entries'][name]['conf']
+
+    def extract_files(self, name, save_path):
+        """Write files of an entry to a directory.
+
+        Args:
+            name (str): entry name
+            save_path (str): directory
+        Returns:
+            save_path (str):
+
+        """
+        if not os.path.isdir(save_path):
+            os.makedirs(save_path)
+        for fname, (offset, size) in self.header['entries'][name]['files'].items():
+            start = self.data_offset + offset
+            with open(os.path.join(save_path, fname), 'wb') as f:
+                f.write(self.mmap[start:start + size].tobytes())
+        return save_path
+
+    def state_dict(self, name):
+        """Tensors of an entry as views of the memory map.
+
+        Args:
+            name (str): entry name
+        Returns:
+            state_dict (OrderedDict):
+
+        """
+        state_dict = OrderedDict()
+        shared = {}
+        for k, info in self.header['entries'][name]['tensors'].items():
+            if info['offset'] not in shared:
+                dtype = np.dtype(info['dtype'])
+                start = self.data_offset + info['offset']
+                n_bytes = int(np.prod(info['shape'])) * dtype.itemsize
+                array = self.mmap[start:start + n_bytes].view(dtype).reshape(info['shape'])
+                shared[info['offset']] = torch.from_numpy(array)
+            state_dict[k] = shared[info['offset']]
+        return state_dict
+
+
+def load_weights(model, state_dict):
+    """Replace parameters and buffers of a model with tensors without copying.
+
+    Args:
+        model (torch.nn.Module):
+        state_dict (OrderedDict): tensors, where tied parameters share the same tensor
+
+    """
+    expected = set(model.state_dict().keys())
+    missing = expected - set(state_dict.keys())
+    unexpected = set(state_dict.keys()) - expected
+    if len(missing) > 0 or len(unexpected) > 0:
+        raise KeyError('missing keys: %s, unexpected keys: %s' % (sorted(missing), sorted(unexpected)))
+
+    modules = dict(model.named_modules())
+    params = {}
+    for k, v in state_dict.items():
+        module_name, _, attr = k.rpartition('.')
+        module = modules[module_name]
+        if attr in module._parameters:
+            if module._parameters[attr].size() != v.size():
+                raise ValueError('size mismatch for %s: %s vs %s' % (k, v.size(), module._parameters[attr].size()))
+            if id(v) not in params:
+                params[id(v)] = nn.Parameter(v, requires_grad=False)
+            # NOTE: setattr updates flattened weights of RNN modules
+            setattr(module, attr, params[id(v)])
+        else:
+            setattr(module, attr, v)
+
+
+def load_bundle(bundle_path, args, save_path):
+    """Build the ASR model and LMs in a bundle.
+
+    Configurations except for decoding parameters are overwritten in `args`.
+    Files of the ASR model are extracted to `save_path`, and those of LMs
+    to `save_path/<entry name>`.
+
+    Args:
+        bundle_path (str): path to the bundle
+        args (Namespace): arguments with decoding parameters
+        save_path (str): directory to extract files
+    Returns:
+        model (Speech2Text):
+
+    """
+    bundle = Bundle(bundle_path)
+    for k, v in bundle.conf('asr').items():
+        if 'recog' not in k:
+            setattr(args, k, v)
+    # NOTE: all parameters are replaced with those in the bundle
+    args.lm_init = False
+    bundle.extract_files('asr', save_path)
+    model = Speech2Text(args, save_path)
+    load_weights(model, bundle.state_dict('asr'))
+    logger.info('=> Loading the ASR model from %s' % bundle_path)
+
+    # Load the LM for shallow fusion
+    lm_weights = {'lm': args.recog_lm_weight, 'lm_second': args.recog_lm_second_weight,
+                  'lm_bwd': args.recog_lm_rev_weight}
+    for name in ['lm', 'lm_second', 'lm_bwd']:
+        if name not in bundle.entries or lm_weights[name] <= 0 or args.lm_fusion:
+            continue
+        args_lm = argparse.Namespace()
+        for k, v in bundle.conf(name).items():
+            setattr(args_lm, k, v)
+        lm = build_lm(args_lm, bundle.extract_files(name, os.path.join(save_path, name)))
+        load_weights(lm, bundle.state_dict(name))
+        if name == 'lm_second':
+            model.lm_2nd = lm
+        elif name == 'lm_bwd' or getattr(args_lm, 'backward', False):
+            model.lm_bwd = lm
+        else:
+            model.lm_fwd = lm
+        logger.info('=> Loading %s from %s' % (name, bundle_path))
+    return model
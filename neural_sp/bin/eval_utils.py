@@ -10,10 +10,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import argparse
 import logging
 import os
 import torch
 
+from neural_sp.bin.train_utils import load_checkpoint
+from neural_sp.bin.train_utils import load_config
+from neural_sp.models.lm.build import build_lm
+
 logger = logging.getLogger(__name__)
 
 
@@ -47,3 +52,22 @@ def average_checkpoints(model, best_model_path, epoch, n_average):
     torch.save(checkpoint_avg, checkpoint_avg_path)
 
     return model
+
+
+def load_lm(lm_path, **kwargs):
+    """Build a LM with its conf.yml and load the checkpoint.
+
+    Args:
+        lm_path (str): path to the checkpoint
+        kwargs: passed to `build_lm`
+    Returns:
+        lm (LMBase):
+
+    """
+    conf_lm = load_config(os.path.join(os.path.dirname(lm_path), 'conf.yml'))
+    args_lm = argparse.Namespace()
+    for k, v in conf_lm.items():
+        setattr(args_lm, k, v)
+    lm = build_lm(args_lm, **kwargs)
+    load_checkpoint(lm, lm_path)
+    return lm
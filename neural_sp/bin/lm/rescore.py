@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Rescore N-best lists (or lattices) exported by ASR decoding with the LM."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import codecs
+import logging
+import multiprocessing
+import numpy as np
+import os
+import time
+import torch
+
+from neural_sp.bin.args_lm import parse
+from neural_sp.bin.train_utils import load_checkpoint
+from neural_sp.bin.train_utils import load_config
+from neural_sp.bin.train_utils import set_logger
+from neural_sp.datasets.nbest import lattice_paths
+from neural_sp.datasets.nbest import NBestWriter
+from neural_sp.datasets.nbest import read_nbest
+from neural_sp.datasets.token_converter.character import Idx2char
+from neural_sp.datasets.token_converter.phone import Idx2phone
+from neural_sp.datasets.token_converter.word import Idx2word
+from neural_sp.datasets.token_converter.wordpiece import Idx2wp
+from neural_sp.models.lm.build import build_lm
+
+logger = logging.getLogger(__name__)
+
+# LM loaded in each worker process
+_lm = None
+
+
+def _init_worker(args, n_threads):
+    global _lm
+    torch.set_num_threads(n_threads)
+    _lm = build_lm(args)
+    load_checkpoint(_lm, args.recog_model[0])
+    _lm.eval()
+
+
+def _rescore(records, fields, lm_weight, length_norm, use_lattice):
+    """Rescore N-best lists of utterances in a single batch.
+
+    Args:
+        records (list): A list of tuples of (utt_id, nbest, lattice)
+        fields (tuple): names of scores
+        lm_weight (float): weight of LM score
+        length_norm (bool): normalize LM score by length
+        use_lattice (bool): rescore all paths in lattices if available
+    Returns:
+        results (list): A list of tuples of (utt_id, nbest) sorted by the new score
+
+    """
+    candidates = []
+    for utt_id, nbest, lattice in records:
+        if use_lattice and lattice is not None:
+            nbest = []
+            for hyp, scores in zip(lattice_paths(lattice), lattice['scores']):
+                entry = {'hyp': hyp, 'ended': True}
+                entry.update(zip(fields, scores.tolist()))
+                nbest.append(entry)
+        candidates.append((utt_id, nbest))
+
+    # <eos> is scored only for complete hypotheses (not cut off by the maximum length)
+    ys = [[_lm.eos] + hyp['hyp'].tolist() + ([_lm.eos] if hyp['ended'] else [])
+          for _, nbest in candidates for hyp in nbest]
+    with torch.no_grad():
+        scores_lm, ylens = _lm.score_sequences(ys)
+    if length_norm:
+        scores_lm /= np.maximum(ylens, 1)
+
+    results = []
+    offset = 0
+    for utt_id, nbest in candidates:
+        for hyp in nbest:
+            hyp['score_lm_2nd'] = float(scores_lm[offset])
+            hyp['score'] += hyp['score_lm_2nd'] * lm_weight
+            offset += 1
+        results.append((utt_id, sorted(nbest, key=lambda x: x['score'], reverse=True)))
+    return results
+
+
+def _rescore_star(inputs):
+    return _rescore(*inputs)
+
+
+def main():
+
+    args = parse()
+
+    # Load a conf file
+    dir_name = os.path.dirname(args.recog_model[0])
+    conf = load_config(os.path.join(dir_name, 'conf.yml'))
+
+    # Overwrite conf
+    for k, v in conf.items():
+        if 'recog' not in k:
+            setattr(args, k, v)
+
+    # Setting for logging
+    if os.path.isfile(os.path.join(args.recog_dir, 'rescore.log')):
+        os.remove(os.path.join(args.recog_dir, 'rescore.log'))
+    set_logger(os.path.join(args.recog_dir, 'rescore.log'), stdout=args.recog_stdout)
+
+    dict_path = os.path.join(dir_name, 'dict.txt')
+    if args.unit in ['word', 'word_char']:
+        idx2token = Idx2word(dict_path)
+    elif args.unit == 'wp':
+        idx2token = Idx2wp(dict_path, os.path.join(dir_name, 'wp.model'))
+    elif args.unit == 'char':
+        idx2token = Idx2char(dict_path)
+    elif 'phone' in args.unit:
+        idx2token = Idx2phone(dict_path)
+    else:
+        raise ValueError(args.unit)
+
+    logger.info('LM weight: %.3f' % args.recog_lm_weight)
+    logger.info('length norm: %s' % args.recog_length_norm)
+    logger.info('use lattice: %s' % args.recog_use_lattice)
+    logger.info('number of workers: %d' % args.recog_n_workers)
+
+    n_threads = max(1, torch.get_num_threads() // args.recog_n_workers)
+    pool = multiprocessing.Pool(args.recog_n_workers, initializer=_init_worker,
+                                initargs=(args, n_threads))
+    for s in args.recog_sets:
+        start_time = time.time()
+        fields, records = read_nbest(s)
+        batches = [(records[i:i + args.recog_batch_size], fields, args.recog_lm_weight,
+                    args.recog_length_norm, args.recog_use_lattice)
+                   for i in range(0, len(records), args.recog_batch_size)]
+
+        name = os.path.basename(s).split('.')[0]
+        if 'score_lm_2nd' not in fields:
+            fields += ('score_lm_2nd',)
+        with NBestWriter(os.path.join(args.recog_dir, name + '.rescored.bin'), fields) as writer, \
+                codecs.open(os.path.join(args.recog_dir, name + '.rescored.hyp'), 'w', 'utf-8') as f:
+            # NOTE: the order of utterances is kept
+            for results in pool.imap(_rescore_star, batches):
+                for utt_id, nbest in results:
+                    writer.write(utt_id, nbest)
+                    f.write('%s %s\n' % (utt_id, idx2token(nbest[0]['hyp']) if len(nbest) > 0 else ''))
+        logger.info('%s: %d utterances' % (s, len(records)))
+        logger.info('Elasped time: %.2f [sec]:' % (time.time() - start_time))
+    pool.close()
+    pool.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Compact binary format of N-best lists and lattices for offline rescoring.
+
+A file consists of a header followed by one record per utterance.
+    header: magic (8 bytes), version (uint8), number of score fields (uint8),
+            and the field names (uint8 length + utf-8 bytes each)
+    record: utterance ID (uint16 length + utf-8 bytes),
+            number of hypotheses (uint32), and for each hypothesis
+            its length (uint32), whether it ended with <eos> (uint8),
+            token IDs (int32) and scores (float32),
+            followed by an optional lattice: number of nodes (uint32),
+            parent node and token ID of each node (int32), number of final
+            nodes (uint32), final node IDs (int32) and their scores (float32).
+The lattice merges the common prefixes of all complete hypotheses reached by
+the CTC and RNN transducer searches, including the ones pruned from the N-best
+list, where node 0 corresponds to <sos>.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import numpy as np
+import struct
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'NSPNBEST'
+VERSION = 1
+
+# All component scores are unweighted log-probabilities except for `score`
+# (the first-path total score) and `score_lp` (the length penalty term).
+NBEST_FIELDS = ('score', 'score_attn', 'score_ctc', 'score_rnnt', 'score_lm', 'score_lp', 'score_cp')
+
+
+def build_lattice(hyps, fields=NBEST_FIELDS):
+    """Merge complete hypotheses into a prefix graph.
+
+    Args:
+        hyps (list): A list of dict, which contains `hyp` (np.ndarray) and scores
+        fields (tuple): names of scores
+    Returns:
+        lattice (dict):
+            parents (np.ndarray): `[n_nodes]`, parent node of each node
+            tokens (np.ndarray): `[n_nodes]`, token ID on the arc from the parent
+            finals (np.ndarray): `[n_finals]`, node IDs where hypotheses end
+            scores (np.ndarray): `[n_finals, n_fields]`
+
+    """
+    parents, tokens = [-1], [-1]
+    children = {}
+    finals, scores = [], []
+    for hyp in hyps:
+        node = 0
+        for idx in hyp['hyp']:
+            key = (node, int(idx))
+            if key not in children:
+                children[key] = len(parents)
+                parents.append(node)
+                tokens.append(int(idx))
+            node = children[key]
+        finals.append(node)
+        scores.append([hyp.get(k, 0.) for k in fields])
+    return {'parents': np.array(parents, dtype=np.int32),
+            'tokens': np.array(tokens, dtype=np.int32),
+            'finals': np.array(finals, dtype=np.int32),
+            'scores': np.array(scores, dtype=np.float32).reshape(len(finals), len(fields))}
+
+
+def lattice_paths(lattice):
+    """Expand a lattice into the token sequences ending at its final nodes.
+
+    Args:
+        lattice (dict): see `build_lattice`
+    Returns:
+        hyps (list): A list of length `[n_finals]`, which contains arrays of size `[L]`
+
+    """
+    parents, tokens = lattice['parents'], lattice['tokens']
+    hyps = []
+    for node in lattice['finals']:
+        hyp = []
+        while node > 0:
+            hyp.append(tokens[node])
+            node = parents[node]
+        hyps.append(np.array(hyp[::-1], dtype=np.int32))
+    return hyps
+
+
+class NBestWriter(object):
+    """Write N-best lists (and lattices) of utterances to a binary file.
+
+    Args:
+        path (str): path to an output file
+        fields (tuple): names of scores
+
+    """
+
+    def __init__(self, path, fields=NBEST_FIELDS):
+        self.fields = tuple(fields)
+        self.n_utts = 0
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC + struct.pack('<BB', VERSION, len(self.fields)))
+        for k in self.fields:
+            k = k.encode('utf-8')
+            self.f.write(struct.pack('<B', len(k)) + k)
+
+    def write(self, utt_id, nbest, lattice=None):
+        """Write a record of an utterance.
+
+        Args:
+            utt_id (str): utterance ID
+            nbest (list): A list of dict, which contains `hyp` (np.ndarray), `ended` (bool) and scores
+            lattice (dict): see `build_lattice`
+
+        """
+        buf = []
+        utt_id = utt_id.encode('utf-8')
+        buf.append(struct.pack('<H', len(utt_id)) + utt_id)
+        buf.append(struct.pack('<I', len(nbest)))
+        for hyp in nbest:
+            buf.append(struct.pack('<IB', len(hyp['hyp']), bool(hyp.get('ended', True))))
+            buf.append(np.asarray(hyp['hyp'], dtype='<i4').tobytes())
+            buf.append(np.array([hyp.get(k, 0.) for k in self.fields], dtype='<f4').tobytes())
+        if lattice is None:
+            buf.append(struct.pack('<I', 0))
+        else:
+            buf.append(struct.pack('<I', len(lattice['parents'])))
+            buf.append(lattice['parents'].astype('<i4').tobytes())
+            buf.append(lattice['tokens'].astype('<i4').tobytes())
+            buf.append(struct.pack('<I', len(lattice['finals'])))
+            buf.append(lattice['finals'].astype('<i4').tobytes())
+            buf.append(lattice['scores'].astype('<f4').tobytes())
+        self.f.write(b''.join(buf))
+        self.n_utts += 1
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_nbest(path):
+    """Read records of utterances from a binary file.
+
+    Args:
+        path (str): path to a file written by `NBestWriter`
+    Returns:
+        fields (tuple): names of scores
+        records (list): A list of tuples of (utt_id, nbest, lattice)
+
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('%s is not an N-best file.' % path)
+    offset = len(MAGIC)
+    version, n_fields = struct.unpack_from('<BB', data, offset)
+    if version != VERSION:
+        raise ValueError('Unsupported version: %d' % version)
+    offset += 2
+    fields = []
+    for _ in range(n_fields):
+        n = data[offset]
+        fields.append(data[offset + 1:offset + 1 + n].decode('utf-8'))
+        offset += 1 + n
+    fields = tuple(fields)
+
+    def read_array(dtype, n):
+        array = np.frombuffer(data, dtype=dtype, count=n, offset=offset)
+        return array, offset + array.nbytes
+
+    records = []
+    while offset < len(data):
+        n = struct.unpack_from('<H', data, offset)[0]
+        utt_id = data[offset + 2:offset + 2 + n].decode('utf-8')
+        offset += 2 + n
+        n_hyps = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        nbest = []
+        for _ in range(n_hyps):
+            length, ended = struct.unpack_from('<IB', data, offset)
+            offset += 5
+            hyp, offset = read_array('<i4', length)
+            scores, offset = read_array('<f4', n_fields)
+            entry = {'hyp': hyp.astype(np.int64), 'ended': bool(ended)}
+            entry.update(zip(fields, scores.tolist()))
+            nbest.append(entry)
+        lattice = None
+        n_nodes = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        if n_nodes > 0:
+            parents, offset = read_array('<i4', n_nodes)
+            tokens, offset = read_array('<i4', n_nodes)
+            n_finals = struct.unpack_from('<I', data, offset)[0]
+            offset += 4
+            finals, offset = read_array('<i4', n_finals)
+            scores, offset = read_array('<f4', n_finals * n_fields)
+            lattice = {'parents': parents, 'tokens': tokens, 'finals': finals,
+                       'scores': scores.reshape(n_finals, n_fields)}
+        records.append((utt_id, nbest, lattice))
+    return fields, records
@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Latency statistics of streaming decoding.
+
+Input features are assumed to arrive in real time, i.e., a chunk becomes
+available when its last input frame (including the right context) has
+been spoken. Chunks are processed in order as soon as both the chunk and
+the decoder are available, so the emission time of each result is
+simulated from the measured compute time of the preceding chunks.
+All times are measured from the beginning of each utterance.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import codecs
+import json
+import logging
+import numpy as np
+import time
+import torch
+
+logger = logging.getLogger(__name__)
+
+COMPONENTS = ('encoder', 'vad', 'decoder')
+PERCENTILES = (50, 90, 95, 99)
+
+
+class StreamingLatency(object):
+    """Recorder of per-chunk compute time and latency of streaming decoding.
+
+    Args:
+        frame_rate (int): number of input frames per second
+        synchronize (bool): synchronize CUDA kernels before reading the clock
+
+    """
+
+    def __init__(self, frame_rate=100, synchronize=False):
+        self.frame_rate = frame_rate
+        self.synchronize = synchronize
+        self.stats = {'chunk_' + c + '_ms': [] for c in COMPONENTS + ('total',)}
+        self.stats.update({'rtf': [], 'first_token_ms': [], 'endpoint_delay_ms': [], 'final_delay_ms': []})
+        self.n_utts = 0
+        self.total_frames = 0
+        self.total_time = 0.
+        self._reset()
+
+    def _reset(self):
+        self.n_frames = 0
+        self.clock = 0.  # emission time of the latest result
+        self.compute_time = 0.
+        self.times = {c: 0. for c in COMPONENTS}
+        self.first_token = None
+        self._tic = 0.
+
+    def now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start(self, n_frames):
+        """Start an utterance.
+
+        Args:
+            n_frames (int): number of input frames
+
+        """
+        self._reset()
+        self.n_frames = n_frames
+
+    def tic(self):
+        self._tic = self.now()
+
+    def lap(self, component):
+        """Accumulate compute time since the last call of `tic` or `lap` in the current chunk.
+
+        Args:
+            component (str): encoder or vad or decoder
+
+        """
+        toc = self.now()
+        self.times[component] += toc - self._tic
+        self._tic = toc
+
+    def _flush(self, arrival):
+        elapsed = sum(self.times.values())
+        self.clock = max(self.clock, arrival) + elapsed
+        self.compute_time += elapsed
+        times = self.times
+        self.times = {c: 0. for c in COMPONENTS}
+        return times, elapsed
+
+    def next_chunk(self, end_frame, n_tokens):
+        """Close the current chunk.
+
+        Args:
+            end_frame (int): last input frame (exclusive) of the chunk including the right context
+            n_tokens (int): number of tokens emitted so far including partial hypotheses
+
+        """
+        times, elapsed = self._flush(min(end_frame, self.n_frames) / self.frame_rate)
+        for c in COMPONENTS:
+            self.stats['chunk_' + c + '_ms'].append(times[c] * 1000)
+        self.stats['chunk_total_ms'].append(elapsed * 1000)
+        if self.first_token is None and n_tokens > 0:
+            self.first_token = self.clock
+
+    def endpoint(self, speech_end_frame):
+        """Record the delay from the end of speech detected by VAD to the finalized hypothesis.
+
+        Args:
+            speech_end_frame (int): last non-blank input frame (exclusive) before the boundary
+
+        """
+        self.stats['endpoint_delay_ms'].append((self.clock - speech_end_frame / self.frame_rate) * 1000)
+
+    def end(self, n_tokens):
+        """Finish the current utterance.
+
+        Args:
+            n_tokens (int): number of tokens in the final hypothesis
+
+        """
+        # NOTE: computation after the last chunk is not regarded as a chunk
+        self._flush(self.n_frames / self.frame_rate)
+        if self.first_token is None and n_tokens > 0:
+            self.first_token = self.clock
+        duration = self.n_frames / self.frame_rate
+        if duration > 0:
+            self.stats['rtf'].append(self.compute_time / duration)
+        if self.first_token is not None:
+            self.stats['first_token_ms'].append(self.first_token * 1000)
+        self.stats['final_delay_ms'].append((self.clock - duration) * 1000)
+        self.n_utts += 1
+        self.total_frames += self.n_frames
+        self.total_time += self.compute_time
+
+    def summary(self):
+        """Aggregate statistics into percentiles.
+
+        Returns:
+            report (dict):
+
+        """
+        report = {'n_utts': self.n_utts,
+                  'n_chunks': len(self.stats['chunk_total_ms']),
+                  'rtf_total': self.total_time / (self.total_frames / self.frame_rate) if self.total_frames > 0 else 0.}
+        for k, v in self.stats.items():
+            if len(v) == 0:
+                report[k] = None
+                continue
+            v = np.array(v)
+            report[k] = {'mean': float(v.mean()), 'max': float(v.max())}
+            report[k].update({'p%d' % p: float(np.percentile(v, p)) for p in PERCENTILES})
+        return report
+
+    def save(self, path):
+        report = self.summary()
+        with codecs.open(path, 'w', 'utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        logger.info('Latency report (%d utterances) is saved to %s' % (self.n_utts, path))
+        for k in ['chunk_total_ms', 'first_token_ms', 'endpoint_delay_ms', 'final_delay_ms']:
+            if report[k] is not None:
+                logger.info('%s: p50 %.1f / p90 %.1f / p99 %.1f' %
+                            (k, report[k]['p50'], report[k]['p90'], report[k]['p99']))
+        logger.info('RTF: %.3f' % report['rtf_total'])
+        return report
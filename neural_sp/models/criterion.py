@@ -121,3 +121,56 @@ def focal_loss(logits, ys, ylens, alpha, gamma):
     loss = -alpha * torch.mul(torch.pow(probs_inv, gamma), log_probs)
     loss_mean = np.sum([loss[b, :ylens[b], :].sum() for b in range(bs)]) / ylens.sum()
     return loss_mean
+
+
+def transducer_loss(log_probs_blank, log_probs_label, elens, ylens, log0=-1e10):
+    """Compute Transducer loss from log probabilities of blank and target labels.
+
+    The forward recursion is computed over anti-diagonals of the `[T, L + 1]`
+    lattice, and gradients are obtained by back-propagation through it.
+
+    Args:
+        log_probs_blank (FloatTensor): `[B, T, L + 1]`
+        log_probs_label (FloatTensor): log probabilities of the (u+1)-th label at `(t, u)`. `[B, T, L]`
+        elens (IntTensor): `[B]`
+        ylens (IntTensor): `[B]`
+        log0 (float): log-scale zero
+    Returns:
+        loss_mean (FloatTensor): `[1]`
+
+    """
+    bs, xmax, ymax = log_probs_label.size()
+    device = log_probs_blank.device
+    elens = elens.to(device).long()
+    ylens = ylens.to(device).long()
+
+    # Skew the lattice so that each anti-diagonal `n = t + u` is a row
+    # blank_skew[b, n, u] = log_probs_blank[b, n - u, u]
+    n_diags = xmax + ymax
+    n_idx = torch.arange(n_diags, device=device).unsqueeze(1)
+    u_idx = torch.arange(ymax + 1, device=device).unsqueeze(0)
+    t_idx = n_idx - u_idx  # `[n_diags, L + 1]`
+    is_valid = (t_idx >= 0).unsqueeze(0) & (t_idx.unsqueeze(0) < elens.view(bs, 1, 1)) & \
+        (u_idx.unsqueeze(0) <= ylens.view(bs, 1, 1))  # `[B, n_diags, L + 1]`
+    t_idx = t_idx.clamp(0, xmax - 1).unsqueeze(0).expand(bs, n_diags, ymax + 1)
+    blank_skew = log_probs_blank.gather(1, t_idx).masked_fill(is_valid == 0, log0)
+    label_skew = torch.cat([log_probs_label, log_probs_label.new_zeros(bs, xmax, 1)], dim=2)
+    label_skew = label_skew.gather(1, t_idx).masked_fill(is_valid == 0, log0)
+
+    # alpha[b, n, u] = alpha(t = n - u, u)
+    alpha = [log_probs_blank.new_zeros(bs, ymax + 1).fill_(log0)]
+    alpha[0][:, 0] = 0
+    pad = log_probs_blank.new_zeros(bs, 1).fill_(log0)
+    for n in range(1, n_diags):
+        from_blank = alpha[-1] + blank_skew[:, n - 1]
+        from_label = torch.cat([pad, (alpha[-1] + label_skew[:, n - 1])[:, :-1]], dim=1)
+        alpha_n = torch.logsumexp(torch.stack([from_blank, from_label], dim=0), dim=0)
+        alpha.append(alpha_n.masked_fill(is_valid[:, n] == 0, log0))
+    alpha = torch.stack(alpha, dim=1)  # `[B, n_diags, L + 1]`
+
+    # log p(y|x) = alpha(T - 1, U) + log p(blank | T - 1, U)
+    n_last = elens - 1 + ylens
+    log_likelihood = alpha[torch.arange(bs, device=device), n_last, ylens] + \
+        blank_skew[torch.arange(bs, device=device), n_last, ylens]
+    loss_mean = -log_likelihood.mean()
+    return loss_mean
@@ -167,13 +167,14 @@ class GatedConvLM(LMBase):
             else:
                 raise ValueError(n)
 
-    def decode(self, ys, state=None, cache=False):
+    def decode(self, ys, state=None, cache=False, project=True):
         """Decode function.
 
         Args:
             ys (LongTensor): `[B, L]`
             state: dummy interfance
             cache (bool): dummy interfance
+            project (bool): project onto the vocabulary (if False, logits is None unless the adaptive softmax is used)
         Returns:
             logits (FloatTensor): `[B, L, vocab]`
             out (FloatTensor): `[B, L, d_model]` (for cache)
@@ -189,7 +190,7 @@ class GatedConvLM(LMBase):
         out = out.transpose(2, 1).contiguous()  # `[B, T, out_ch, 1]`
         out = out.squeeze(3)
         if self.adaptive_softmax is None:
-            logits = self.output(out)
+            logits = self.output(out) if project else None
         else:
             logits = out
 
@@ -19,6 +19,7 @@ from neural_sp.models.criterion import cross_entropy_lsm
 from neural_sp.models.torch_utils import compute_accuracy
 from neural_sp.models.torch_utils import np2tensor
 from neural_sp.models.torch_utils import pad_list
+from neural_sp.models.torch_utils import tensor2np
 
 logger = logging.getLogger(__name__)
 
@@ -129,7 +130,7 @@ class LMBase(ModelBase):
     def repackage_state(self, state):
         return state
 
-    def decode(self, ys_emb, state=None):
+    def decode(self, ys_emb, state=None, cache=False, project=True):
         raise NotImplementedError
 
     def predict(self, ys, state=None):
@@ -153,8 +154,130 @@ class LMBase(ModelBase):
 
         """
         logits, out, new_state = self.decode(ys, state, cache=True)
-        log_probs = torch.log_softmax(logits, dim=-1)
+        if self.adaptive_softmax is None:
+            log_probs = torch.log_softmax(logits, dim=-1)
+        else:
+            log_probs = self.adaptive_softmax.log_prob(
+                logits.contiguous().view(-1, logits.size(2))).view(logits.size(0), logits.size(1), -1)
+        return out, new_state, log_probs
+
+    def predict_candidates(self, ys, state, candidates, normalizer_size=0):
+        """Precict function for ASR restricted to candidate tokens.
+
+        Only log-probabilities of the candidates at the last step are computed.
+        With the adaptive softmax, only the head and the tail clusters which
+        contain any candidate are evaluated, and the normalizer is exact.
+        Otherwise, the output layer projects only the last step; if `normalizer_size`
+        is positive, only onto the rows of the candidates and of the `normalizer_size`
+        tokens with the largest output bias (see `normalizer_shortlist`), and
+        the normalizer is approximated by the log-sum-exp over them.
+
+        Args:
+            ys (LongTensor): `[B, L]`
+            state: see `predict`
+            candidates (LongTensor): `[B, K]` or `[K]` (shared by all hypotheses), without duplicates
+            normalizer_size (int): number of shortlisted tokens for the approximate normalizer
+                (0: exact normalizer over the whole vocabulary)
+        Returns:
+            out (FloatTensor): `[B, L, n_units]`
+            state: see `predict`
+            log_probs (FloatTensor): `[B, K]`
+
+        """
+        logits, out, new_state = self.decode(ys, state, cache=True, project=False)
+        if candidates.dim() == 1:
+            candidates = candidates.unsqueeze(0).expand(out.size(0), -1)
+        candidates = candidates.long()
+
+        if self.adaptive_softmax is None:
+            h = out[:, -1]
+            if normalizer_size <= 0 or normalizer_size >= self.vocab:
+                logits = self.output(h)
+                log_probs = logits.gather(1, candidates) - torch.logsumexp(logits, dim=-1, keepdim=True)
+                return out, new_state, log_probs
+
+            shortlist, in_shortlist = self.normalizer_shortlist(normalizer_size)
+            logits_sl = torch.matmul(h, self.output.weight[shortlist].t())
+            logits_cand = torch.bmm(self.output.weight[candidates], h.unsqueeze(2)).squeeze(2)
+            if self.output.bias is not None:
+                logits_sl = logits_sl + self.output.bias[shortlist]
+                logits_cand = logits_cand + self.output.bias[candidates]
+            # candidates in the shortlist are counted only once
+            log_z = torch.logsumexp(torch.cat([logits_sl, logits_cand.masked_fill(
+                in_shortlist[candidates], float('-inf'))], dim=-1), dim=-1, keepdim=True)
+            return out, new_state, logits_cand - log_z
+
+        logits = logits[:, -1]
+        asm = self.adaptive_softmax
+        head_log_probs = torch.log_softmax(asm.head(logits), dim=-1)
+        log_probs = head_log_probs.gather(1, candidates.clamp(max=asm.shortlist_size - 1))
+        for i in range(asm.n_clusters):
+            start, stop = asm.cutoffs[i], asm.cutoffs[i + 1]
+            in_cluster = (candidates >= start) & (candidates < stop)
+            rows = in_cluster.sum(1).nonzero().view(-1)
+            if rows.numel() == 0:
+                continue
+            cluster_log_probs = torch.log_softmax(asm.tail[i](logits[rows]), dim=-1)
+            cluster_log_probs = cluster_log_probs.gather(
+                1, (candidates[rows] - start).clamp(min=0, max=stop - start - 1))
+            cluster_log_probs += head_log_probs[rows, asm.shortlist_size + i].unsqueeze(1)
+            log_probs[rows] = torch.where(in_cluster[rows], cluster_log_probs, log_probs[rows])
         return out, new_state, log_probs
 
+    def normalizer_shortlist(self, normalizer_size):
+        """Tokens for the approximate normalizer in `predict_candidates`.
+
+        Tokens with the largest output bias (or weight norm if the output layer
+        has no bias), which dominate the normalizer of most contexts, are
+        selected once and cached.
+
+        Args:
+            normalizer_size (int): number of tokens
+        Returns:
+            shortlist (LongTensor): `[normalizer_size]`
+            in_shortlist (BoolTensor): `[vocab]`
+
+        """
+        cache = getattr(self, '_normalizer_shortlist', None)
+        if cache is None or cache[0] != normalizer_size:
+            with torch.no_grad():
+                if self.output.bias is not None:
+                    prior = self.output.bias
+                else:
+                    prior = self.output.weight.norm(dim=1)
+                shortlist = torch.topk(prior, k=normalizer_size)[1]
+                in_shortlist = prior.new_zeros(self.vocab, dtype=torch.bool)
+                in_shortlist[shortlist] = True
+            cache = (normalizer_size, shortlist, in_shortlist)
+            self._normalizer_shortlist = cache
+        return cache[1], cache[2]
+
+    def score_sequences(self, ys, reverse=False):
+        """Compute log-likelihoods of token sequences in a single batch.
+
+        Args:
+            ys (list): A list of length `[N]`, which contains token sequences including <sos>
+            reverse (bool): score sequences in the reverse order
+        Returns:
+            scores (np.ndarray): `[N]`
+            ylens (np.ndarray): `[N]`, the number of scored tokens
+
+        """
+        ys = [np.fromiter(y, dtype=np.int64) for y in ys]
+        if reverse:
+            ys = [y[::-1].copy() for y in ys]
+        ylens = np.array([len(y) - 1 for y in ys], dtype=np.int64)
+        scores = np.zeros(len(ys), dtype=np.float32)
+        if len(ys) == 0 or ylens.max() <= 0:
+            return scores, ylens
+
+        ys = [np2tensor(y, self.device_id) for y in ys]
+        ys_in = pad_list([y[:-1] for y in ys], self.pad)  # `[N, L]`
+        ys_out = pad_list([y[1:] for y in ys], -1)  # `[N, L]`
+        _, _, log_probs = self.predict(ys_in, None)  # `[N, L, vocab]`
+        log_probs = log_probs.gather(2, ys_out.clamp(min=0).unsqueeze(2)).squeeze(2)
+        scores = tensor2np(log_probs.masked_fill(ys_out == -1, 0).sum(1))
+        return scores, ylens
+
     def plot_attention(self):
         raise NotImplementedError
@@ -111,7 +111,7 @@ class RNNLM(LMBase):
             else:
                 raise ValueError(n)
 
-    def decode(self, ys, state, cache=False):
+    def decode(self, ys, state, cache=False, project=True):
         """Decode function.
 
         Args:
@@ -120,6 +120,7 @@ class RNNLM(LMBase):
                 hxs (FloatTensor): `[n_layers, B, n_units]`
                 cxs (FloatTensor): `[n_layers, B, n_units]`
             cache (bool): dummy interfance
+            project (bool): project onto the vocabulary (if False, logits is None unless the adaptive softmax is used)
         Returns:
             logits (FloatTensor): `[B, L, vocab]`
             ys_emb (FloatTensor): `[B, L, n_units]` (for cache)
@@ -174,7 +175,7 @@ class RNNLM(LMBase):
                 ys_emb = ys_emb + residual
 
         if self.adaptive_softmax is None:
-            logits = self.output(ys_emb)
+            logits = self.output(ys_emb) if project else None
         else:
             logits = ys_emb
 
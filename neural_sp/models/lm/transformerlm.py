@@ -96,13 +96,14 @@ class TransformerLM(LMBase):
         nn.init.xavier_uniform_(self.output.weight)
         nn.init.constant_(self.output.bias, 0.)
 
-    def decode(self, ys, ys_prev=None, cache=False):
+    def decode(self, ys, ys_prev=None, cache=False, project=True):
         """Decode function.
 
         Args:
             ys (LongTensor): `[B, L]`
             ys_prev (LongTensor): previous tokens
             cahce (bool): concatenate previous tokens
+            project (bool): project onto the vocabulary (if False, logits is None unless the adaptive softmax is used)
         Returns:
             logits (FloatTensor): `[B, L, vocab]`
             ys_emb (FloatTensor): `[B, L, d_model]` (for ys_prev)
@@ -129,7 +130,7 @@ class TransformerLM(LMBase):
                 setattr(self, 'yy_aws_layer%d' % l, tensor2np(yy_aws))
         out = self.norm_out(out)
         if self.adaptive_softmax is None:
-            logits = self.output(out)
+            logits = self.output(out) if project else None
         else:
             logits = out
 
@@ -76,7 +76,8 @@ class Energy(nn.Module):
             energy (FloatTensor): `[B, value_dim]`
 
         """
-        bs, klen, kdim = key.size()
+        klen = key.size(1)
+        bs = query.size(0)
 
         # Pre-computation of encoder-side features for computing scores
         if self.key is None or not cache:
@@ -86,14 +87,17 @@ class Energy(nn.Module):
             self.key = self.w_key(key)
             self.mask = mask
 
+        # NOTE: the key is broadcast over groups of `B // B'` consecutive queries
+        kbs = self.key.size(0)
+        query = self.w_query(query).view(kbs, bs // kbs, 1, -1)
         # energy = torch.tanh(self.key + self.w_query(query))
-        energy = torch.relu(self.key + self.w_query(query))
-        energy = self.v(energy).squeeze(-1)  # `[B, klen]`
+        energy = torch.relu(self.key.unsqueeze(1) + query)
+        energy = self.v(energy).squeeze(-1)  # `[B', B // B', klen]`
         if self.r is not None:
             energy = energy + self.r
         if self.mask is not None:
-            energy = energy.masked_fill_(self.mask == 0, NEG_INF)
-        return energy
+            energy = energy.masked_fill_(self.mask.view(kbs, 1, klen) == 0, NEG_INF)
+        return energy.view(bs, klen)
 
 
 class MoChA(nn.Module):
@@ -167,7 +171,8 @@ class MoChA(nn.Module):
             alpha (FloatTensor): `[B, klen, 1]`
 
         """
-        bs, klen = key.size()[:2]
+        klen = key.size(1)
+        bs = query.size(0)  # key/value can be broadcast over groups of queries
 
         if aw_prev is None:
             # aw_prev = [1, 0, 0 ... 0]
@@ -200,9 +205,9 @@ class MoChA(nn.Module):
 
             # Mask the right part from the trigger point
             if trigger_point is not None:
-                for b in range(bs):
-                    alpha[b, trigger_point[b] + 1:] = 0
-                    # TODO(hirofumi): add tolerance parameter
+                pos = torch.arange(klen, device=alpha.device).unsqueeze(0)  # `[1, klen]`
+                alpha = alpha.masked_fill(pos > trigger_point.to(alpha.device).long().unsqueeze(1), 0)
+                # TODO(hirofumi): add tolerance parameter
 
         elif mode == 'hard':  # inference
             # Attend when monotonic energy is above threshold (Sigmoid > 0.5)
@@ -210,13 +215,12 @@ class MoChA(nn.Module):
             p_choose_i = (emit_probs >= 0.5).float()
             # Remove any probabilities before the index chosen at the last time step
             p_choose_i *= torch.cumsum(aw_prev.squeeze(2), dim=1)  # `[B, klen]`
-            # Now, use exclusive cumprod to remove probabilities after the first
-            # chosen index, like so:
-            # p_choose_i                        = [0, 0, 0, 1, 1, 0, 1, 1]
-            # 1 - p_choose_i                    = [1, 1, 1, 0, 0, 1, 0, 0]
-            # exclusive_cumprod(1 - p_choose_i) = [1, 1, 1, 1, 0, 0, 0, 0]
-            # alpha: product of above           = [0, 0, 0, 1, 0, 0, 0, 0]
-            alpha = p_choose_i * exclusive_cumprod(1 - p_choose_i)
+            # Now, keep only the first chosen index (first crossing) for all
+            # utterances in parallel, like so:
+            # p_choose_i                = [0, 0, 0, 1, 1, 0, 1, 1]
+            # cumsum(p_choose_i)        = [0, 0, 0, 1, 2, 2, 3, 4]
+            # alpha: (cumsum == 1) * p  = [0, 0, 0, 1, 0, 0, 0, 0]
+            alpha = first_crossing(p_choose_i)
         else:
             raise ValueError("mode must be 'recursive', 'parallel', or 'hard'.")
 
@@ -239,11 +243,12 @@ class MoChA(nn.Module):
                     alpha, e_chunk, self.chunk_size, self.sharpening_factor)
 
         # Compute context vector
+        kbs = value.size(0)
         if self.chunk_size > 1:
-            cv = torch.bmm(beta.unsqueeze(1), value)
+            cv = torch.matmul(beta.view(kbs, bs // kbs, klen), value).view(bs, 1, -1)
             beta = beta.unsqueeze(2)
         else:
-            cv = torch.bmm(alpha.unsqueeze(1), value)
+            cv = torch.matmul(alpha.view(kbs, bs // kbs, klen), value).view(bs, 1, -1)
 
         return cv, alpha.unsqueeze(2)
 
@@ -269,6 +274,22 @@ def exclusive_cumprod(x):
     return torch.cumprod(torch.cat([x.new_ones(x.size(0), 1), x[:, :-1]], dim=1), dim=1)
 
 
+def first_crossing(p_choose_i):
+    """Keep only the first non-zero entry of each row of a binary tensor.
+
+    This is equivalent to `p_choose_i * exclusive_cumprod(1 - p_choose_i)`,
+    but does not accumulate a product over frames.
+
+    Args:
+        p_choose_i (FloatTensor): `[B, klen]`
+    Returns:
+        alpha (FloatTensor): `[B, klen]`
+
+    """
+    chosen = p_choose_i > 0
+    return (chosen & (torch.cumsum(chosen.long(), dim=1) == 1)).float()
+
+
 def moving_sum(x, back, forward):
     """Compute the moving sum of x over a chunk_size with the provided bounds.
 
@@ -315,6 +336,33 @@ def efficient_chunkwise_attention(alpha, e, chunk_size, sharpening_factor=1.):
     return beta
 
 
+def adaptive_moving_sum(x, back, forward):
+    """Compute the moving sum of x with per-utterance bounds.
+
+    All utterances are processed at once by unfolding x with the largest
+    window and masking out the frames outside each utterance's bounds.
+
+    Args:
+        x (FloatTensor): `[B, klen]`
+        back (LongTensor): `[B]`
+        forward (LongTensor): `[B]`
+
+    Returns:
+        x_sum (FloatTensor): `[B, klen]`
+    """
+    klen = x.size(1)
+    back = back.clamp(min=0, max=klen - 1)
+    forward = forward.clamp(min=0, max=klen - 1)
+    max_back = int(back.max())
+    max_forward = int(forward.max())
+    x_padded = F.pad(x, pad=[max_back, max_forward])
+    # `[B, klen, max_back + max_forward + 1]`
+    windows = x_padded.unfold(1, max_back + max_forward + 1, 1)
+    offset = torch.arange(-max_back, max_forward + 1, device=x.device).unsqueeze(0)
+    window_mask = (offset >= -back.unsqueeze(1)) & (offset <= forward.unsqueeze(1))
+    return (windows * window_mask.unsqueeze(1).to(x.dtype)).sum(-1)
+
+
 def efficient_adaptive_chunkwise_attention(alpha, e, chunk_len_dist, sharpening_factor=1.):
     """Compute adaptive chunkwise attention distribution efficiently by clipping logits.
 
@@ -330,17 +378,13 @@ def efficient_adaptive_chunkwise_attention(alpha, e, chunk_len_dist, sharpening_
     e -= torch.max(e, dim=1, keepdim=True)[0]
     # Limit the range for numerical stability
     softmax_exp = torch.clamp(torch.exp(e), min=1e-5)
+    # Chunk length at the boundary of each utterance
+    boundary = torch.argmax(alpha, dim=1, keepdim=True)
+    chunk_len = chunk_len_dist.long().gather(1, boundary).squeeze(1) - 1  # `[B]`
+    zeros = torch.zeros_like(chunk_len)
     # Compute chunkwise softmax denominators
-    boundary = torch.argmax(alpha, dim=1)
-    bs = alpha.size(0)
-    softmax_denominators = [moving_sum(
-        softmax_exp[b:b + 1],
-        back=chunk_len_dist[b, boundary[b]] - 1, forward=0)
-        for b in range(bs)]
+    softmax_denominators = adaptive_moving_sum(softmax_exp, back=chunk_len, forward=zeros)
     # Compute \beta_{i, :}. emit_probs are \alpha_{i, :}.
-    beta = [softmax_exp[b:b + 1] * moving_sum(
-        alpha[b:b + 1] * sharpening_factor / softmax_denominators[b],
-        back=0, forward=chunk_len_dist[b, boundary[b]] - 1)
-        for b in range(bs)]
-    beta = torch.cat(beta, dim=0)
+    beta = softmax_exp * adaptive_moving_sum(alpha * sharpening_factor / softmax_denominators,
+                                             back=zeros, forward=chunk_len)
     return beta
@@ -104,7 +104,7 @@ class MultiheadAttentionMechanism(nn.Module):
             klens (IntTensor): `[B]`
             value (FloatTensor): `[B, klen, vdim]`
             query (FloatTensor): `[B, qlen, qdim]`
-            mask (ByteTensor): `[B, qlen, klen]`
+            mask (ByteTensor): `[B, qlen, klen]` or `[B, klen]`
             aw_prev: dummy interface for single-head attention
             mode: dummy interface for MoChA
             cache (bool): cache key and mask
@@ -114,36 +114,47 @@ class MultiheadAttentionMechanism(nn.Module):
             aw (FloatTensor): `[B, n_heads, qlen, klen]`
 
         """
-        bs, klen = key.size()[: 2]
-        qlen = query.size(1)
+        klen = key.size(1)
+        bs, qlen = query.size()[: 2]
 
+        # NOTE: key/value with a smaller batch size `B'` are broadcast over
+        # groups of `B // B'` consecutive queries
         if self.key is None or not cache:
-            key = self.w_key(key).view(bs, -1, self.n_heads, self.d_k)
-            value = self.w_value(value).view(bs, -1, self.n_heads, self.d_k)
-            self.key = key.transpose(2, 1).contiguous()      # `[B, n_heads, klen, d_k]`
-            self.value = value.transpose(2, 1).contiguous()  # `[B, n_heads, klen, d_k]`
+            if mask is not None and mask.dim() == 2:
+                # padding mask of `[B', klen]` shared by all queries (e.g., LAS decoder)
+                mask = mask.unsqueeze(1).expand(-1, qlen, -1)
+            key = self.w_key(key).view(key.size(0), -1, self.n_heads, self.d_k)
+            value = self.w_value(value).view(value.size(0), -1, self.n_heads, self.d_k)
+            self.key = key.transpose(2, 1).contiguous()      # `[B', n_heads, klen, d_k]`
+            self.value = value.transpose(2, 1).contiguous()  # `[B', n_heads, klen, d_k]`
             self.mask = mask.unsqueeze(1).repeat(
-                [1, self.n_heads, 1, 1]) if mask is not None else None  # `[B, n_heads, qlen, klen]`
+                [1, self.n_heads, 1, 1]) if mask is not None else None  # `[B', n_heads, qlen, klen]`
             if self.mask is not None:
-                assert self.mask.size() == (bs, self.n_heads, qlen, klen)
+                assert self.mask.size() == (key.size(0), self.n_heads, qlen, klen)
+
+        kbs = self.key.size(0)
+        n_groups = bs // kbs
 
         query = self.w_query(query).view(bs, -1, self.n_heads, self.d_k)
         query = query.transpose(2, 1).contiguous()  # `[B, n_heads, qlen, d_k]`
+        query = query.view(kbs, n_groups, self.n_heads, qlen, self.d_k)
 
         if self.atype == 'scaled_dot':
-            e = torch.matmul(query, self.key.transpose(3, 2)) / math.sqrt(self.d_k)
+            e = torch.matmul(query, self.key.unsqueeze(1).transpose(4, 3)) / math.sqrt(self.d_k)
         elif self.atype == 'add':
-            e = torch.tanh(self.key.unsqueeze(2) + query.unsqueeze(3))
-            e = e.permute(0, 2, 3, 1, 4).contiguous().view(bs, qlen, klen, -1)
-            e = self.v(e).permute(0, 3, 1, 2)
+            e = torch.tanh(self.key.unsqueeze(1).unsqueeze(3) + query.unsqueeze(4))
+            e = e.permute(0, 1, 3, 4, 2, 5).contiguous().view(kbs, n_groups, qlen, klen, -1)
+            e = self.v(e).permute(0, 1, 4, 2, 3)
 
         # Compute attention weights
         if self.mask is not None:
-            e = e.masked_fill_(self.mask == 0, NEG_INF)  # `[B, n_heads, qlen, klen]`
+            e = e.masked_fill_(self.mask.unsqueeze(1) == 0, NEG_INF)  # `[B', B // B', n_heads, qlen, klen]`
         aw = torch.softmax(e, dim=-1)
         aw = self.attn_dropout(aw)
-        cv = torch.matmul(aw, self.value)  # `[B, n_heads, qlen, d_k]`
+        cv = torch.matmul(aw, self.value.unsqueeze(1))  # `[B', B // B', n_heads, qlen, d_k]`
+        cv = cv.view(bs, self.n_heads, qlen, self.d_k)
         cv = cv.transpose(2, 1).contiguous().view(bs, -1,  self.n_heads * self.d_k)
         cv = self.w_out(cv)
+        aw = aw.view(bs, self.n_heads, qlen, klen)
 
         return cv, aw
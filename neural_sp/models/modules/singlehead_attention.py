@@ -116,8 +116,14 @@ class AttentionMechanism(nn.Module):
             cv (FloatTensor): `[B, 1, vdim]`
             aw (FloatTensor): `[B, klen, 1 (n_heads)]`
 
+        NOTE: key and value can have a smaller batch size `B'` than query
+            as long as `B` is a multiple of `B'`. Rows of query are then grouped
+            per key (e.g., hypotheses of each utterance during beam search)
+            and the cached key projection is broadcast over each group.
+
         """
-        bs, klen = key.size()[:2]
+        klen = key.size(1)
+        bs = query.size(0)
 
         if aw_prev is None:
             aw_prev = key.new_zeros(bs, klen, 1)
@@ -130,6 +136,10 @@ class AttentionMechanism(nn.Module):
                 self.key = key
             self.mask = mask
 
+        kbs = self.key.size(0)
+        n_groups = bs // kbs
+        key_g = self.key.unsqueeze(1)  # `[B', 1, klen, adim]`
+
         if self.atype == 'no':
             raise NotImplementedError
             # last_state = [key[b, klens[b] - 1] for b in range(bs)]
@@ -137,37 +147,36 @@ class AttentionMechanism(nn.Module):
             # return cv, None
 
         elif self.atype == 'add':
-            query = query.repeat([1, klen, 1])
-            e = self.v(torch.tanh(self.key + self.w_query(query)))
+            query = self.w_query(query).view(kbs, n_groups, 1, -1)
+            e = self.v(torch.tanh(key_g + query))
 
         elif self.atype == 'location':
-            query = query.repeat([1, klen, 1])
+            query = self.w_query(query).view(kbs, n_groups, 1, -1)
             conv_feat = self.conv(aw_prev.unsqueeze(3).transpose(3, 1)).squeeze(2)  # `[B, ch, klen]`
             conv_feat = conv_feat.transpose(2, 1).contiguous()  # `[B, klen, ch]`
-            e = self.v(torch.tanh(self.key + self.w_query(query) + self.w_conv(conv_feat)))
+            conv_feat = self.w_conv(conv_feat).view(kbs, n_groups, klen, -1)
+            e = self.v(torch.tanh(key_g + query + conv_feat))
 
         elif self.atype == 'dot':
-            e = torch.bmm(self.key, self.w_query(query).transpose(-2, -1))
-
-        elif self.atype == 'luong_dot':
-            e = torch.bmm(self.key, query.transpose(-2, -1))
+            e = torch.matmul(key_g, self.w_query(query).view(kbs, n_groups, -1, 1))
 
-        elif self.atype == 'luong_general':
-            e = torch.bmm(self.key, query.transpose(-2, -1))
+        elif self.atype in ['luong_dot', 'luong_general']:
+            e = torch.matmul(key_g, query.view(kbs, n_groups, -1, 1))
 
         elif self.atype == 'luong_concat':
-            query = query.repeat([1, klen, 1])
-            e = self.v(torch.tanh(self.w(torch.cat([self.key, query], dim=-1))))
+            query = query.view(kbs, n_groups, 1, -1).expand(-1, -1, klen, -1)
+            e = self.v(torch.tanh(self.w(torch.cat([key_g.expand(-1, n_groups, -1, -1), query], dim=-1))))
 
         # Compute attention weights, context vector
-        e = e.squeeze(2)  # `[B, klen]`
+        e = e.squeeze(3)  # `[B', B // B', klen]`
         if self.mask is not None:
-            e = e.masked_fill_(self.mask == 0, NEG_INF)
+            e = e.masked_fill_(self.mask.view(kbs, 1, klen) == 0, NEG_INF)
+        e = e.view(bs, klen)
         if self.sigmoid_smoothing:
             aw = torch.sigmoid(e) / torch.sigmoid(e).sum(1).unsqueeze(1)
         else:
             aw = torch.softmax(e * self.sharpening_factor, dim=-1)
         aw = self.attn_dropout(aw)
-        cv = torch.bmm(aw.unsqueeze(1), value)
+        cv = torch.matmul(aw.view(kbs, n_groups, klen), value).view(bs, 1, -1)
 
         return cv, aw.unsqueeze(2)
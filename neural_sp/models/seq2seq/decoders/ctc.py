@@ -11,7 +11,6 @@ from __future__ import division
 from __future__ import print_function
 
 from collections import OrderedDict
-from itertools import groupby
 import logging
 import numpy as np
 import random
@@ -129,37 +128,37 @@ class CTC(DecoderBase):
 
         Args:
             eouts (FloatTensor): `[B, T, enc_n_units]`
-            elens (np.ndarray): `[B]`
+            elens (IntTensor): `[B]`
         Returns:
-            hyps (np.ndarray): Best path hypothesis. `[B, labels_max_seq_len]`
+            hyps (list): A list of length `[B]`, which contains arrays of size `[L]`
 
         """
-        bs = eouts.size(0)
-        hyps = []
-
-        log_probs = torch.log_softmax(self.output(eouts), dim=-1)
-
         # Pickup argmax class
-        for b in range(bs):
-            indices = []
-            time = elens[b]
-            for t in range(time):
-                argmax = log_probs[b, t].argmax(0).item()
-                indices.append(argmax)
+        best_paths = self.output(eouts).argmax(-1)  # `[B, T]`
+        mask = make_pad_mask(elens, self.device_id)
+        best_paths = best_paths[:, :mask.size(1)]
 
-            # Step 1. Collapse repeated labels
-            collapsed_indices = [x[0] for x in groupby(indices)]
+        # Step 1. Collapse repeated labels
+        keep = mask.clone()
+        keep[:, 1:] &= best_paths[:, 1:] != best_paths[:, :-1]
 
-            # Step 2. Remove all blank labels
-            best_hyp = [x for x in filter(lambda x: x != self.blank, collapsed_indices)]
-            hyps.append(np.array(best_hyp))
+        # Step 2. Remove all blank labels
+        keep &= best_paths != self.blank
 
-        return np.array(hyps)
+        # Copy to the host at once
+        best_paths = tensor2np(best_paths.masked_fill(keep == 0, -1))
+        return [best_path[best_path >= 0] for best_path in best_paths]
 
     def beam_search(self, eouts, elens, params, idx2token,
                     lm=None, lm_2nd=None, lm_2nd_rev=None,
                     nbest=1, refs_id=None, utt_ids=None, speakers=None):
-        """Beam search decoding.
+        """Prefix beam search decoding.
+
+        Hypotheses sharing the same label sequence are merged into a single
+        prefix by summing their blank- and non-blank-ending probabilities.
+        LM scores are computed once per prefix, in a single batch for all
+        prefixes newly added to the beam, and are cached for the rest of the
+        utterance.
 
         Args:
             eouts (FloatTensor): `[B, T, enc_n_units]`
@@ -170,6 +169,8 @@ class CTC(DecoderBase):
                 recog_lm_weight (float): weight of first path LM score
                 recog_lm_second_weight (float): weight of second path LM score
                 recog_lm_rev_weight (float): weight of second path backward LM score
+                recog_ctc_blank_skip_threshold (float): prefixes are not extended
+                    at frames whose blank posterior exceeds this value
             idx2token (): converter from index to token
             lm: firsh path LM
             lm_2nd: second path LM
@@ -187,8 +188,10 @@ class CTC(DecoderBase):
         beam_width = params['recog_beam_width']
         lp_weight = params['recog_length_penalty']
         lm_weight = params['recog_lm_weight']
+        lm_normalizer_size = params['recog_lm_normalizer_size']
         lm_weight_2nd = params['recog_lm_second_weight']
         lm_weight_2nd_rev = params['recog_lm_rev_weight']
+        blank_skip_threshold = params['recog_ctc_blank_skip_threshold']
 
         if lm is not None:
             assert lm_weight > 0
@@ -196,109 +199,145 @@ class CTC(DecoderBase):
         if lm_2nd is not None:
             assert lm_weight_2nd > 0
             lm_2nd.eval()
+        if lm_2nd_rev is not None:
+            assert lm_weight_2nd_rev > 0
+            lm_2nd_rev.eval()
+        use_lm = lm is not None and lm_weight > 0
+        self.nbest_hyps_final = [] if params['recog_nbest_export'] else None
 
-        best_hyps = []
         log_probs = torch.log_softmax(self.output(eouts), dim=-1)
+        # Candidates are taken from the top-k labels of each frame
+        topk_ids = torch.topk(log_probs, k=min(beam_width, self.vocab), dim=-1,
+                              largest=True, sorted=True)[1]
+        topk_ids = tensor2np(topk_ids)
+        log_probs = tensor2np(log_probs)
+
+        if blank_skip_threshold >= 1:
+            log_blank_skip_threshold = np.inf
+        else:
+            log_blank_skip_threshold = np.log(max(blank_skip_threshold, 1e-10))
+
+        best_hyps = []
         for b in range(bs):
-            # Elements in the beam are (prefix, (p_b, p_no_blank))
+            lp_b = log_probs[b]
+            skip = lp_b[:elens[b], self.blank] > log_blank_skip_threshold
+
+            # Per-utterance LM cache keyed by prefix (including the leading <eos>)
+            # score_lm: accumulated LM score of the prefix
+            # lmstate: LM state after consuming the prefix
+            # lm_log_probs: LM log-probabilities of the candidate next labels
+            lm_cache = {}
+            root = (self.eos,)  # <eos> is used for LM
+            lm_cache[root] = {'score_lm': LOG_1, 'lmstate': None, 'lm_log_probs': None}
+            if use_lm:
+                # Prefixes are only extended with the top-k labels of non-skipped frames,
+                # so the LM scores only these labels
+                lm_cands = np.unique(topk_ids[b, :elens[b]][~skip])
+                lm_cands = lm_cands[lm_cands != self.blank]
+                cand_index = np.full(self.vocab, -1, dtype=np.int64)
+                cand_index[lm_cands] = np.arange(len(lm_cands))
+                lm_cands = np2tensor(lm_cands, self.device_id)
+                self._update_lm_cache(lm, lm_cache, [root], lm_cands, lm_normalizer_size)
+
+            # Elements in the beam are prefix: (p_b, p_nb)
             # Initialize the beam with the empty sequence, a probability of
             # 1 for ending in blank and zero for ending in non-blank (in log space).
-            beam = [{'hyp': [self.eos],  # <eos> is used for LM
-                     'p_b': LOG_1,
-                     'p_nb': LOG_0,
-                     'score_lm': LOG_1,
-                     'lmstate': None}]
+            beam = {root: (LOG_1, LOG_0)}
+            # all prefixes scored at the last frame before pruning, merged into a lattice for export
+            final_beam = beam
 
             for t in range(elens[b]):
-                new_beam = []
-
-                # Pick up the top-k scores
-                log_probs_topk, topk_ids = torch.topk(
-                    log_probs[b:b + 1, t], k=min(beam_width, self.vocab), dim=-1, largest=True, sorted=True)
-
-                for i_beam in range(len(beam)):
-                    hyp = beam[i_beam]['hyp'][:]
-                    p_b = beam[i_beam]['p_b']
-                    p_nb = beam[i_beam]['p_nb']
-                    score_lm = beam[i_beam]['score_lm']
-
-                    # case 1. hyp is not extended
-                    new_p_b = np.logaddexp(p_b + log_probs[b, t, self.blank].item(),
-                                           p_nb + log_probs[b, t, self.blank].item())
-                    if len(hyp) > 1:
-                        new_p_nb = p_nb + log_probs[b, t, hyp[-1]].item()
-                    else:
-                        new_p_nb = LOG_0
-                    score_ctc = np.logaddexp(new_p_b, new_p_nb)
-                    score_lp = len(hyp[1:]) * lp_weight
-                    new_beam.append({'hyp': hyp,
-                                     'score': score_ctc + score_lm + score_lp,
-                                     'p_b': new_p_b,
-                                     'p_nb': new_p_nb,
-                                     'score_ctc': score_ctc,
-                                     'score_lm': score_lm,
-                                     'score_lp': score_lp,
-                                     'lmstate': beam[i_beam]['lmstate']})
-
-                    # Update LM states for shallow fusion
-                    if lm_weight > 0 and lm is not None:
-                        _, lmstate, lm_log_probs = lm.predict(
-                            eouts.new_zeros(1, 1).fill_(hyp[-1]), beam[i_beam]['lmstate'])
+                lp_t = lp_b[t]
+                lp_blank = lp_t[self.blank]
+                new_beam = {}
+
+                if skip[t]:
+                    # Blank dominates this frame: no prefix is extended
+                    for prefix, (p_b, p_nb) in beam.items():
+                        new_p_nb = p_nb + lp_t[prefix[-1]] if len(prefix) > 1 else LOG_0
+                        new_beam[prefix] = (np.logaddexp(p_b, p_nb) + lp_blank, new_p_nb)
+                    beam = final_beam = new_beam
+                    continue
+
+                cands = topk_ids[b, t]
+                cands = cands[cands != self.blank]
+                lp_cands = lp_t[cands]
+                for prefix, (p_b, p_nb) in beam.items():
+                    p_total = np.logaddexp(p_b, p_nb)
+
+                    # case 1. prefix is not extended
+                    new_p_nb = p_nb + lp_t[prefix[-1]] if len(prefix) > 1 else LOG_0
+                    _add_prefix(new_beam, prefix, p_total + lp_blank, new_p_nb)
+
+                    # case 2. prefix is extended
+                    # a repeated label is only reachable from a blank-ending path
+                    if len(prefix) > 1:
+                        p_ext = np.where(cands == prefix[-1], p_b, p_total) + lp_cands
                     else:
-                        lmstate = None
-
-                    # case 2. hyp is extended
-                    new_p_b = LOG_0
-                    for c in tensor2np(topk_ids)[0]:
-                        p_t = log_probs[b, t, c].item()
-
-                        if c == self.blank:
-                            continue
-
-                        c_prev = hyp[-1] if len(hyp) > 1 else None
-                        if c == c_prev:
-                            new_p_nb = p_b + p_t
-                            # TODO(hirofumi): apply character LM here
-                        else:
-                            new_p_nb = np.logaddexp(p_b + p_t, p_nb + p_t)
-                            # TODO(hirofumi): apply character LM here
-                            if c == self.space:
-                                pass
-                                # TODO(hirofumi): apply word LM here
-
-                        score_ctc = np.logaddexp(new_p_b, new_p_nb)
-                        score_lp = (len(hyp[1:]) + 1) * lp_weight
-                        if lm_weight > 0 and lm is not None:
-                            local_score_lm = lm_log_probs[0, 0, c].item() * lm_weight
-                            score_lm += local_score_lm
-                        new_beam.append({'hyp': hyp + [c],
-                                         'score': score_ctc + score_lm + score_lp,
-                                         'p_b': new_p_b,
-                                         'p_nb': new_p_nb,
-                                         'score_ctc': score_ctc,
-                                         'score_lm': score_lm,
-                                         'score_lp': score_lp,
-                                         'lmstate': lmstate})
+                        p_ext = p_total + lp_cands
+                    for c, p in zip(cands.tolist(), p_ext.tolist()):
+                        _add_prefix(new_beam, prefix + (c,), LOG_0, p)
 
                 # Pruning
-                beam = sorted(new_beam, key=lambda x: x['score'], reverse=True)[:beam_width]
+                scores = {}
+                for prefix, (p_b, p_nb) in new_beam.items():
+                    scores[prefix] = np.logaddexp(p_b, p_nb) + (len(prefix) - 1) * lp_weight
+                    if use_lm:
+                        scores[prefix] += self._prefix_lm_score(lm_cache, prefix, lm_weight, cand_index)
+                prefixes = sorted(scores, key=lambda x: scores[x], reverse=True)[:beam_width]
+                beam = {prefix: new_beam[prefix] for prefix in prefixes}
+                final_beam = new_beam
+
+                # Query LM only for prefixes which have not been seen yet
+                if use_lm:
+                    self._update_lm_cache(lm, lm_cache, [prefix for prefix in prefixes
+                                                         if lm_cache[prefix]['lm_log_probs'] is None],
+                                          lm_cands, lm_normalizer_size)
+
+            hyps = []
+            for prefix, (p_b, p_nb) in (final_beam if self.nbest_hyps_final is not None else beam).items():
+                score_ctc = np.logaddexp(p_b, p_nb)
+                score_lm = self._prefix_lm_score(lm_cache, prefix, lm_weight, cand_index) if use_lm else LOG_1
+                score_lp = (len(prefix) - 1) * lp_weight
+                hyps.append({'hyp': list(prefix),
+                             'score': score_ctc + score_lm + score_lp,
+                             'p_b': p_b,
+                             'p_nb': p_nb,
+                             'score_ctc': score_ctc,
+                             'score_lm': score_lm,
+                             'score_lp': score_lp})
+            hyps = sorted(hyps, key=lambda x: x['score'], reverse=True)
+            beam = hyps[:beam_width]
+            if self.nbest_hyps_final is not None:
+                lattice = [{'hyp': hyp['hyp'][1:],
+                            'ended': True,
+                            'score': hyp['score'],
+                            'score_ctc': hyp['score_ctc'],
+                            'score_lm': hyp['score_lm'] / lm_weight if use_lm else 0.,
+                            'score_lp': hyp['score_lp']} for hyp in hyps]
 
             # Rescoing lattice
             if lm_2nd is not None:
-                new_beam = []
-                for i_beam in range(len(beam)):
-                    ys = [np2tensor(np.fromiter(beam[i_beam]['hyp'], dtype=np.int64), self.device_id)]
-                    ys_pad = pad_list(ys, lm_2nd.pad)
-                    _, _, lm_log_probs = lm_2nd.predict(ys_pad, None)
-                    score_ctc = np.logaddexp(beam[i_beam]['p_b'], beam[i_beam]['p_nb'])
-                    score_lm = lm_log_probs.sum() * lm_weight_2nd
-                    score_lp = len(beam[i_beam]['hyp'][1:]) * lp_weight
-                    new_beam.append({'hyp': beam[i_beam]['hyp'],
-                                     'score': score_ctc + score_lm + score_lp,
-                                     'score_ctc': score_ctc,
-                                     'score_lp': score_lp,
-                                     'score_lm': score_lm})
-                beam = sorted(new_beam, key=lambda x: x['score'], reverse=True)
+                scores_lm, _ = lm_2nd.score_sequences([hyp['hyp'] for hyp in beam])
+                for i_beam, hyp in enumerate(beam):
+                    hyp['score_lm_2nd'] = scores_lm[i_beam] * lm_weight_2nd
+                    hyp['score'] = hyp['score_ctc'] + hyp['score_lm_2nd'] + hyp['score_lp']
+            if lm_2nd_rev is not None:
+                scores_lm_rev, _ = lm_2nd_rev.score_sequences([hyp['hyp'][:1] + hyp['hyp'][1:][::-1]
+                                                               for hyp in beam])
+                for i_beam, hyp in enumerate(beam):
+                    hyp['score_lm_rev'] = scores_lm_rev[i_beam] * lm_weight_2nd_rev
+                    hyp['score'] += hyp['score_lm_rev']
+            if lm_2nd is not None or lm_2nd_rev is not None:
+                beam = sorted(beam, key=lambda x: x['score'], reverse=True)
+
+            if self.nbest_hyps_final is not None:
+                self.store_nbest([{'hyp': hyp['hyp'][1:],
+                                   'ended': True,
+                                   'score': hyp['score'],
+                                   'score_ctc': hyp['score_ctc'],
+                                   'score_lm': hyp['score_lm'] / lm_weight if use_lm else 0.,
+                                   'score_lp': hyp['score_lp']} for hyp in beam], lattice=lattice)
 
             best_hyps.append(np.array(beam[0]['hyp'][1:]))
 
@@ -313,7 +352,70 @@ class CTC(DecoderBase):
             if lm is not None:
                 logger.info('log prob (hyp, lm): %.7f' % (beam[0]['score_lm']))
 
-        return np.array(best_hyps)
+        return best_hyps
+
+    def _prefix_lm_score(self, lm_cache, prefix, lm_weight, cand_index):
+        """Return the accumulated LM score of a prefix whose parent has been cached."""
+        if prefix not in lm_cache:
+            parent = lm_cache[prefix[:-1]]
+            lm_log_prob = parent['lm_log_probs'][cand_index[prefix[-1]]]
+            lm_cache[prefix] = {'score_lm': parent['score_lm'] + lm_log_prob * lm_weight,
+                                'lmstate': None,
+                                'lm_log_probs': None}
+        return lm_cache[prefix]['score_lm']
+
+    def _update_lm_cache(self, lm, lm_cache, prefixes, cands, normalizer_size=0):
+        """Compute LM outputs for new prefixes in a single batch.
+
+        RNNLM consumes only the last label of each prefix from the cached state
+        of its parent. The other LMs (e.g., GatedConvLM and TransformerLM) carry
+        no recurrent state, so the whole prefixes are fed in batches of the same length.
+
+        Args:
+            lm: LM for shallow fusion
+            lm_cache (dict): prefix: dict
+            prefixes (list): prefixes whose next label distribution is not cached yet
+            cands (LongTensor): `[K]`, labels to be scored by the LM
+            normalizer_size (int): see `LMBase.predict_candidates`
+
+        """
+        if len(prefixes) == 0:
+            return
+        if len(prefixes[0]) > 1 and lm_cache[prefixes[0][:-1]]['lmstate'] is None:
+            for ylen in sorted(set([len(prefix) for prefix in prefixes])):
+                prefixes_l = [prefix for prefix in prefixes if len(prefix) == ylen]
+                ys = np2tensor(np.array(prefixes_l, dtype=np.int64), self.device_id)
+                _, _, lm_log_probs = lm.predict_candidates(ys, None, cands, normalizer_size)
+                for prefix, lm_log_probs_i in zip(prefixes_l, tensor2np(lm_log_probs)):
+                    lm_cache[prefix]['lm_log_probs'] = lm_log_probs_i
+            return
+        ys = np2tensor(np.array([prefix[-1] for prefix in prefixes], dtype=np.int64),
+                       self.device_id).unsqueeze(1)
+        if len(prefixes[0]) == 1:
+            # only the root has no parent state
+            lmstate = None
+        else:
+            parents = [lm_cache[prefix[:-1]]['lmstate'] for prefix in prefixes]
+            lmstate = {'hxs': torch.cat([s['hxs'] for s in parents], dim=1),
+                       'cxs': torch.cat([s['cxs'] for s in parents], dim=1) if parents[0]['cxs'] is not None else None}
+        _, lmstate, lm_log_probs = lm.predict_candidates(ys, lmstate, cands, normalizer_size)
+        lm_log_probs = tensor2np(lm_log_probs)
+        is_rnnlm = isinstance(lmstate, dict) and 'hxs' in lmstate
+        for i, prefix in enumerate(prefixes):
+            if is_rnnlm:
+                cxs = lmstate['cxs']  # None for GRU
+                lm_cache[prefix]['lmstate'] = {'hxs': lmstate['hxs'][:, i:i + 1],
+                                               'cxs': cxs[:, i:i + 1] if cxs is not None else None}
+            lm_cache[prefix]['lm_log_probs'] = lm_log_probs[i]
+
+
+def _add_prefix(beam, prefix, p_b, p_nb):
+    """Merge blank- and non-blank-ending probabilities of a prefix in log space."""
+    if prefix in beam:
+        p_b_prev, p_nb_prev = beam[prefix]
+        beam[prefix] = (np.logaddexp(p_b_prev, p_b), np.logaddexp(p_nb_prev, p_nb))
+    else:
+        beam[prefix] = (p_b, p_nb)
 
 
 def _label_to_path(labels, blank):
@@ -588,8 +690,11 @@ class CTCPrefixScore(object):
         if ylen == 0:
             r[0, 0] = xs[0]
             r[0, 1] = self.log0
-        else:
+        elif ylen <= self.xlen:
             r[ylen - 1] = self.log0
+        else:
+            # the prefix is longer than the frames, so that no label can follow
+            r[:] = self.log0
 
         # Initialize CTC state for the new chunk
         if new_chunk and self.xlen_prev > 0:
@@ -613,7 +718,7 @@ class CTCPrefixScore(object):
         # compute forward probabilities log(r_t^n(h)), log(r_t^b(h)),
         # and log prefix probabilites log(psi)
         start = max(ylen, 1)
-        log_psi = r[start - 1, 0]
+        log_psi = r[min(start, self.xlen) - 1, 0]
         for t in range(start, self.xlen):
             # non-blank
             r[t, 0] = np.logaddexp(r[t - 1, 0], log_phi[t - 1]) + xs[t]
@@ -629,3 +734,137 @@ class CTCPrefixScore(object):
         # return the log prefix probability and CTC states, where the label axis
         # of the CTC states is moved to the first axis to slice it easily
         return log_psi, np.rollaxis(r, 2)
+
+
+class CTCPrefixScoreTH(object):
+    """Compute CTC label sequence scores of multiple hypotheses in a batch.
+
+    This is a batched version of CTCPrefixScore, where all hypotheses of all
+    utterances are extended with their candidate labels in a single recursion
+    over time. The recursion can be optionally restricted to frames near the
+    attention peaks of the current step.
+
+    [Reference]:
+        https://github.com/espnet/espnet
+    """
+
+    def __init__(self, log_probs, xlens, blank, eos, flip=False, margin=0):
+        """
+        Args:
+            log_probs (FloatTensor): `[B, T, vocab]`
+            xlens (list): A list of length `[B]`
+            blank (int): index of <blank>
+            eos (int): index of <eos>
+            flip (bool): reverse each utterance in time for backward decoders
+            margin (int): number of frames around attention peaks to compute
+                the forward probabilities. 0 means all frames are used.
+
+        """
+        self.blank = blank
+        self.eos = eos
+        self.margin = margin
+        self.flip = flip
+        self.log0 = LOG_0
+
+        bs, xmax, vocab = log_probs.size()
+        self.xmax = xmax
+        if torch.is_tensor(xlens):
+            self.xlens = xlens.to(log_probs.device).long()
+        else:
+            self.xlens = torch.as_tensor(np.array(xlens, dtype=np.int64), device=log_probs.device)
+        if flip:
+            pos = torch.arange(xmax, device=log_probs.device).unsqueeze(0)
+            rev = torch.where(pos < self.xlens.unsqueeze(1), self.xlens.unsqueeze(1) - 1 - pos, pos)
+            log_probs = log_probs.gather(1, rev.unsqueeze(2).expand(bs, xmax, vocab))
+
+        # Padded frames only emit blank so that the forward probabilities are
+        # carried over to the last frame
+        x = log_probs.transpose(1, 0).contiguous()  # `[T, B, vocab]`
+        pos = torch.arange(xmax, device=log_probs.device).unsqueeze(1)
+        pad_mask = (pos >= self.xlens.unsqueeze(0)).unsqueeze(2)  # `[T, B, 1]`
+        self.x = x.masked_fill(pad_mask, self.log0)
+        self.x_blank = x[:, :, blank].masked_fill(pad_mask.squeeze(2), 0)  # `[T, B]`
+
+        # range of attention peaks observed so far
+        self.f_min_prev = 0
+        self.f_max_prev = 0
+
+    def initial_state(self):
+        """Obtain initial CTC states of all utterances.
+
+        Returns:
+            ctc_states (FloatTensor): `[T, 2, B]`
+
+        """
+        # r_t^n(<sos>) and r_t^b(<sos>), where 0 and 1 of axis=1 represent
+        # superscripts n and b (non-blank and blank), respectively.
+        r_n = torch.full_like(self.x_blank, self.log0)
+        r_b = torch.cumsum(self.x_blank, dim=0)
+        return torch.stack([r_n, r_b], dim=1)
+
+    def __call__(self, hyps, cs, r_prev, utt_ids, aw=None):
+        """Compute CTC prefix scores for next labels of all hypotheses.
+
+        Args:
+            hyps (list): A list of length `[N]`, which contains prefix label sequences
+            cs (LongTensor): next labels. `[N, K]`
+            r_prev (FloatTensor): previous CTC states. `[T, 2, N]`
+            utt_ids (LongTensor): utterance index of each hypothesis. `[N]`
+            aw (FloatTensor): attention weights of the current step. `[N, T']`
+        Returns:
+            ctc_scores (FloatTensor): `[N, K]`
+            ctc_states (FloatTensor): `[T, 2, N, K]`
+
+        """
+        n_hyps, n_labels = cs.size()
+        xmax = self.xmax
+
+        xs = self.x[:, utt_ids].gather(2, cs.unsqueeze(0).expand(xmax, n_hyps, n_labels))  # `[T, N, K]`
+        xs_blank = self.x_blank[:, utt_ids].unsqueeze(2).expand(xmax, n_hyps, n_labels)  # `[T, N, K]`
+
+        # initialize CTC states
+        ylens = [len(hyp) - 1 for hyp in hyps]  # ignore sos
+        r = cs.new_zeros(xmax, 2, n_hyps, n_labels).float().fill_(self.log0)
+        no_label = cs.new_tensor([ylen == 0 for ylen in ylens]).bool()
+        r[0, 0] = xs[0].masked_fill(~no_label.unsqueeze(1), self.log0)
+
+        # prepare forward probabilities for the last label
+        r_sum = torch.logsumexp(r_prev, dim=1)  # log(r_t^n(g) + r_t^b(g)), `[T, N]`
+        last = cs.new_tensor([hyp[-1] for hyp in hyps])
+        same = (cs == last.unsqueeze(1)) & (~no_label).unsqueeze(1)  # `[N, K]`
+        log_phi = torch.where(same.unsqueeze(0).expand(xmax, n_hyps, n_labels),
+                              r_prev[:, 1].unsqueeze(2).expand(xmax, n_hyps, n_labels),
+                              r_sum.unsqueeze(2).expand(xmax, n_hyps, n_labels))
+
+        # frames to compute
+        start = max(min(ylens), 1)
+        end = xmax
+        if self.margin > 0 and aw is not None:
+            peaks = aw.argmax(1)
+            if self.flip:
+                peaks = self.xlens[utt_ids] - 1 - peaks
+            f_min, f_max = torch.stack([peaks.min(), peaks.max()]).tolist()
+            f_min = max(f_min, self.f_min_prev)
+            f_max = max(f_max, self.f_max_prev)
+            start = max(min(self.f_max_prev, max(f_min - self.margin, min(ylens))), 1)
+            end = min(f_max + self.margin, xmax)
+            self.f_min_prev = f_min
+            self.f_max_prev = f_max
+            if start > 1:
+                r[start - 1] = self.log0
+
+        # compute forward probabilities log(r_t^n(h)) and log(r_t^b(h))
+        for t in range(start, end):
+            r_t = torch.stack([r[t - 1, 0], log_phi[t - 1], r[t - 1, 0], r[t - 1, 1]], dim=0)
+            r[t] = torch.logsumexp(r_t.view(2, 2, n_hyps, n_labels), dim=1) + \
+                torch.stack([xs[t], xs_blank[t]], dim=0)
+
+        # compute log prefix probabilites log(psi)
+        log_psi = torch.logsumexp(torch.cat([r[start - 1, 0].unsqueeze(0),
+                                             log_phi[start - 1:end - 1] + xs[start:end]], dim=0), dim=0)
+
+        # get P(...eos|X) that ends with the prefix itself
+        r_sum_last = r_sum.gather(0, (self.xlens[utt_ids] - 1).unsqueeze(0)).squeeze(0)  # `[N]`
+        log_psi = torch.where(cs == self.eos, r_sum_last.unsqueeze(1).expand(n_hyps, n_labels), log_psi)
+
+        return log_psi, r
@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""CTC-based voice activity detection (segmentation at runs of blank frames)."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import numpy as np
+import torch
+
+from neural_sp.models.torch_utils import tensor2np
+
+logger = logging.getLogger(__name__)
+
+
+def blank_frames(ctc_probs, blank, spike_threshold):
+    """Detect frames regarded as <blank>.
+
+    A frame is regarded as <blank> when the best label is <blank> or
+    the probability of the best label is below the spike threshold.
+
+    Args:
+        ctc_probs (FloatTensor or np.ndarray): `[T, vocab]` or `[B, T, vocab]`
+        blank (int): index of <blank>
+        spike_threshold (float): minimum probability of non-blank spikes
+    Returns:
+        is_blank (np.ndarray): `[T]` or `[B, T]`
+
+    """
+    if torch.is_tensor(ctc_probs):
+        topk_probs, topk_ids = ctc_probs.max(-1)
+        return tensor2np((topk_ids == blank) | (topk_probs < spike_threshold)).astype(np.bool_)
+    topk_ids = ctc_probs.argmax(-1)
+    topk_probs = ctc_probs.max(-1)
+    return (topk_ids == blank) | (topk_probs < spike_threshold)
+
+
+def blank_run_lengths(is_blank, n_blanks_prev=0):
+    """Count the number of consecutive <blank> frames up to each frame.
+
+    Args:
+        is_blank (np.ndarray): `[T]`
+        n_blanks_prev (int): number of consecutive <blank> frames before the first frame
+    Returns:
+        n_blanks (np.ndarray): `[T]`
+
+    """
+    pos = np.arange(len(is_blank))
+    last_non_blank = np.maximum.accumulate(np.where(is_blank, -1, pos)) if len(is_blank) > 0 else pos
+    return np.where(last_non_blank >= 0, pos - last_non_blank, n_blanks_prev + pos + 1)
+
+
+def detect_boundary(is_blank, n_blanks_prev, blank_threshold):
+    """Detect the first segmentation point in a chunk.
+
+    Args:
+        is_blank (np.ndarray): `[T]`
+        n_blanks_prev (int): number of consecutive <blank> frames carried over from the previous chunk
+        blank_threshold (float): number of consecutive <blank> frames to segment
+    Returns:
+        boundary (int): offset of the segmentation point in the chunk (-1 if not found)
+        n_blanks (int): number of consecutive <blank> frames at the last frame
+
+    """
+    if len(is_blank) == 0:
+        return -1, n_blanks_prev
+    n_blanks = blank_run_lengths(is_blank, n_blanks_prev)
+    over = np.where(n_blanks > blank_threshold)[0]
+    boundary = over[0] if len(over) > 0 else -1
+    return int(boundary), int(n_blanks[-1])
+
+
+def ctc_vad_segments(ctc_probs, blank, blank_threshold, spike_threshold, min_len=0, max_len=0):
+    """Split a recording of an arbitrary length at runs of <blank> frames.
+
+    A segment ends at the frame where the number of consecutive <blank>
+    frames (counted from the beginning of the segment) surpasses the
+    threshold, as the segmentation strategy of `Speech2Text.decode_streaming`.
+
+    Args:
+        ctc_probs (FloatTensor or np.ndarray): `[T, vocab]`
+        blank (int): index of <blank>
+        blank_threshold (float): number of consecutive <blank> frames to segment
+        spike_threshold (float): minimum probability of non-blank spikes
+        min_len (int): minimum number of frames in a segment
+        max_len (int): maximum number of frames in a segment (0 means no limit).
+            A segment exceeding this is split after the longest run of <blank> frames in it.
+    Returns:
+        segments (np.ndarray): `[N, 2]`, start and end (exclusive) frames of segments
+        is_blank (np.ndarray): `[T]`
+
+    """
+    is_blank = blank_frames(ctc_probs, blank, spike_threshold)
+    xlen = len(is_blank)
+    n_blanks = blank_run_lengths(is_blank)
+    candidates = np.where(n_blanks > blank_threshold)[0]
+
+    segments = []
+    start = 0
+    while start < xlen:
+        # consecutive <blank> frames are counted from the start of each segment
+        first = max(start + int(np.floor(blank_threshold)), start + min_len - 1)
+        i = np.searchsorted(candidates, first)
+        end = int(candidates[i]) + 1 if i < len(candidates) else xlen
+        if 0 < max_len < end - start:
+            offset = start + min(max(min_len - 1, 0), max_len - 1)
+            window = np.minimum(n_blanks[offset:start + max_len], np.arange(offset, start + max_len) - start + 1)
+            if window.max() > 0:
+                end = offset + int(window.argmax()) + 1
+            else:
+                end = start + max_len
+        segments.append((start, end))
+        start = end
+
+    logger.debug('%d segments from %d frames' % (len(segments), xlen))
+    return np.array(segments, dtype=np.int64).reshape(-1, 2), is_blank
@@ -11,15 +11,21 @@ from __future__ import division
 from __future__ import print_function
 
 import logging
+import math
 import numpy as np
 import torch
 
+from neural_sp.datasets.nbest import build_lattice
 from neural_sp.models.base import ModelBase
+from neural_sp.models.torch_utils import make_pad_mask
 from neural_sp.models.torch_utils import np2tensor
 from neural_sp.models.torch_utils import pad_list
+from neural_sp.models.torch_utils import tensor2np
 
 logger = logging.getLogger(__name__)
 
+NEG_INF = float(np.finfo(np.float32).min)
+
 
 class DecoderBase(ModelBase):
     """Base class for decoders."""
@@ -117,18 +123,133 @@ class DecoderBase(ModelBase):
         _, topk_ids = torch.topk(probs, k=topk, dim=-1, largest=True, sorted=True)
         return probs, topk_ids
 
+    def ctc_shortlist(self, eouts, elens, threshold):
+        """Build per-utterance token shortlists from CTC posteriors.
+
+        A token is shortlisted if its CTC posterior exceeds `threshold` at any frame.
+        <eos> is never emitted by CTC, so it is always placed at the first position.
+
+        Args:
+            eouts (FloatTensor): `[B, T, enc_units]`
+            elens (IntTensor): `[B]`
+            threshold (float): posterior threshold
+        Returns:
+            shortlist (LongTensor): `[B, K]`, padded with <pad>
+
+        """
+        probs = self.ctc_probs(eouts)
+        mask = make_pad_mask(elens, self.device_id).unsqueeze(2)
+        max_probs = tensor2np(probs.masked_fill(mask == 0, 0).max(1)[0])  # `[B, vocab]`
+        max_probs[:, [self.blank, self.eos, self.pad]] = 0
+        shortlist = [np2tensor(np.concatenate([[self.eos], np.nonzero(p > threshold)[0]]), self.device_id)
+                     for p in max_probs]
+        return pad_list(shortlist, self.pad)
+
+    def slice_output(self, shortlist):
+        """Slice the output layer for per-utterance token shortlists.
+
+        Args:
+            shortlist (LongTensor): `[B, K]`
+        Returns:
+            weight (FloatTensor): `[B, K, dim]`
+            bias (FloatTensor): `[B, K]`, where padded entries are masked out
+
+        """
+        weight = self.output.weight[shortlist]
+        if self.output.bias is not None:
+            bias = self.output.bias[shortlist]
+        else:
+            bias = weight.new_zeros(shortlist.size())
+        bias = bias.masked_fill(shortlist == self.pad, NEG_INF)
+        return weight, bias
+
+    def shortlist_logits(self, douts, output_sl, utts):
+        """Compute logits over the shortlisted tokens of each utterance.
+
+        Args:
+            douts (FloatTensor): `[n_utts * n_rows, dim]`, grouped per utterance
+            output_sl (tuple): sliced output layer (see `slice_output`)
+            utts (list): indices of utterances in the batch
+        Returns:
+            logits (FloatTensor): `[n_utts * n_rows, K]`
+
+        """
+        weight, bias = output_sl[0][utts], output_sl[1][utts]
+        logits = torch.bmm(douts.view(len(utts), -1, douts.size(-1)), weight.transpose(2, 1))
+        logits = logits + bias.unsqueeze(1)
+        return logits.view(-1, logits.size(-1))
+
+    def score_upper_bound(self, hyp, n_steps, lp_weight, cp_weight, ctc_weight, lm_weight,
+                          length_norm, gnmt_decoding):
+        """Upper bound of the score a hypothesis can reach within the remaining steps.
+
+        Attention, CTC and LM scores never increase as a hypothesis grows, while the
+        length penalty and (linear) coverage penalty increase at most by their
+        weights per step. The bound accounts for the length normalization in use.
+
+        Args:
+            hyp (dict): hypothesis including `hyp` (with <sos>) and scores
+            n_steps (int): maximum number of remaining steps
+            lp_weight (float): weight of length penalty
+            cp_weight (float): weight of coverage penalty
+            ctc_weight (float): weight of CTC score
+            lm_weight (float): weight of LM score
+            length_norm (bool): scores are normalized by length
+            gnmt_decoding (bool): length and coverage penalties of GNMT
+        Returns:
+            bound (float):
+
+        """
+        ylen = len(hyp['hyp']) - 1
+        if gnmt_decoding:
+            if length_norm:
+                return float('inf')
+            score = hyp['score_attn'] * (1 - ctc_weight) + hyp['score_lm'] * lm_weight
+            if lp_weight > 0:
+                score /= math.pow((5 + ylen + n_steps) / 6, lp_weight)
+            return score + hyp['score_ctc'] * ctc_weight
+        reward = max(lp_weight, 0) + max(cp_weight, 0)
+        if not length_norm:
+            return hyp['score'] + reward * n_steps
+        score = hyp['score'] * ylen
+        return max((score + reward) / (ylen + 1), (score + reward * n_steps) / (ylen + n_steps))
+
+    def store_nbest(self, nbest, lattice=None):
+        """Keep N-best hypotheses of an utterance with their component scores for export.
+
+        Args:
+            nbest (list): A list of dict, which contains `hyp` (token IDs without <sos>)
+                and scores listed in `NBEST_FIELDS`. `ended` is set to whether `hyp`
+                contains <eos> unless given.
+            lattice (list): all complete hypotheses reached by the search in the same form
+                as `nbest`, which are merged into a prefix graph
+
+        """
+        for hyp in nbest + (lattice or []):
+            if 'ended' not in hyp:
+                hyp['ended'] = self.eos in list(hyp['hyp'])
+            hyp['hyp'] = np.array([idx for idx in hyp['hyp'] if idx != self.eos], dtype=np.int32)
+        self.nbest_hyps_final.append({'nbest': nbest,
+                                      'lattice': build_lattice(lattice) if lattice else None})
+
     def lm_rescoring(self, hyps, lm, lm_weight, reverse=False, tag=''):
+        """Rescore N-best hypotheses with an external LM.
+
+        All hypotheses are scored in a single batch, and the length-normalized
+        LM scores are added to `score` and stored as `score_lm_` + tag.
+
+        Args:
+            hyps (list): A list of hypotheses, each of which contains `hyp` including <sos>
+            lm: external LM
+            lm_weight (float): weight of LM score
+            reverse (bool): score hypotheses in the reverse order
+            tag (str): suffix of the key to store LM scores
+
+        """
+        if len(hyps) == 0:
+            return
+        scores_lm, ylens = lm.score_sequences([hyp['hyp'] for hyp in hyps], reverse)
+        scores_lm /= np.maximum(ylens, 1)
         for i in range(len(hyps)):
-            ys = hyps[i]['hyp']  # include <sos>
-            if reverse:
-                ys = ys[::-1]
-            ys = [np2tensor(np.fromiter(ys, dtype=np.int64), self.device_id)]
-            ys_in = pad_list([y[:-1] for y in ys], -1)  # `[1, L-1]`
-            ys_out = pad_list([y[1:] for y in ys], -1)  # `[1, L-1]`
-
-            lmout, lmstate, scores_lm = lm.predict(ys_in, None)
-            score_lm = sum([scores_lm[0, t, ys_out[0, t]] for t in range(ys_out.size(1))])
-            score_lm /= ys_out.size(1)
-
-            hyps[i]['score'] += score_lm * lm_weight
-            hyps[i]['score_lm_' + tag] = score_lm
+            hyps[i]['score'] += scores_lm[i] * lm_weight
+            hyps[i]['score_lm_' + tag] = scores_lm[i]
@@ -11,6 +11,7 @@ from __future__ import division
 from __future__ import print_function
 
 import logging
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
@@ -71,40 +72,66 @@ def fwd_bwd_attention(nbest_hyps_fwd, aws_fwd, scores_fwd,
                 # <eos> only
                 logger.info(nbest_hyps_bwd[b][n])
 
+        # Attention peaks of all steps are computed once per hypothesis
+        peaks_fwd = [_attention_peaks(aws_fwd[b][n]) for n in range(nbest)]
+        peaks_bwd = [_attention_peaks(aws_bwd[b][n]) for n in range(nbest)]
+        if flip:
+            peaks_bwd = [max_time - peaks for peaks in peaks_bwd]
+
         for n_f in range(nbest):
+            ys_fwd = np.asarray(nbest_hyps_fwd[b][n_f])
+            sc_fwd = np.asarray(scores_fwd[b][n_f])
+            l_fwd = len(aws_fwd[b][n_f]) - 1
+            if l_fwd <= 0:
+                continue
+            t_curr = peaks_fwd[n_f][:l_fwd]  # `[L_fwd]`
             for n_b in range(nbest):
-                for i_f in range(len(aws_fwd[b][n_f]) - 1):
-                    for i_b in range(len(aws_bwd[b][n_b]) - 1):
-                        if flip:
-                            t_prev = max_time - aws_bwd[b][n_b][i_b + 1].argmax(-2)
-                            t_curr = aws_fwd[b][n_f][i_f].argmax(-2)
-                            t_next = max_time - aws_bwd[b][n_b][i_b - 1].argmax(-2)
-                        else:
-                            t_prev = aws_bwd[b][n_b][i_b + 1].argmax(-2)
-                            t_curr = aws_fwd[b][n_f][i_f].argmax(-2)
-                            t_next = aws_bwd[b][n_b][i_b - 1].argmax(-2)
-
-                        # the same token at the same time
-                        if t_curr >= t_prev and t_curr <= t_next and nbest_hyps_fwd[b][n_f][i_f] == nbest_hyps_bwd[b][n_b][i_b]:
-                            new_hyp = nbest_hyps_fwd[b][n_f][:i_f + 1].tolist() + \
-                                nbest_hyps_bwd[b][n_b][i_b + 1:].tolist()
-                            score_curr_fwd = scores_fwd[b][n_f][i_f] - scores_fwd[b][n_f][i_f - 1]
-                            score_curr_bwd = scores_bwd[b][n_b][i_b] - scores_bwd[b][n_b][i_b + 1]
-                            score_curr = max(score_curr_fwd, score_curr_bwd)
-                            new_score = scores_fwd[b][n_f][i_f - 1] + scores_bwd[b][n_b][i_b + 1] + score_curr
-                            merged.append({'hyp': new_hyp, 'score': new_score})
-
-                            logger.info('time matching')
-                            if refs_id is not None:
-                                logger.info('Ref: %s' % idx2token(refs_id[b]))
-                            logger.info('hyp (fwd): %s' % idx2token(nbest_hyps_fwd[b][n_f]))
-                            logger.info('hyp (bwd): %s' % idx2token(nbest_hyps_bwd[b][n_b]))
-                            logger.info('hyp (fwd-bwd): %s' % idx2token(new_hyp))
-                            logger.info('log prob (fwd): %.3f' % scores_fwd[b][n_f][-1])
-                            logger.info('log prob (bwd): %.3f' % scores_bwd[b][n_b][0])
-                            logger.info('log prob (fwd-bwd): %.3f' % new_score)
+                ys_bwd = np.asarray(nbest_hyps_bwd[b][n_b])
+                sc_bwd = np.asarray(scores_bwd[b][n_b])
+                l_bwd = len(aws_bwd[b][n_b]) - 1
+                if l_bwd <= 0:
+                    continue
+                i_bwd = np.arange(l_bwd)
+                t_prev = peaks_bwd[n_b][i_bwd + 1]  # `[L_bwd]`
+                t_next = peaks_bwd[n_b][i_bwd - 1]  # `[L_bwd]`
+
+                # the same token at the same time
+                matched = (t_curr[:, None] >= t_prev[None, :]) & (t_curr[:, None] <= t_next[None, :]) & \
+                    (ys_fwd[:l_fwd, None] == ys_bwd[None, :l_bwd])
+                for i_f, i_b in zip(*np.nonzero(matched)):
+                    new_hyp = ys_fwd[:i_f + 1].tolist() + ys_bwd[i_b + 1:].tolist()
+                    score_curr_fwd = sc_fwd[i_f] - sc_fwd[i_f - 1]
+                    score_curr_bwd = sc_bwd[i_b] - sc_bwd[i_b + 1]
+                    score_curr = max(score_curr_fwd, score_curr_bwd)
+                    new_score = sc_fwd[i_f - 1] + sc_bwd[i_b + 1] + score_curr
+                    merged.append({'hyp': new_hyp, 'score': new_score})
+
+                    logger.info('time matching')
+                    if refs_id is not None:
+                        logger.info('Ref: %s' % idx2token(refs_id[b]))
+                    logger.info('hyp (fwd): %s' % idx2token(nbest_hyps_fwd[b][n_f]))
+                    logger.info('hyp (bwd): %s' % idx2token(nbest_hyps_bwd[b][n_b]))
+                    logger.info('hyp (fwd-bwd): %s' % idx2token(new_hyp))
+                    logger.info('log prob (fwd): %.3f' % scores_fwd[b][n_f][-1])
+                    logger.info('log prob (bwd): %.3f' % scores_bwd[b][n_b][0])
+                    logger.info('log prob (fwd-bwd): %.3f' % new_score)
 
         merged = sorted(merged, key=lambda x: x['score'], reverse=True)
         best_hyps.append(merged[0]['hyp'])
 
     return best_hyps
+
+
+def _attention_peaks(aws):
+    """Return the frame index with the largest attention weight at each step.
+
+    Args:
+        aws (np.ndarray): `[L, T]` or `[L, T, n_heads]`
+    Returns:
+        peaks (np.ndarray): `[L]`
+
+    """
+    aws = np.asarray(aws)
+    if aws.ndim == 3:
+        aws = aws[:, :, 0]
+    return aws.argmax(-1)
@@ -29,6 +29,7 @@ from neural_sp.models.modules.multihead_attention import MultiheadAttentionMecha
 from neural_sp.models.modules.singlehead_attention import AttentionMechanism
 from neural_sp.models.seq2seq.decoders.ctc import CTC
 from neural_sp.models.seq2seq.decoders.ctc import CTCPrefixScore
+from neural_sp.models.seq2seq.decoders.ctc import CTCPrefixScoreTH
 from neural_sp.models.seq2seq.decoders.decoder_base import DecoderBase
 from neural_sp.models.seq2seq.decoders.mbr import MBR
 from neural_sp.models.torch_utils import append_sos_eos
@@ -47,6 +48,8 @@ random.seed(1)
 
 logger = logging.getLogger(__name__)
 
+NEG_INF = float(np.finfo(np.float32).min)
+
 
 class RNNDecoder(DecoderBase):
     """RNN decoder.
@@ -468,14 +471,23 @@ class RNNDecoder(DecoderBase):
 
         ys_emb = self.dropout_emb(self.embed(ys_in))
         attn_mask = make_pad_mask(elens, self.device_id)
+
+        # Run the LM over the whole sequence at once in teacher-forcing
+        teacher_forcing = self._ss_prob == 0
+        if self.lm is not None and teacher_forcing:
+            _, lmouts, _ = self.lm.decode(ys_in, None)
+
         logits = []
         for t in range(ys_in.size(1)):
             is_sample = t > 0 and self._ss_prob > 0 and random.random() < self._ss_prob
 
             # Update LM states for LM fusion
             if self.lm is not None:
-                y_lm = self.output(logits[-1]).detach().argmax(-1) if is_sample else ys_in[:, t:t + 1]
-                lmout, lmstate = self.lm.decode(y_lm, lmstate)
+                if teacher_forcing:
+                    lmout = lmouts[:, t:t + 1]
+                else:
+                    y_lm = self.output(logits[-1]).detach().argmax(-1) if is_sample else ys_in[:, t:t + 1]
+                    _, lmout, lmstate = self.lm.decode(y_lm, lmstate)
 
             # Recurrency -> Score -> Generate
             y_emb = self.dropout_emb(self.embed(
@@ -566,14 +578,23 @@ class RNNDecoder(DecoderBase):
 
         ys_emb = self.dropout_emb(self.embed(ys_in))
         attn_mask = make_pad_mask(elens, self.device_id)
+
+        # Run the LM over the whole sequence at once in teacher-forcing
+        teacher_forcing = self._ss_prob == 0
+        if self.lm is not None and teacher_forcing:
+            _, lmouts, _ = self.lm.decode(ys_in, None)
+
         logits = []
         for t in range(ys_in.size(1)):
             is_sample = t > 0 and self._ss_prob > 0 and random.random() < self._ss_prob
 
             # Update LM states for LM fusion
             if self.lm is not None:
-                y_lm = self.output(logits[-1]).detach().argmax(-1) if is_sample else ys_in[:, t:t + 1]
-                lmout, lmstate = self.lm.decode(y_lm, lmstate)
+                if teacher_forcing:
+                    lmout = lmouts[:, t:t + 1]
+                else:
+                    y_lm = self.output(logits[-1]).detach().argmax(-1) if is_sample else ys_in[:, t:t + 1]
+                    _, lmout, lmstate = self.lm.decode(y_lm, lmstate)
 
             # Recurrency -> Score -> Generate
             y_emb = self.dropout_emb(self.embed(
@@ -830,7 +851,7 @@ class RNNDecoder(DecoderBase):
                     lm=None, lm_2nd=None, lm_2nd_rev=None, ctc_log_probs=None,
                     nbest=1, exclude_eos=False,
                     refs_id=None, utt_ids=None, speakers=None,
-                    ensmbl_eouts=None, ensmbl_elens=None, ensmbl_decs=[]):
+                    ensmbl_eouts=None, ensmbl_elens=None, ensmbl_decs=[], shortlist=None):
         """Beam search decoding.
 
         Args:
@@ -844,6 +865,13 @@ class RNNDecoder(DecoderBase):
                 recog_coverage_penalty (float): coverage penalty
                 recog_coverage_threshold (float): threshold for coverage penalty
                 recog_lm_weight (float): weight of LM score
+                recog_ctc_weight (float): weight of CTC score
+                recog_ctc_window_margin (int): number of frames around attention peaks
+                    to compute CTC prefix scores
+                recog_beam_threshold (float): prune hypotheses whose score is lower
+                    than the best one by this value (0 disables)
+                recog_early_termination (bool): stop when no active hypothesis can
+                    outperform the best complete hypothesis
             idx2token (): converter from index to token
             lm: firsh path LM
             lm_2nd: second path LM
@@ -857,6 +885,8 @@ class RNNDecoder(DecoderBase):
             ensmbl_eouts (list): list of FloatTensor
             ensmbl_elens (list) list of list
             ensmbl_decs (list): list of torch.nn.Module
+            shortlist (LongTensor): `[B, K]`, tokens the output layer is restricted to
+                (see `ctc_shortlist`). <eos> must be placed at the first position.
         Returns:
             nbest_hyps_idx (list): A list of length `[B]`, which contains list of N hypotheses
             aws (list): A list of length `[B]`, which contains arrays of size `[L, T]`
@@ -870,6 +900,7 @@ class RNNDecoder(DecoderBase):
         beam_width = params['recog_beam_width']
         assert 1 <= nbest <= beam_width
         ctc_weight = params['recog_ctc_weight']
+        ctc_window_margin = params['recog_ctc_window_margin']
         max_len_ratio = params['recog_max_len_ratio']
         min_len_ratio = params['recog_min_len_ratio']
         lp_weight = params['recog_length_penalty']
@@ -877,6 +908,7 @@ class RNNDecoder(DecoderBase):
         cp_threshold = params['recog_coverage_threshold']
         length_norm = params['recog_length_norm']
         lm_weight = params['recog_lm_weight']
+        lm_normalizer_size = params['recog_lm_normalizer_size']
         lm_weight_2nd = params['recog_lm_second_weight']
         lm_weight_2nd_rev = params['recog_lm_rev_weight']
         gnmt_decoding = params['recog_gnmt_decoding']
@@ -884,6 +916,8 @@ class RNNDecoder(DecoderBase):
         asr_state_carry_over = params['recog_asr_state_carry_over']
         lm_state_carry_over = params['recog_lm_state_carry_over']
         softmax_smoothing = params['recog_softmax_smoothing']
+        beam_threshold = params['recog_beam_threshold']
+        early_termination = params['recog_early_termination'] and not oracle
 
         if lm is not None:
             assert lm_weight > 0
@@ -894,32 +928,44 @@ class RNNDecoder(DecoderBase):
         if lm_2nd_rev is not None:
             assert lm_weight_2nd_rev > 0
             lm_2nd_rev.eval()
+        self.nbest_hyps_final = [] if params['recog_nbest_export'] else None
 
-        nbest_hyps_idx, aws, scores = [], [], []
-        eos_flags = []
+        if (asr_state_carry_over or lm_state_carry_over) and speakers is not None:
+            assert bs == 1, 'State carry over is supported only when recog_batch_size == 1.'
+
+        # For joint CTC-Attention decoding
+        ctc_prefix_scorer = None
+        if ctc_log_probs is not None:
+            assert ctc_weight > 0
+            ctc_prefix_scorer = CTCPrefixScoreTH(ctc_log_probs, elens, self.blank, self.eos,
+                                                 flip=self.bwd, margin=ctc_window_margin)
+            ctc_states_init = ctc_prefix_scorer.initial_state()
+
+        # Restrict the output layer to the shortlisted tokens of each utterance
+        output_sl, ensmbl_output_sl = None, []
+        eos_pos = self.eos  # position of <eos> in the output layer
+        if shortlist is not None:
+            if shortlist.size(1) < beam_width:
+                shortlist = torch.cat([shortlist, shortlist.new_full(
+                    (bs, beam_width - shortlist.size(1)), self.pad)], dim=1)
+            output_sl = self.slice_output(shortlist)
+            ensmbl_output_sl = [dec.slice_output(shortlist) for dec in ensmbl_decs]
+            eos_pos = 0
+
+        # Initialization per utterance
+        self.score.reset()
+        for dec in ensmbl_decs:
+            dec.score.reset()
+        hyps, end_hyps, ytimes = [], [], []
         for b in range(bs):
-            # Initialization per utterance
-            self.score.reset()
             dstates = self.zero_state(1)
             lmstate = None
 
-            # For joint CTC-Attention decoding
-            if ctc_log_probs is not None:
-                assert ctc_weight > 0
-                if self.bwd:
-                    ctc_prefix_score = CTCPrefixScore(
-                        tensor2np(ctc_log_probs)[b][::-1], self.blank, self.eos)
-                else:
-                    ctc_prefix_score = CTCPrefixScore(
-                        tensor2np(ctc_log_probs)[b], self.blank, self.eos)
-
             # Ensemble initialization
             ensmbl_dstate, ensmbl_cv = [], []
-            if n_models > 1:
-                for dec in ensmbl_decs:
-                    ensmbl_dstate += [dec.zero_state(1)]
-                    ensmbl_cv += [eouts.new_zeros(1, 1, dec.enc_n_units)]
-                    dec.score.reset()
+            for dec in ensmbl_decs:
+                ensmbl_dstate += [dec.zero_state(1)]
+                ensmbl_cv += [eouts.new_zeros(1, 1, dec.enc_n_units)]
 
             if speakers is not None:
                 if speakers[b] == self.prev_spk:
@@ -929,250 +975,358 @@ class RNNDecoder(DecoderBase):
                         lmstate = self.lmstate_final
                 self.prev_spk = speakers[b]
 
-            end_hyps = []
-            hyps = [{'hyp': [self.eos],
-                     'score': 0.,
-                     'score_attn': 0.,
-                     'score_ctc': 0.,
-                     'score_lm': 0.,
-                     'dstates': dstates,
-                     'cv': eouts.new_zeros(1, 1, self.enc_n_units),
-                     'aws': [None],
-                     'lmstate': lmstate,
-                     'ensmbl_dstate': ensmbl_dstate,
-                     'ensmbl_cv': ensmbl_cv,
-                     'ensmbl_aws':[[None]] * (n_models - 1),
-                     'ctc_state': ctc_prefix_score.initial_state() if ctc_log_probs is not None else None}]
+            hyps.append([{'hyp': [self.eos],
+                          'score': 0.,
+                          'score_attn': 0.,
+                          'score_ctc': 0.,
+                          'score_lm': 0.,
+                          'dstates': dstates,
+                          'cv': eouts.new_zeros(1, 1, self.enc_n_units),
+                          'aws': [None],
+                          'lmstate': lmstate,
+                          'ensmbl_dstate': ensmbl_dstate,
+                          'ensmbl_cv': ensmbl_cv,
+                          'ensmbl_aws': [[None]] * (n_models - 1),
+                          'ctc_state': ctc_states_init[:, :, b] if ctc_log_probs is not None else None}])
+            end_hyps.append([])
             if oracle:
                 assert refs_id is not None
-                ytime = len(refs_id[b]) + 1
+                ytimes.append(len(refs_id[b]) + 1)
             else:
-                ytime = int(math.floor(elens[b] * max_len_ratio)) + 1
-            for t in range(ytime):
-                # preprocess for batch decoding
-                y = eouts.new_zeros(len(hyps), 1).long()
-                for j, beam in enumerate(hyps):
-                    if self.replace_sos and t == 0:
-                        prev_idx = refs_id[0][0]
-                    else:
-                        prev_idx = ([self.eos] + refs_id[b])[t] if oracle else beam['hyp'][-1]
-                    y[j, 0] = prev_idx
-
-                cv = torch.cat([beam['cv'] for beam in hyps], dim=0)
-                aw = torch.cat([beam['aws'][-1] for beam in hyps], dim=0) if t > 0 else None
-                hxs = torch.cat([beam['dstates']['dstate'][0] for beam in hyps], dim=1)
-                if self.rnn_type == 'lstm':
-                    cxs = torch.cat([beam['dstates']['dstate'][1] for beam in hyps], dim=1)
-                dstates = {'dstate': (hxs, cxs)}
-                if (lm is not None or self.lm is not None) and beam['lmstate'] is not None:
-                    lm_hxs = torch.cat([beam['lmstate']['hxs'] for beam in hyps], dim=1)
-                    lm_cxs = torch.cat([beam['lmstate']['cxs'] for beam in hyps], dim=1)
-                    lmstate = {'hxs': lm_hxs, 'cxs': lm_cxs}
+                ytimes.append(int(math.floor(elens[b] * max_len_ratio)) + 1)
+
+        active_utts = list(range(bs))
+        active_utts_prev = None
+        n_hyps_total, n_steps_total = 0, 0
+        for t in range(max(ytimes)):
+            # Flatten hypotheses of all active utterances into a single batch.
+            # Each utterance is padded to the same number of rows with copies of its
+            # first hypothesis so that the encoder-side attention features are
+            # broadcast over the hypotheses of each utterance.
+            n_act = len(active_utts)
+            n_hyps_total += sum([len(hyps[b]) for b in active_utts])
+            n_steps_total += n_act
+            n_rows = max([len(hyps[b]) for b in active_utts])
+            beams = []
+            for b in active_utts:
+                beams += hyps[b] + [hyps[b][0]] * (n_rows - len(hyps[b]))
+            utt_of_rows = [b for b in active_utts for _ in range(n_rows)]
+            elens_act = elens[active_utts]
+            eouts_act = eouts[active_utts, :max(elens_act)]
+            mask = make_pad_mask(elens_act, self.device_id)
+            # The key projection is recomputed only when some utterances finish
+            cache = active_utts == active_utts_prev
+            active_utts_prev = active_utts[:]
+
+            # preprocess for batch decoding
+            y = eouts.new_zeros(len(beams), 1).long()
+            for j, beam in enumerate(beams):
+                b = utt_of_rows[j]
+                if self.replace_sos and t == 0:
+                    prev_idx = refs_id[b][0]
                 else:
-                    lmstate = None
-
-                lmout, scores_lm = None, None
-                if self.lm is not None:
-                    # Update LM states for LM fusion
-                    lmout, lmstate, scores_lm = self.lm.predict(y, lmstate)
-                elif lm is not None:
-                    # Update LM states for shallow fusion
-                    lmout, lmstate, scores_lm = lm.predict(y, lmstate)
-
-                # for the main model
-                dstates, cv, aw, attn_v = self.decode_step(
-                    eouts[b:b + 1, :elens[b]].repeat([cv.size(0), 1, 1]),
-                    dstates, cv, self.dropout_emb(self.embed(y)), None, aw, lmout)
-                probs = torch.softmax(self.output(attn_v).squeeze(1) * softmax_smoothing, dim=1)
-
-                # for the ensemble
-                ensmbl_dstate, ensmbl_cv, ensmbl_aws = [], [], []
-                if n_models > 1:
-                    for i_e, dec in enumerate(ensmbl_decs):
-                        cv_e = torch.cat([beam['ensmbl_cv'][i_e] for beam in hyps], dim=0)
-                        aw_e = torch.cat([beam['ensmbl_aws'][i_e][-1] for beam in hyps], dim=0) if t > 0 else None
-                        hxs_e = torch.cat([beam['ensmbl_dstate'][i_e]['dstate'][0] for beam in hyps], dim=1)
-                        if self.rnn_type == 'lstm':
-                            cxs_e = torch.cat([beam['dstates'][i_e]['dstate'][1] for beam in hyps], dim=1)
-                        dstates_e = {'dstate': (hxs_e, cxs_e)}
-
-                        dstate_e, cv_e, aw_e, attn_v_e = dec.decode_step(
-                            ensmbl_eouts[i_e][b:b + 1, :ensmbl_elens[i_e][b]].repeat([cv_e.size(0), 1, 1]),
-                            dstates_e, cv_e, dec.dropout_emb(dec.embed(y)), None, aw_e, lmout)
-
-                        ensmbl_dstate += [{'dstate': (beam['dstates'][i_e]['dstate'][0][:, j:j + 1],
-                                                      beam['dstates'][i_e]['dstate'][1][:, j:j + 1])}]
-                        ensmbl_cv += [cv_e[j:j + 1]]
-                        ensmbl_aws += [beam['ensmbl_aws'][i_e] + [aw_e[j:j + 1]]]
-                        probs += torch.softmax(dec.output(attn_v_e).squeeze(1), dim=1)
-                        # NOTE: sum in the probability scale (not log-scale)
-
-                # Ensemble in log-scale
-                scores_attn = torch.log(probs) / n_models
+                    prev_idx = ([self.eos] + refs_id[b])[t] if oracle else beam['hyp'][-1]
+                y[j, 0] = prev_idx
 
-                new_hyps = []
-                for j, beam in enumerate(hyps):
-                    # Attention scores
-                    total_scores_attn = beam['score_attn'] + scores_attn[j:j + 1]
-                    total_scores = total_scores_attn * (1 - ctc_weight)
+            cv = torch.cat([beam['cv'] for beam in beams], dim=0)
+            aw = self._pad_aws([beam['aws'][-1] for beam in beams], eouts_act.size(1)) if t > 0 else None
+            hxs = torch.cat([beam['dstates']['dstate'][0] for beam in beams], dim=1)
+            cxs = None
+            if self.rnn_type == 'lstm':
+                cxs = torch.cat([beam['dstates']['dstate'][1] for beam in beams], dim=1)
+            dstates = {'dstate': (hxs, cxs)}
+            if (lm is not None or self.lm is not None) and beams[0]['lmstate'] is not None:
+                lm_hxs = torch.cat([beam['lmstate']['hxs'] for beam in beams], dim=1)
+                lm_cxs = torch.cat([beam['lmstate']['cxs'] for beam in beams], dim=1)
+                lmstate = {'hxs': lm_hxs, 'cxs': lm_cxs}
+            else:
+                lmstate = None
 
-                    # Add LM score <after> top-K selection
-                    total_scores_topk, topk_ids = torch.topk(
-                        total_scores, k=beam_width, dim=1, largest=True, sorted=True)
-                    if lm is not None:
-                        total_scores_lm = beam['score_lm'] + scores_lm[j, -1, topk_ids[0]]
-                        total_scores_topk += total_scores_lm * lm_weight
-                    else:
-                        total_scores_lm = eouts.new_zeros(beam_width)
+            lmout, scores_lm = None, None
+            if self.lm is not None:
+                # Update LM states for LM fusion
+                lmout, lmstate, scores_lm = self.lm.predict(y, lmstate)
+            # NOTE: LM states for shallow fusion are updated after top-K selection
 
-                    # Add length penalty
-                    if lp_weight > 0:
-                        if gnmt_decoding:
-                            lp = math.pow(6 + len(beam['hyp'][1:]), lp_weight) / math.pow(6, lp_weight)
-                            total_scores_topk /= lp
-                        else:
-                            total_scores_topk += (len(beam['hyp'][1:]) + 1) * lp_weight
-
-                    # Add coverage penalty
-                    if cp_weight > 0:
-                        aw_mat = torch.stack(beam['aws'][1:] + [aw], dim=-1)  # `[B, T, L, n_heads]`
-                        aw_mat = aw_mat[:, :, :, 0]
-                        if gnmt_decoding:
-                            aw_mat = torch.log(aw_mat.sum(-1))
-                            cp = torch.where(aw_mat < 0, aw_mat, aw_mat.new_zeros(aw_mat.size())).sum()
-                            # TODO(hirofumi): mask by elens[b]
-                            total_scores_topk += cp * cp_weight
-                        else:
-                            # Recompute converage penalty at each step
-                            if cp_threshold == 0:
-                                cp = aw_mat.sum() / self.score.n_heads
-                            else:
-                                cp = torch.where(aw_mat > cp_threshold, aw_mat,
-                                                 aw_mat.new_zeros(aw_mat.size())).sum() / self.score.n_heads
-                            total_scores_topk += cp * cp_weight
-                    else:
-                        cp = 0.
+            # for the main model
+            dstates, cv, aw, attn_v = self.decode_step(
+                eouts_act, dstates, cv, self.dropout_emb(self.embed(y)), mask, aw, lmout, cache=cache)
+            if shortlist is None:
+                logits = self.output(attn_v).squeeze(1)
+            else:
+                logits = self.shortlist_logits(attn_v.squeeze(1), output_sl, active_utts)
+            probs = torch.softmax(logits * softmax_smoothing, dim=1)
+
+            # for the ensemble
+            ensmbl_dstates, ensmbl_cvs, ensmbl_aws = [], [], []
+            for i_e, dec in enumerate(ensmbl_decs):
+                elens_act_e = ensmbl_elens[i_e][active_utts]
+                eouts_act_e = ensmbl_eouts[i_e][active_utts, :max(elens_act_e)]
+                cv_e = torch.cat([beam['ensmbl_cv'][i_e] for beam in beams], dim=0)
+                aw_e = dec._pad_aws([beam['ensmbl_aws'][i_e][-1] for beam in beams],
+                                    eouts_act_e.size(1)) if t > 0 else None
+                hxs_e = torch.cat([beam['ensmbl_dstate'][i_e]['dstate'][0] for beam in beams], dim=1)
+                cxs_e = None
+                if dec.rnn_type == 'lstm':
+                    cxs_e = torch.cat([beam['ensmbl_dstate'][i_e]['dstate'][1] for beam in beams], dim=1)
+                dstates_e = {'dstate': (hxs_e, cxs_e)}
+
+                dstates_e, cv_e, aw_e, attn_v_e = dec.decode_step(
+                    eouts_act_e, dstates_e, cv_e, dec.dropout_emb(dec.embed(y)),
+                    make_pad_mask(elens_act_e, self.device_id), aw_e, lmout, cache=cache)
+
+                ensmbl_dstates += [dstates_e]
+                ensmbl_cvs += [cv_e]
+                ensmbl_aws += [aw_e]
+                if shortlist is None:
+                    logits_e = dec.output(attn_v_e).squeeze(1)
+                else:
+                    logits_e = dec.shortlist_logits(attn_v_e.squeeze(1), ensmbl_output_sl[i_e], active_utts)
+                probs += torch.softmax(logits_e, dim=1)
+                # NOTE: sum in the probability scale (not log-scale)
+
+            # Ensemble in log-scale
+            scores_attn = torch.log(probs) / n_models
+
+            # Score all candidates of all hypotheses at once
+            n_hyps = len(beams)
+            is_valid = eouts.new_tensor([j % n_rows < len(hyps[b]) for j, b in enumerate(utt_of_rows)]).bool()
+            hyp_lens = eouts.new_tensor([len(beam['hyp']) - 1 for beam in beams])
+
+            # Attention scores
+            total_scores_attn = eouts.new_tensor([beam['score_attn'] for beam in beams]).unsqueeze(1) + scores_attn
+            total_scores = total_scores_attn * (1 - ctc_weight)
+
+            # Add LM score <after> top-K selection
+            total_scores_topk, topk_pos = torch.topk(
+                total_scores, k=beam_width, dim=1, largest=True, sorted=True)
+            # positions in the output layer -> token IDs
+            topk_ids = topk_pos if shortlist is None else shortlist[utt_of_rows].gather(1, topk_pos)
+            if lm is not None:
+                if scores_lm is None:
+                    # Score only the top-K candidates of each hypothesis
+                    _, lmstate, scores_lm_topk = lm.predict_candidates(y, lmstate, topk_ids, lm_normalizer_size)
+                else:
+                    scores_lm_topk = scores_lm[:, -1].gather(1, topk_ids)
+                total_scores_lm = eouts.new_tensor([beam['score_lm'] for beam in beams]).unsqueeze(1) + \
+                    scores_lm_topk
+                total_scores_topk += total_scores_lm * lm_weight
+            else:
+                total_scores_lm = eouts.new_zeros(n_hyps, beam_width)
 
-                    # CTC score
-                    if ctc_log_probs is not None:
-                        ctc_scores, ctc_states = ctc_prefix_score(
-                            beam['hyp'], tensor2np(topk_ids[0]), beam['ctc_state'])
-                        total_scores_ctc = torch.from_numpy(ctc_scores)
-                        if self.device_id >= 0:
-                            total_scores_ctc = total_scores_ctc.cuda(self.device_id)
-                        total_scores_topk += total_scores_ctc * ctc_weight
-                        # Sort again
-                        total_scores_topk, joint_ids_topk = torch.topk(
-                            total_scores_topk, k=beam_width, dim=1, largest=True, sorted=True)
-                        topk_ids = topk_ids[:, joint_ids_topk[0]]
+            # Add length penalty
+            if lp_weight > 0:
+                if gnmt_decoding:
+                    lp = torch.pow(6 + hyp_lens, lp_weight) / math.pow(6, lp_weight)
+                    total_scores_topk /= lp.unsqueeze(1)
+                else:
+                    total_scores_topk += (hyp_lens.unsqueeze(1) + 1) * lp_weight
+
+            # Add coverage penalty
+            cp = eouts.new_zeros(n_hyps)
+            if cp_weight > 0:
+                for j, beam in enumerate(beams):
+                    aws_j = beam['aws'][1:] + [self._crop_aw(aw[j:j + 1], elens[utt_of_rows[j]])]
+                    # average over heads
+                    aw_mat = torch.stack([self._frame_aw(aw_l) for aw_l in aws_j],
+                                         dim=2) / self.score.n_heads  # `[1, T, L]`
+                    if gnmt_decoding:
+                        aw_mat = torch.log(aw_mat.sum(-1))
+                        cp[j] = torch.where(aw_mat < 0, aw_mat, aw_mat.new_zeros(aw_mat.size())).sum()
                     else:
-                        total_scores_ctc = eouts.new_zeros(beam_width)
-
-                    for k in range(beam_width):
-                        idx = topk_ids[0, k].item()
-                        length_norm_factor = 1.
-                        if length_norm:
-                            length_norm_factor = len(beam['hyp'][1:]) + 1
-                        total_score = total_scores_topk[0, k].item() / length_norm_factor
-
-                        if idx == self.eos:
-                            # Exclude short hypotheses
-                            if len(beam['hyp']) - 1 < elens[b] * min_len_ratio:
-                                continue
-                            # EOS threshold
-                            max_score_no_eos = scores_attn[j, :idx].max(0)[0].item()
-                            max_score_no_eos = max(max_score_no_eos, scores_attn[j, idx + 1:].max(0)[0].item())
-                            if scores_attn[j, idx].item() <= eos_threshold * max_score_no_eos:
-                                continue
+                        # Recompute converage penalty at each step
+                        if cp_threshold == 0:
+                            cp[j] = aw_mat.sum()
+                        else:
+                            cp[j] = torch.where(aw_mat > cp_threshold, aw_mat,
+                                                aw_mat.new_zeros(aw_mat.size())).sum()
+                total_scores_topk += cp.unsqueeze(1) * cp_weight
 
-                        new_hyps.append(
-                            {'hyp': beam['hyp'] + [idx],
-                             'score': total_score,
-                             'score_attn': total_scores_attn[0, idx].item(),
-                             'score_cp': cp,
-                             'score_ctc': total_scores_ctc[k].item(),
-                             'score_lm': total_scores_lm[k].item(),
-                             'dstates': {'dstate': (dstates['dstate'][0][:, j:j + 1], dstates['dstate'][1][:, j:j + 1])},
-                             'cv': cv[j:j + 1],
-                             'aws': beam['aws'] + [aw[j:j + 1]],
-                             'lmstate': {'hxs': lmstate['hxs'][:, j:j + 1], 'cxs': lmstate['cxs'][:, j:j + 1]} if lmstate is not None else None,
-                             'ctc_state': ctc_states[joint_ids_topk[0, k]] if ctc_log_probs is not None else None,
-                             'ensmbl_dstate': ensmbl_dstate,
-                             'ensmbl_cv': ensmbl_cv,
-                             'ensmbl_aws': ensmbl_aws})
+            # CTC score
+            if ctc_log_probs is not None:
+                total_scores_ctc, ctc_states = ctc_prefix_scorer(
+                    [beam['hyp'] for beam in beams], topk_ids,
+                    torch.stack([beam['ctc_state'] for beam in beams], dim=2),
+                    topk_ids.new_tensor(utt_of_rows), aw=self._frame_aw(aw))
+                total_scores_topk += total_scores_ctc * ctc_weight
+                # Sort again
+                total_scores_topk, joint_ids_topk = torch.topk(
+                    total_scores_topk, k=beam_width, dim=1, largest=True, sorted=True)
+                topk_ids = topk_ids.gather(1, joint_ids_topk)
+                topk_pos = topk_pos.gather(1, joint_ids_topk)
+                total_scores_lm = total_scores_lm.gather(1, joint_ids_topk)
+                total_scores_ctc = total_scores_ctc.gather(1, joint_ids_topk)
+            else:
+                total_scores_ctc = eouts.new_zeros(n_hyps, beam_width)
+
+            if length_norm:
+                total_scores_topk /= (hyp_lens.unsqueeze(1) + 1)
+
+            # Exclude short hypotheses and <eos> below the EOS threshold
+            eos_ok = hyp_lens >= elens_act.float().repeat_interleave(n_rows).to(hyp_lens.device) * min_len_ratio
+            max_scores_no_eos = scores_attn.index_fill(1, topk_ids.new_tensor([eos_pos]), NEG_INF).max(1)[0]
+            eos_ok &= scores_attn[:, eos_pos] > eos_threshold * max_scores_no_eos
+            is_valid = is_valid.unsqueeze(1) & ((topk_ids != self.eos) | eos_ok.unsqueeze(1))
+            if shortlist is not None:
+                is_valid &= topk_ids != self.pad
+            total_scores_topk = total_scores_topk.masked_fill(~is_valid, NEG_INF)
+
+            # Local pruning over candidates of each utterance
+            total_scores_topk, ids_utt = torch.topk(
+                total_scores_topk.view(n_act, n_rows * beam_width), k=beam_width, dim=1, largest=True, sorted=True)
+            ids_utt_all = ids_utt + torch.arange(n_act, device=ids_utt.device).unsqueeze(1) * n_rows * beam_width
+            total_scores_attn = total_scores_attn.gather(1, topk_pos)
+            # Copy only the selected candidates to the host at once
+            sel_scores = tensor2np(torch.stack([
+                total_scores_topk,
+                total_scores_attn.view(-1)[ids_utt_all],
+                total_scores_ctc.view(-1)[ids_utt_all],
+                total_scores_lm.view(-1)[ids_utt_all],
+                cp[ids_utt_all // beam_width]], dim=0))
+            sel_ids = tensor2np(torch.stack([
+                ids_utt_all // beam_width,
+                topk_ids.view(-1)[ids_utt_all],
+                is_valid.view(-1)[ids_utt_all].long()], dim=0))
+            if ctc_log_probs is not None:
+                ctc_states = ctc_states[:, :, ids_utt_all // beam_width,
+                                        joint_ids_topk.view(-1)[ids_utt_all]]  # `[T, 2, n_act, beam_width]`
 
-                # Local pruning
-                new_hyps_sorted = sorted(new_hyps, key=lambda x: x['score'], reverse=True)[:beam_width]
+            for i_b, b in enumerate(active_utts):
+                new_hyps_sorted = []
+                for k in range(beam_width):
+                    j, idx, valid = [int(v) for v in sel_ids[:, i_b, k]]
+                    if not valid:
+                        continue
+                    beam = beams[j]
+                    new_hyps_sorted.append(
+                        {'hyp': beam['hyp'] + [idx],
+                         'score': float(sel_scores[0, i_b, k]),
+                         'score_attn': float(sel_scores[1, i_b, k]),
+                         'score_cp': float(sel_scores[4, i_b, k]),
+                         'score_ctc': float(sel_scores[2, i_b, k]),
+                         'score_lm': float(sel_scores[3, i_b, k]),
+                         'dstates': {'dstate': (dstates['dstate'][0][:, j:j + 1],
+                                                dstates['dstate'][1][:, j:j + 1] if cxs is not None else None)},
+                         'cv': cv[j:j + 1],
+                         'aws': beam['aws'] + [self._crop_aw(aw[j:j + 1], elens[b])],
+                         'lmstate': {'hxs': lmstate['hxs'][:, j:j + 1], 'cxs': lmstate['cxs'][:, j:j + 1]} if lmstate is not None else None,
+                         'ctc_state': ctc_states[:, :, i_b, k] if ctc_log_probs is not None else None,
+                         'ensmbl_dstate': [{'dstate': (ds['dstate'][0][:, j:j + 1],
+                                                       ds['dstate'][1][:, j:j + 1] if ds['dstate'][1] is not None else None)}
+                                           for ds in ensmbl_dstates],
+                         'ensmbl_cv': [cv_e[j:j + 1] for cv_e in ensmbl_cvs],
+                         'ensmbl_aws': [beam['ensmbl_aws'][i_e] + [self._crop_aw(aw_e[j:j + 1], ensmbl_elens[i_e][b])]
+                                        for i_e, aw_e in enumerate(ensmbl_aws)]})
 
                 # Remove complete hypotheses
                 new_hyps = []
                 for hyp in new_hyps_sorted:
                     if oracle:
                         if t == len(refs_id[b]):
-                            end_hyps += [hyp]
+                            end_hyps[b] += [hyp]
                         else:
                             new_hyps += [hyp]
                     else:
                         if len(hyp['hyp']) > 1 and hyp['hyp'][-1] == self.eos:
-                            end_hyps += [hyp]
+                            end_hyps[b] += [hyp]
                         else:
                             new_hyps += [hyp]
-                if len(end_hyps) >= beam_width:
-                    end_hyps = end_hyps[:beam_width]
-                    break
-                hyps = new_hyps[:]
 
+                # Score-threshold pruning relative to the best candidate
+                if beam_threshold > 0 and not oracle and len(new_hyps_sorted) > 0:
+                    new_hyps = [hyp for hyp in new_hyps
+                                if hyp['score'] >= new_hyps_sorted[0]['score'] - beam_threshold]
+
+                # Stop when no active hypothesis can outperform the best complete hypothesis
+                if early_termination and len(end_hyps[b]) > 0 and len(new_hyps) > 0:
+                    best_end_score = max([hyp['score'] for hyp in end_hyps[b]])
+                    if all(self.score_upper_bound(hyp, ytimes[b] - 1 - t, lp_weight, cp_weight, ctc_weight, lm_weight,
+                                                  length_norm, gnmt_decoding) <= best_end_score for hyp in new_hyps):
+                        new_hyps = []
+
+                if len(end_hyps[b]) >= beam_width:
+                    end_hyps[b] = end_hyps[b][:beam_width]
+                else:
+                    hyps[b] = new_hyps[:]
+
+            # Per-utterance end detection
+            active_utts = [b for b in active_utts
+                           if len(end_hyps[b]) < beam_width and len(hyps[b]) > 0 and t < ytimes[b] - 1]
+            if len(active_utts) == 0:
+                break
+
+        logger.info('Average number of active hypotheses per step: %.2f' %
+                    (n_hyps_total / max(n_steps_total, 1)))
+
+        nbest_hyps_idx, aws, scores = [], [], []
+        eos_flags = []
+        for b in range(bs):
             # Global pruning
-            if len(end_hyps) == 0:
-                end_hyps = hyps[:]
-            elif len(end_hyps) < nbest and nbest > 1:
-                end_hyps.extend(hyps[:nbest - len(end_hyps)])
+            if len(end_hyps[b]) == 0:
+                end_hyps[b] = hyps[b][:]
+            elif len(end_hyps[b]) < nbest and nbest > 1:
+                end_hyps[b].extend(hyps[b][:nbest - len(end_hyps[b])])
 
-            # forward second path LM rescoring
-            if lm_2nd is not None:
-                self.lm_rescoring(end_hyps, lm_2nd, lm_weight_2nd, tag='2nd')
+        # N-best lists of all utterances are rescored in a single batch per LM
+        # forward second path LM rescoring
+        if lm_2nd is not None:
+            self.lm_rescoring([hyp for b in range(bs) for hyp in end_hyps[b]],
+                              lm_2nd, lm_weight_2nd, tag='2nd')
 
-            # backward secodn path LM rescoring
-            if lm_2nd_rev is not None:
-                self.lm_rescoring(end_hyps, lm_2nd_rev, lm_weight_2nd_rev, tag='2nd_rev')
+        # backward secodn path LM rescoring
+        if lm_2nd_rev is not None:
+            self.lm_rescoring([hyp for b in range(bs) for hyp in end_hyps[b]],
+                              lm_2nd_rev, lm_weight_2nd_rev, reverse=True, tag='2nd_rev')
 
+        for b in range(bs):
             # Sort by score
-            end_hyps = sorted(end_hyps, key=lambda x: x['score'], reverse=True)
+            end_hyps[b] = sorted(end_hyps[b], key=lambda x: x['score'], reverse=True)
+            end_hyps_b = end_hyps[b]
+
+            if self.nbest_hyps_final is not None:
+                self.store_nbest([{'hyp': hyp['hyp'][1:][::-1] if self.bwd else hyp['hyp'][1:],
+                                   'score': hyp['score'],
+                                   'score_attn': hyp['score_attn'],
+                                   'score_ctc': hyp['score_ctc'],
+                                   'score_lm': hyp['score_lm'],
+                                   'score_lp': 0. if gnmt_decoding else (len(hyp['hyp']) - 1) * lp_weight,
+                                   'score_cp': hyp['score_cp']}
+                                  for hyp in end_hyps_b])
 
             if utt_ids is not None:
                 logger.info('Utt-id: %s' % utt_ids[b])
             if refs_id is not None and idx2token is not None and self.vocab == idx2token.vocab:
                 logger.info('Ref: %s' % idx2token(refs_id[b]))
             if idx2token is not None:
-                for k in range(len(end_hyps)):
+                for k in range(len(end_hyps_b)):
                     logger.info('Hyp: %s' % idx2token(
-                        end_hyps[k]['hyp'][1:][::-1] if self.bwd else end_hyps[k]['hyp'][1:]))
-                    logger.info('log prob (hyp): %.7f' % end_hyps[k]['score'])
-                    logger.info('log prob (hyp, att): %.7f' % (end_hyps[k]['score_attn'] * (1 - ctc_weight)))
-                    logger.info('log prob (hyp, cp): %.7f' % (end_hyps[k]['score_cp'] * cp_weight))
+                        end_hyps_b[k]['hyp'][1:][::-1] if self.bwd else end_hyps_b[k]['hyp'][1:]))
+                    logger.info('log prob (hyp): %.7f' % end_hyps_b[k]['score'])
+                    logger.info('log prob (hyp, att): %.7f' % (end_hyps_b[k]['score_attn'] * (1 - ctc_weight)))
+                    logger.info('log prob (hyp, cp): %.7f' % (end_hyps_b[k]['score_cp'] * cp_weight))
                     if ctc_log_probs is not None:
-                        logger.info('log prob (hyp, ctc): %.7f' % (end_hyps[k]['score_ctc'] * ctc_weight))
+                        logger.info('log prob (hyp, ctc): %.7f' % (end_hyps_b[k]['score_ctc'] * ctc_weight))
                     if lm is not None:
-                        logger.info('log prob (hyp, first-path lm): %.7f' % (end_hyps[k]['score_lm'] * lm_weight))
+                        logger.info('log prob (hyp, first-path lm): %.7f' % (end_hyps_b[k]['score_lm'] * lm_weight))
                     if lm_2nd is not None:
                         logger.info('log prob (hyp, second-path lm): %.7f' %
-                                    (end_hyps[k]['score_lm_2nd'] * lm_weight))
+                                    (end_hyps_b[k]['score_lm_2nd'] * lm_weight))
                     if lm_2nd_rev is not None:
                         logger.info('log prob (hyp, second-path lm, reverse): %.7f' %
-                                    (end_hyps[k]['score_lm_2nd_rev'] * lm_weight))
+                                    (end_hyps_b[k]['score_lm_2nd_rev'] * lm_weight))
 
             # N-best list
             if self.bwd:
                 # Reverse the order
-                nbest_hyps_idx += [[np.array(end_hyps[n]['hyp'][1:][::-1]) for n in range(nbest)]]
-                aws += [tensor2np(torch.stack(end_hyps[0]['aws'][1:][::-1], dim=1).squeeze(0))]
+                nbest_hyps_idx += [[np.array(end_hyps_b[n]['hyp'][1:][::-1]) for n in range(nbest)]]
+                aws += [tensor2np(torch.stack(end_hyps_b[0]['aws'][1:][::-1], dim=1).squeeze(0))]
             else:
-                nbest_hyps_idx += [[np.array(end_hyps[n]['hyp'][1:]) for n in range(nbest)]]
-                aws += [tensor2np(torch.stack(end_hyps[0]['aws'][1:], dim=1).squeeze(0))]
-            scores += [[end_hyps[n]['score_attn'] for n in range(nbest)]]
+                nbest_hyps_idx += [[np.array(end_hyps_b[n]['hyp'][1:]) for n in range(nbest)]]
+                aws += [tensor2np(torch.stack(end_hyps_b[0]['aws'][1:], dim=1).squeeze(0))]
+            scores += [[end_hyps_b[n]['score_attn'] for n in range(nbest)]]
 
             # Check <eos>
-            eos_flags.append([(end_hyps[n]['hyp'][-1] == self.eos) for n in range(nbest)])
+            eos_flags.append([(end_hyps_b[n]['hyp'][-1] == self.eos) for n in range(nbest)])
 
         # Exclude <eos> (<sos> in case of the backward decoder)
         if exclude_eos:
@@ -1184,11 +1338,58 @@ class RNNDecoder(DecoderBase):
                                    else nbest_hyps_idx[b][n] for n in range(nbest)] for b in range(bs)]
 
         # Store ASR/LM state
-        self.dstates_final = end_hyps[0]['dstates']
-        self.lmstate_final = end_hyps[0]['lmstate']
+        self.dstates_final = end_hyps[-1][0]['dstates']
+        self.lmstate_final = end_hyps[-1][0]['lmstate']
 
         return nbest_hyps_idx, aws, scores
 
+    @staticmethod
+    def _key_dim(aw):
+        """Dimension of encoder frames in attention weights.
+
+        Single-head attention returns `[B, klen, 1]` (also MoChA and GMM attention),
+        and multi-head attention returns `[B, n_heads, qlen, klen]`.
+
+        """
+        return 3 if aw.dim() == 4 else 1
+
+    @classmethod
+    def _frame_aw(cls, aw):
+        """Attention weights of a single query summed over heads.
+
+        Args:
+            aw (FloatTensor): `[B, klen, 1]` or `[B, n_heads, 1, klen]`
+        Returns:
+            aw (FloatTensor): `[B, klen]`
+
+        """
+        if cls._key_dim(aw) == 3:
+            return aw.sum(1).squeeze(1)
+        return aw.sum(2)
+
+    def _crop_aw(self, aw, xlen):
+        """Crop attention weights to the length of encoder outputs."""
+        return aw.narrow(self._key_dim(aw), 0, xlen)
+
+    def _pad_aws(self, aws, xmax):
+        """Pad attention weights of hypotheses to the same length.
+
+        Args:
+            aws (list): A list of length `[n_hyps]`, which contains FloatTensor of size
+                `[1, T, n_heads]` or `[1, n_heads, 1, T]`
+            xmax (int): maximum length of encoder outputs
+        Returns:
+            aw (FloatTensor): `[n_hyps, xmax, n_heads]` or `[n_hyps, n_heads, 1, xmax]`
+
+        """
+        dim = self._key_dim(aws[0])
+        size = list(aws[0].size())
+        size[0], size[dim] = len(aws), xmax
+        aw = aws[0].new_zeros(size)
+        for j, aw_j in enumerate(aws):
+            aw[j:j + 1].narrow(dim, 0, aw_j.size(dim)).copy_(aw_j)
+        return aw
+
     def beam_search_chunk_sync(self, eouts_chunk, params, idx2token,
                                lm=None, lm_2nd=None, ctc_log_probs=None,
                                hyps_segment=False, state_carry_over=False,):
@@ -1200,6 +1401,7 @@ class RNNDecoder(DecoderBase):
         max_len_ratio = params['recog_max_len_ratio']
         lp_weight = params['recog_length_penalty']
         lm_weight = params['recog_lm_weight']
+        lm_normalizer_size = params['recog_lm_normalizer_size']
         lm_weight_2nd = params['recog_lm_second_weight']
         eos_threshold = params['recog_eos_threshold']
 
@@ -1245,7 +1447,6 @@ class RNNDecoder(DecoderBase):
                              'no_trigger': False}]
 
         ytime = int(math.floor(eouts_chunk.size(1) * max_len_ratio)) + 1
-        n_hyps_prev = 1
         n_forced_eos = 0
         for t in range(ytime):
             # finish if additional triggered points are not found in all candidates
@@ -1274,16 +1475,24 @@ class RNNDecoder(DecoderBase):
             if self.lm is not None:
                 # Update LM states for LM fusion
                 lmout, lmstate, scores_lm = self.lm.predict(y, lmstate)
-            elif lm is not None:
-                # Update LM states for shallow fusion
-                lmout, lmstate, scores_lm = lm.predict(y, lmstate)
+                if lm is not None:
+                    scores_lm = scores_lm[:, -1]
 
             dstates, cv, aw, attn_v = self.decode_step(
-                eouts_chunk[0:1].repeat([cv.size(0), 1, 1]),
-                dstates, cv, self.dropout_emb(self.embed(y)), None, aw, lmout,
-                cache=cv.size(0) == n_hyps_prev)
+                eouts_chunk[0:1], dstates, cv, self.dropout_emb(self.embed(y)), None, aw, lmout)
             scores_attn = torch.log_softmax(self.output(attn_v).squeeze(1), dim=1)
-            n_hyps_prev = cv.size(0)
+
+            # Top-K selection for all hypotheses at once
+            total_scores = (eouts_chunk.new_tensor([beam['score_attn'] for beam in hyps_segment]).unsqueeze(1) +
+                            scores_attn) * (1 - ctc_weight)
+            total_scores_topk_all, topk_ids_all = torch.topk(
+                total_scores, k=beam_width, dim=1, largest=True, sorted=True)
+            if lm is not None:
+                if scores_lm is None:
+                    # Update LM states for shallow fusion and score only the top-K candidates
+                    _, lmstate, scores_lm = lm.predict_candidates(y, lmstate, topk_ids_all, lm_normalizer_size)
+                else:
+                    scores_lm = scores_lm.gather(1, topk_ids_all)
 
             new_hyps = []
             for j, beam in enumerate(hyps_segment):
@@ -1296,13 +1505,12 @@ class RNNDecoder(DecoderBase):
 
                 # Attention scores
                 total_scores_attn = beam['score_attn'] + scores_attn[j:j + 1]
-                total_scores = total_scores_attn * (1 - ctc_weight)
 
                 # Add LM score <after> top-K selection
-                total_scores_topk, topk_ids = torch.topk(
-                    total_scores, k=beam_width, dim=1, largest=True, sorted=True)
+                total_scores_topk = total_scores_topk_all[j:j + 1].clone()
+                topk_ids = topk_ids_all[j:j + 1]
                 if lm is not None:
-                    total_scores_lm = beam['score_lm'] + scores_lm[j, -1, topk_ids[0]]
+                    total_scores_lm = beam['score_lm'] + scores_lm[j]
                     total_scores_topk += total_scores_lm * lm_weight
                 else:
                     total_scores_lm = eouts_chunk.new_zeros(beam_width)
@@ -1396,3 +1604,254 @@ class RNNDecoder(DecoderBase):
         self.n_frames += eouts_chunk.size(1)
 
         return end_hyps, hyps_segment
+
+    def beam_search_chunk_sync_streams(self, eouts, elens, params, idx2token, streams,
+                                       lm=None, lm_2nd=None, ctc_log_probs=None, ctc_lens=None):
+        """Chunk-synchronous beam search over chunks of multiple streams in a batch.
+
+        This is equivalent to calling `beam_search_chunk_sync` for each stream,
+        but decoder steps of all streams are batched and the streaming state is
+        kept in `streams` instead of the decoder.
+
+        Args:
+            eouts (FloatTensor): `[S, T, enc_units]`, current chunks of streams
+            elens (IntTensor): `[S]`
+            params (dict): hyper-parameters for decoding
+            idx2token (): converter from index to token
+            streams (list): A list of length `[S]`, which contains dicts of
+                hyps (list): active hypotheses in the current segment (None for a new segment)
+                ctc_prefix_score (CTCPrefixScore): CTC prefix scorer of the current segment
+                n_frames (int): number of frames decoded in the current segment
+            lm: firsh path LM
+            lm_2nd: second path LM
+            ctc_log_probs (FloatTensor): `[S, T, vocab]`
+            ctc_lens (IntTensor): `[S]`, lengths of `ctc_log_probs` (`elens` if None).
+                CTC posteriors of the whole chunks are registered even if `eouts`
+                are truncated at a segment boundary
+        Returns:
+            results (list): A list of length `[S]`, which contains tuples of (end_hyps, hyps).
+                `streams` are updated in-place.
+
+        """
+        assert self.attn_type == 'mocha'
+        bs = eouts.size(0)
+        xlens = elens.tolist()
+
+        beam_width = params['recog_beam_width']
+        ctc_weight = params['recog_ctc_weight']
+        max_len_ratio = params['recog_max_len_ratio']
+        lp_weight = params['recog_length_penalty']
+        lm_weight = params['recog_lm_weight']
+        lm_normalizer_size = params['recog_lm_normalizer_size']
+        lm_weight_2nd = params['recog_lm_second_weight']
+        eos_threshold = params['recog_eos_threshold']
+
+        if lm is not None:
+            assert lm_weight > 0
+            lm.eval()
+        if lm_2nd is not None:
+            assert lm_weight_2nd > 0
+            lm_2nd.eval()
+        if ctc_log_probs is not None:
+            assert ctc_weight > 0
+            ctc_log_probs = tensor2np(ctc_log_probs)
+            ctc_xlens = ctc_lens.tolist() if ctc_lens is not None else xlens
+
+        self.score.reset()
+        hyps, end_hyps, ytimes = [], [], []
+        for b in range(bs):
+            if ctc_log_probs is not None:
+                if streams[b]['hyps'] is None:
+                    streams[b]['ctc_prefix_score'] = CTCPrefixScore(
+                        ctc_log_probs[b, :ctc_xlens[b]], self.blank, self.eos)
+                else:
+                    streams[b]['ctc_prefix_score'].register_new_chunk(ctc_log_probs[b, :ctc_xlens[b]])
+            if streams[b]['hyps'] is None:
+                streams[b]['n_frames'] = 0
+                ctc_state = streams[b]['ctc_prefix_score'].initial_state() if ctc_log_probs is not None else None
+                streams[b]['hyps'] = [{'hyp': [self.eos],
+                                       'score': 0.,
+                                       'score_attn': 0.,
+                                       'score_ctc': 0.,
+                                       'score_lm': 0.,
+                                       'dstates': self.zero_state(1),
+                                       'cv': eouts.new_zeros(1, 1, self.enc_n_units),
+                                       'aws': [None],
+                                       'lmstate': None,
+                                       'ctc_state': ctc_state,
+                                       'no_trigger': False}]
+            hyps.append(streams[b]['hyps'])
+            end_hyps.append([])
+            ytimes.append(int(math.floor(xlens[b] * max_len_ratio)) + 1)
+
+        active_utts = [b for b in range(bs) if len(hyps[b]) > 0]
+        active_utts_prev = None
+        for t in range(max(ytimes)):
+            # finish if additional triggered points are not found in all candidates
+            active_utts = [b for b in active_utts if t < ytimes[b] and not (
+                t > 0 and sum([cand['no_trigger'] for cand in hyps[b]]) == len(hyps[b]))]
+            if len(active_utts) == 0:
+                break
+
+            # Flatten hypotheses of all active streams into a single batch
+            n_rows = max([len(hyps[b]) for b in active_utts])
+            beams = []
+            for b in active_utts:
+                beams += hyps[b] + [hyps[b][0]] * (n_rows - len(hyps[b]))
+            elens_act = elens[active_utts]
+            eouts_act = eouts[active_utts, :max(elens_act)]
+            mask = make_pad_mask(elens_act, self.device_id)
+            # The key projection is recomputed only when some streams finish
+            cache = active_utts == active_utts_prev
+            active_utts_prev = active_utts[:]
+
+            # preprocess for batch decoding
+            y = eouts.new_zeros(len(beams), 1).long()
+            for j, beam in enumerate(beams):
+                y[j, 0] = beam['hyp'][-1]
+
+            cv = torch.cat([beam['cv'] for beam in beams], dim=0)
+            aw = self._pad_aws([beam['aws'][-1] for beam in beams], eouts_act.size(1)) if t > 0 else None
+            hxs = torch.cat([beam['dstates']['dstate'][0] for beam in beams], dim=1)
+            cxs = None
+            if self.rnn_type == 'lstm':
+                cxs = torch.cat([beam['dstates']['dstate'][1] for beam in beams], dim=1)
+            dstates = {'dstate': (hxs, cxs)}
+            lmstate = None
+            if lm is not None or self.lm is not None:
+                # NOTE: hypotheses of new segments do not have LM states yet
+                lmstate_ref = [beam['lmstate'] for beam in beams if beam['lmstate'] is not None]
+                if len(lmstate_ref) > 0:
+                    lmstate = {}
+                    for key in ['hxs', 'cxs']:
+                        zero = torch.zeros_like(lmstate_ref[0][key])
+                        lmstate[key] = torch.cat([beam['lmstate'][key] if beam['lmstate'] is not None else zero
+                                                  for beam in beams], dim=1)
+
+            lmout, scores_lm = None, None
+            if self.lm is not None:
+                # Update LM states for LM fusion
+                lmout, lmstate, scores_lm = self.lm.predict(y, lmstate)
+                scores_lm = scores_lm[:, -1]
+
+            dstates, cv, aw, attn_v = self.decode_step(
+                eouts_act, dstates, cv, self.dropout_emb(self.embed(y)), mask, aw, lmout, cache=cache)
+            scores_attn = torch.log_softmax(self.output(attn_v).squeeze(1), dim=1)
+
+            # Top-K selection for all hypotheses at once
+            total_scores = (eouts.new_tensor([beam['score_attn'] for beam in beams]).unsqueeze(1) +
+                            scores_attn) * (1 - ctc_weight)
+            total_scores_topk_all, topk_ids_all = torch.topk(
+                total_scores, k=beam_width, dim=1, largest=True, sorted=True)
+            if lm is not None:
+                if self.lm is None:
+                    # Update LM states for shallow fusion and score only the top-K candidates
+                    _, lmstate, scores_lm = lm.predict_candidates(y, lmstate, topk_ids_all, lm_normalizer_size)
+                else:
+                    scores_lm = scores_lm.gather(1, topk_ids_all)
+
+            for i_b, b in enumerate(active_utts):
+                new_hyps = []
+                for j_b, beam in enumerate(hyps[b]):
+                    j = i_b * n_rows + j_b
+                    # no triggered point found in this chunk
+                    if aw[j].sum() == 0:
+                        beam['aws'][-1] = eouts.new_zeros(1, xlens[b], 1)
+                        # NOTE: for the case where the first token in the current chunk is <eos>
+                        new_hyps.append(beam.copy())
+                        continue
+
+                    # Attention scores
+                    total_scores_attn = beam['score_attn'] + scores_attn[j:j + 1]
+
+                    # Add LM score <after> top-K selection
+                    total_scores_topk = total_scores_topk_all[j:j + 1].clone()
+                    topk_ids = topk_ids_all[j:j + 1]
+                    if lm is not None:
+                        total_scores_lm = beam['score_lm'] + scores_lm[j]
+                        total_scores_topk += total_scores_lm * lm_weight
+                    else:
+                        total_scores_lm = eouts.new_zeros(beam_width)
+
+                    # Add length penalty
+                    total_scores_topk += (len(beam['hyp'][1:]) + 1) * lp_weight
+
+                    # CTC score
+                    if ctc_log_probs is not None:
+                        ctc_scores, ctc_states = streams[b]['ctc_prefix_score'](
+                            beam['hyp'], tensor2np(topk_ids[0]), beam['ctc_state'], new_chunk=(t == 0))
+                        total_scores_ctc = torch.from_numpy(ctc_scores)
+                        if self.device_id >= 0:
+                            total_scores_ctc = total_scores_ctc.cuda(self.device_id)
+                        total_scores_topk += total_scores_ctc * ctc_weight
+                        # Sort again
+                        total_scores_topk, joint_ids_topk = torch.topk(
+                            total_scores_topk, k=beam_width, dim=1, largest=True, sorted=True)
+                        topk_ids = topk_ids[:, joint_ids_topk[0]]
+                    else:
+                        total_scores_ctc = eouts.new_zeros(beam_width)
+
+                    topk_ids = [topk_ids[0, k].item() for k in range(beam_width)]
+
+                    for k in range(beam_width):
+                        idx = topk_ids[k]
+                        total_score = total_scores_topk[0, k].item() / (len(beam['hyp'][1:]) + 1)
+
+                        if idx == self.eos:
+                            # EOS threshold
+                            max_score_no_eos = scores_attn[j, :idx].max(0)[0].item()
+                            max_score_no_eos = max(max_score_no_eos, scores_attn[j, idx + 1:].max(0)[0].item())
+                            if scores_attn[j, idx].item() <= eos_threshold * max_score_no_eos:
+                                continue
+
+                        new_hyps.append(
+                            {'hyp': beam['hyp'] + [idx],
+                             'score': total_score,
+                             'score_attn': total_scores_attn[0, idx].item(),
+                             'score_ctc': total_scores_ctc[k].item(),
+                             'score_lm': total_scores_lm[k].item(),
+                             'dstates': {'dstate': (dstates['dstate'][0][:, j:j + 1],
+                                                    dstates['dstate'][1][:, j:j + 1] if cxs is not None else None)},
+                             'cv': cv[j:j + 1],
+                             'aws': beam['aws'] + [self._crop_aw(aw[j:j + 1], xlens[b])],
+                             'lmstate': {'hxs': lmstate['hxs'][:, j:j + 1],
+                                         'cxs': lmstate['cxs'][:, j:j + 1]} if lmstate is not None else None,
+                             'ctc_state': ctc_states[joint_ids_topk[0, k]] if ctc_log_probs is not None else None,
+                             'no_trigger': False})
+
+                # Local pruning
+                new_hyps_sorted = sorted(new_hyps, key=lambda x: x['score'], reverse=True)[:beam_width]
+
+                # Remove complete hypotheses
+                new_hyps = []
+                for hyp in new_hyps_sorted:
+                    if len(hyp['hyp']) > 1 and hyp['hyp'][-1] == self.eos:
+                        end_hyps[b] += [hyp]
+                    else:
+                        new_hyps += [hyp]
+                if len(end_hyps[b]) >= beam_width:
+                    end_hyps[b] = end_hyps[b][:beam_width]
+                    ytimes[b] = t  # finish this stream
+                    continue
+                hyps[b] = new_hyps[:]
+
+        results = []
+        for b in range(bs):
+            # forward second path LM rescoring
+            if lm_2nd is not None:
+                self.lm_rescoring(end_hyps[b], lm_2nd, lm_weight_2nd, tag='2nd')
+
+            # Sort by score
+            if len(end_hyps[b]) > 0:
+                end_hyps[b] = sorted(end_hyps[b], key=lambda x: x['score'], reverse=True)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                merged_hyps = sorted(end_hyps[b] + hyps[b], key=lambda x: x['score'], reverse=True)
+                if len(merged_hyps) > 0:
+                    logger.debug('Hyp (stream %d): %s' % (b, idx2token(merged_hyps[0]['hyp'][1:])))
+
+            streams[b]['hyps'] = hyps[b]
+            streams[b]['n_frames'] += xlens[b]
+            results.append((end_hyps[b], hyps[b]))
+
+        return results
@@ -16,13 +16,17 @@ import numpy as np
 import random
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from neural_sp.models.criterion import kldiv_lsm_ctc
+from neural_sp.models.criterion import transducer_loss
+from neural_sp.models.lm.rnnlm import RNNLM
 from neural_sp.models.seq2seq.decoders.ctc import CTC
 from neural_sp.models.seq2seq.decoders.decoder_base import DecoderBase
 from neural_sp.models.torch_utils import np2tensor
 from neural_sp.models.torch_utils import pad_list
 from neural_sp.models.torch_utils import repeat
+from neural_sp.models.torch_utils import tensor2np
 
 random.seed(1)
 
@@ -111,6 +115,10 @@ class RNNTransducer(DecoderBase):
         self.prev_spk = ''
         self.lmstate_final = None
         self.state_cache = OrderedDict()
+        self.state_cache_size = 1000
+
+        # number of frames per chunk for the joint network in training
+        self.joint_chunk_size = 16
 
         if ctc_weight > 0:
             self.ctc = CTC(eos=self.eos,
@@ -242,25 +250,25 @@ class RNNTransducer(DecoderBase):
         ys_emb = self.dropout_emb(self.embed(ys_in))
         dout, _ = self.recurrency(ys_emb, None)
 
-        # Compute output distribution
-        logits = self.joint(eouts, dout)
-
-        # Compute Transducer loss
-        log_probs = torch.log_softmax(logits, dim=-1)
+        # Compute log probabilities of blank and target labels per chunk of frames
         if self.device_id >= 0:
             ys_out = ys_out.cuda(self.device_id)
-            elens = elens.cuda(self.device_id)
-            ylens = ylens.cuda(self.device_id)
+        log_probs_blank, log_probs_label = [], []
+        for t in range(0, eouts.size(1), self.joint_chunk_size):
+            eouts_chunk = eouts[:, t:t + self.joint_chunk_size]
+            if self.training and (eouts_chunk.requires_grad or dout.requires_grad):
+                # NOTE: the joint outputs are recomputed in the backward pass
+                lp_blank, lp_label = checkpoint(self._joint_log_probs, eouts_chunk, dout, ys_out)
+            else:
+                lp_blank, lp_label = self._joint_log_probs(eouts_chunk, dout, ys_out)
+            log_probs_blank.append(lp_blank)
+            log_probs_label.append(lp_label)
+        log_probs_blank = torch.cat(log_probs_blank, dim=1)  # `[B, T, L + 1]`
+        log_probs_label = torch.cat(log_probs_label, dim=1)  # `[B, T, L]`
 
-        assert log_probs.size(2) == ys_out.size(1) + 1
-        # loss = self.warprnnt_loss(log_probs, ys_out.int(), elens, ylens)
+        # Compute Transducer loss
         # NOTE: Transducer loss has already been normalized by bs
-        # NOTE: index 0 is reserved for blank in warprnnt_pytorch
-        import warp_rnnt
-        loss = warp_rnnt.rnnt_loss(log_probs, ys_out.int(), elens, ylens,
-                                   average_frames=False,
-                                   reduction='mean',
-                                   gather=False)
+        loss = transducer_loss(log_probs_blank, log_probs_label, elens, ylens)
 
         # Label smoothing for Transducer
         # if self.lsm_prob > 0:
@@ -271,6 +279,25 @@ class RNNTransducer(DecoderBase):
 
         return loss
 
+    def _joint_log_probs(self, eouts, douts, ys_out):
+        """Compute log probabilities of blank and target labels.
+
+        Args:
+            eouts (FloatTensor): `[B, T, dec_n_units]`
+            douts (FloatTensor): `[B, L + 1, dec_n_units]`
+            ys_out (LongTensor): `[B, L]`
+        Returns:
+            log_probs_blank (FloatTensor): `[B, T, L + 1]`
+            log_probs_label (FloatTensor): `[B, T, L]`
+
+        """
+        logits = self.joint(eouts, douts)  # `[B, T, L + 1, vocab]`
+        log_norm = torch.logsumexp(logits, dim=-1)  # `[B, T, L + 1]`
+        log_probs_blank = logits[:, :, :, self.blank] - log_norm
+        ys_out = ys_out.unsqueeze(1).unsqueeze(3).expand(-1, logits.size(1), -1, -1)
+        log_probs_label = logits[:, :, :-1].gather(3, ys_out).squeeze(3) - log_norm[:, :, :-1]
+        return log_probs_blank, log_probs_label
+
     def joint(self, eouts, douts, non_linear=torch.tanh):
         """Combine encoder outputs and prediction network outputs.
 
@@ -347,9 +374,13 @@ class RNNTransducer(DecoderBase):
 
     def greedy(self, eouts, elens, max_len_ratio, idx2token,
                exclude_eos=False, oracle=False,
-               refs_id=None, utt_ids=None, speakers=None):
+               refs_id=None, utt_ids=None, speakers=None,
+               max_symbols_per_frame=1):
         """Greedy decoding in the inference stage.
 
+        All utterances are decoded frame by frame in a batch, and the prediction
+        network is updated only for utterances emitting non-blank labels.
+
         Args:
             eouts (FloatTensor): `[B, T, enc_units]`
             elens (IntTensor): `[B]`
@@ -360,41 +391,67 @@ class RNNTransducer(DecoderBase):
             refs_id (list): reference list
             utt_ids (list): utterance id list
             speakers (list): speaker list
+            max_symbols_per_frame (int): maximum number of labels emitted per frame
         Returns:
             hyps (list): A list of length `[B]`, which contains arrays of size `[L]`
             aw: dummy
 
         """
-        bs = eouts.size(0)
+        bs, xmax = eouts.size()[:2]
+        elens = elens.to(eouts.device) if torch.is_tensor(elens) else eouts.new_tensor(elens)
+        elens = elens.long()
+
+        # Initialization
+        y = eouts.new_zeros(bs, 1).fill_(self.eos).long()
+        y_emb = self.dropout_emb(self.embed(y))
+        dout, dstate = self.recurrency(y_emb, None)
+
+        if oracle:
+            ys_ref = pad_list([eouts.new_tensor(refs_id[b] + [self.eos]).long() for b in range(bs)], self.eos)
+        n_labels = eouts.new_zeros(bs).long()
+        is_ended = eouts.new_zeros(bs).byte()
+        labels = []  # `[T * max_symbols_per_frame, B]`
+        for t in range(xmax):
+            is_active = (elens > t) & (is_ended == 0)
+            for _ in range(max_symbols_per_frame):
+                # Pick up 1-best per frame
+                out = self.joint(eouts[:, t:t + 1], dout)
+                y = out.view(bs, self.vocab).argmax(-1)
+                is_emitted = is_active & (y != self.blank)
+                labels.append(y.masked_fill(is_emitted == 0, -1))
+                emitted_ids = is_emitted.nonzero().view(-1)
+                if emitted_ids.size(0) == 0:
+                    break
 
+                # early stop
+                if self.end_pointing:
+                    is_ended |= is_emitted & (y == self.eos)
+
+                # Update prediction network only for utterances predicting non-blank labels
+                n_labels += is_emitted.long()
+                y = y[emitted_ids].unsqueeze(1)
+                if oracle:
+                    y = ys_ref[emitted_ids].gather(
+                        1, (n_labels[emitted_ids] - 1).clamp(max=ys_ref.size(1) - 1).unsqueeze(1))
+                y_emb = self.dropout_emb(self.embed(y))
+                dstate_e = {'hxs': dstate['hxs'][:, emitted_ids], 'cxs': None}
+                if self.rnn_type == 'lstm_transducer':
+                    dstate_e['cxs'] = dstate['cxs'][:, emitted_ids]
+                dout_e, dstate_e = self.recurrency(y_emb, dstate_e)
+                dout = dout.index_copy(0, emitted_ids, dout_e)
+                dstate['hxs'] = dstate['hxs'].index_copy(1, emitted_ids, dstate_e['hxs'])
+                if self.rnn_type == 'lstm_transducer':
+                    dstate['cxs'] = dstate['cxs'].index_copy(1, emitted_ids, dstate_e['cxs'])
+
+                is_active = is_emitted & (is_ended == 0)
+
+        # Copy to the host at once
+        labels = tensor2np(torch.stack(labels, dim=1)) if len(labels) > 0 else np.zeros((bs, 0), dtype=np.int64)
         hyps = []
         for b in range(bs):
-            hyp_b = []
-            # Initialization
-            y = eouts.new_zeros(bs, 1).fill_(self.eos).long()
-            y_emb = self.dropout_emb(self.embed(y))
-            dout, dstate = self.recurrency(y_emb, None)
-
-            for t in range(elens[b]):
-                # Pick up 1-best per frame
-                out = self.joint(eouts[b:b + 1, t:t + 1], dout.squeeze(1))
-                y = out.squeeze(2).argmax(-1)
-                idx = y[0].item()
-
-                # Update prediction network only when predicting non-blank labels
-                if idx != self.blank:
-                    # early stop
-                    if self.end_pointing and idx == self.eos:
-                        if not exclude_eos:
-                            hyp_b += [idx]
-                        break
-
-                    hyp_b += [idx]
-                    if oracle:
-                        y = eouts.new_zeros(1, 1).fill_(refs_id[b, len(hyp_b) - 1]).long()
-                    y_emb = self.dropout_emb(self.embed(y))
-                    dout, dstate = self.recurrency(y_emb, dstate)
-
+            hyp_b = labels[b][labels[b] >= 0]
+            if self.end_pointing and exclude_eos and len(hyp_b) > 0 and hyp_b[-1] == self.eos:
+                hyp_b = hyp_b[:-1]
             hyps += [hyp_b]
 
         for b in range(bs):
@@ -411,7 +468,11 @@ class RNNTransducer(DecoderBase):
                     nbest=1, exclude_eos=False,
                     refs_id=None, utt_ids=None, speakers=None,
                     ensmbl_eouts=None, ensmbl_elens=None, ensmbl_decs=[]):
-        """Beam search decoding.
+        """Alignment-length synchronous beam search decoding.
+
+        All hypotheses sharing the same alignment length (the number of frames
+        consumed plus the number of labels emitted) are extended at once, and
+        hypotheses reaching the same label sequence at the same frame are merged.
 
         Args:
             eouts (FloatTensor): `[B, T, dec_n_units]`
@@ -419,11 +480,9 @@ class RNNTransducer(DecoderBase):
             params (dict):
                 recog_beam_width (int): size of hyp
                 recog_max_len_ratio (int): maximum sequence length of tokens
-                recog_min_len_ratio (float): minimum sequence length of tokens
-                recog_length_penalty (float): length penalty
-                recog_coverage_penalty (float): coverage penalty
-                recog_coverage_threshold (float): threshold for coverage penalty
                 recog_lm_weight (float): weight of LM score
+                recog_lm_second_weight (float): weight of second path LM score
+                recog_lm_state_carry_over (bool): carry over LM states across utterances
             idx2token (): converter from index to token
             lm: firsh path LM
             lm_2nd: second path LM
@@ -444,163 +503,254 @@ class RNNTransducer(DecoderBase):
 
         """
         bs = eouts.size(0)
-        best_hyps = []
 
         oracle = params['recog_oracle']
         beam_width = params['recog_beam_width']
-        ctc_weight = params['recog_ctc_weight']
+        max_len_ratio = params['recog_max_len_ratio']
         lm_weight = params['recog_lm_weight']
-        asr_state_carry_over = params['recog_asr_state_carry_over']
+        lm_weight_2nd = params['recog_lm_second_weight']
         lm_state_carry_over = params['recog_lm_state_carry_over']
-        lm_usage = params['recog_lm_usage']
 
         if lm is not None:
+            assert lm_weight > 0
             lm.eval()
+        if lm_2nd is not None:
+            assert lm_weight_2nd > 0
+            lm_2nd.eval()
+        self.nbest_hyps_final = [] if params['recog_nbest_export'] else None
 
+        # NOTE: prediction network states only depend on label sequences
+        self.state_cache = OrderedDict()
+
+        nbest_hyps_idx = []
         for b in range(bs):
-            # Initialization
-            y = eouts.new_zeros(bs, 1).fill_(self.eos).long()
-            y_emb = self.dropout_emb(self.embed(y))
-            dout, dstate = self.recurrency(y_emb, None)
             lmstate = None
-
-            if lm_state_carry_over:
-                lmstate = self.lmstate_final
-            self.prev_spk = speakers[b]
-
-            end_hyps = []
-            hyps = [{'hyp': [self.eos],
-                     'lattice': [],
-                     'ref_id': [self.eos],
+            if speakers is not None:
+                if speakers[b] == self.prev_spk:
+                    if lm_state_carry_over and isinstance(lm, RNNLM):
+                        lmstate = self.lmstate_final
+                self.prev_spk = speakers[b]
+            if lm_state_carry_over and lm is not None:
+                # LM states depend on the previous utterance
+                self.state_cache = OrderedDict()
+
+            xmax = int(elens[b])
+            ymax = int(np.floor(xmax * max_len_ratio))
+            ref = refs_id[b] + ([self.eos] if self.end_pointing else []) if oracle else None
+
+            root = (self.eos,)
+            state = self._get_state_cache(root)
+            if state is None:
+                state = self._update_states([root], [{'dstate': None, 'lmstate': lmstate}], lm, eouts)[0]
+            hyps = [{'hyp': root,
+                     't': 0,
                      'score': 0.,
                      'score_lm': 0.,
-                     'score_ctc': 0.,
-                     'dout': dout,
-                     'dstate': dstate,
-                     'lmstate': lmstate,
-                     }]
-            for t in range(elens[b]):
-                new_hyps = []
-                for hyp in hyps:
-                    prev_idx = ([self.eos] + refs_id[b])[t] if oracle else hyp['hyp'][-1]
-                    score = hyp['score']
-                    score_lm = hyp['score_lm']
-                    dout = hyp['dout']
-                    dstate = hyp['dstate']
-                    lmstate = hyp['lmstate']
-
-                    # Pick up the top-k scores
-                    out = self.joint(eouts[b:b + 1, t:t + 1], dout.squeeze(1))
-                    log_probs = torch.log_softmax(out.squeeze(2), dim=-1)
-                    log_probs_topk, topk_ids = torch.topk(
-                        log_probs[0, 0], k=min(beam_width, self.vocab), dim=-1, largest=True, sorted=True)
-
-                    for k in range(beam_width):
-                        idx = topk_ids[k].item()
-                        score += log_probs_topk[k].item()
-
-                        # Update prediction network only when predicting non-blank labels
-                        lattice = hyp['lattice'] + [idx]
-                        if idx == self.blank:
-                            hyp_id = hyp['hyp']
-                        else:
-                            hyp_id = hyp['hyp'] + [idx]
-                            hyp_str = ' '.join(list(map(str, hyp_id[1:])))
-                            if hyp_str in self.state_cache.keys():
-                                # from cache
-                                dout = self.state_cache[hyp_str]['dout']
-                                new_dstate = self.state_cache[hyp_str]['dstate']
-                            else:
-                                if oracle:
-                                    y = eouts.new_zeros(1, 1).fill_(refs_id[b, len(hyp_id) - 1]).long()
-                                else:
-                                    y = eouts.new_zeros(1, 1).fill_(idx).long()
-                                y_emb = self.dropout_emb(self.embed(y))
-                                dout, new_dstate = self.recurrency(y_emb, dstate)
-
-                                # Update LM states for shallow fusion
-                                if lm_weight > 0 and lm is not None:
-                                    _, lmstate, lm_log_probs = lm.predict(
-                                        eouts.new_zeros(1, 1).fill_(prev_idx), hyp['lmstate'])
-                                    local_score_lm = lm_log_probs[0, idx].item()
-                                    score_lm += local_score_lm * lm_weight
-                                    score += local_score_lm * lm_weight
-
-                                # to cache
-                                self.state_cache[hyp_str] = {
-                                    'lattice': lattice,
-                                    'dout': dout,
-                                    'dstate': new_dstate,
-                                    'lmstate': lmstate,
-                                }
-
-                        new_hyps.append({'hyp': hyp_id,
-                                         'lattice': lattice,
-                                         'score': score,
-                                         'score_lm': score_lm,
-                                         'score_ctc': 0,  # TODO(hirofumi):
-                                         'dout': dout,
-                                         'dstate': dstate if idx == self.blank else new_dstate,
-                                         'lmstate': lmstate,
-                                         })
-
-                # Local pruning
-                new_hyps_tmp = sorted(new_hyps, key=lambda x: x['score'], reverse=True)[:beam_width]
+                     'state': state}]
+            end_hyps = {}
+
+            for _ in range(xmax + ymax):
+                # Compute the joint network of all hypotheses at once
+                n_hyps = len(hyps)
+                douts = torch.cat([hyp['state']['dout'] for hyp in hyps], dim=0)  # `[N, 1, dec_n_units]`
+                ts = eouts.new_tensor([hyp['t'] for hyp in hyps]).long()
+                out = self.joint(eouts[b, ts].unsqueeze(1), douts)
+                log_probs = torch.log_softmax(out.view(n_hyps, self.vocab), dim=-1)
+                scores_blank = log_probs[:, self.blank]
+                scores_label = log_probs.clone()
+                if lm is not None:
+                    scores_label += torch.stack([hyp['state']['lm_log_probs'] for hyp in hyps], dim=0) * lm_weight
+                scores_label[:, self.blank] = LOG_0
+                if oracle:
+                    ref_ids = eouts.new_tensor([ref[len(hyp['hyp']) - 1] if len(hyp['hyp']) <= len(ref) else self.blank
+                                                for hyp in hyps]).long().unsqueeze(1)
+                    scores_label = scores_label.gather(1, ref_ids)
+                    topk_ids = ref_ids
+                else:
+                    scores_label, topk_ids = torch.topk(
+                        scores_label, k=min(beam_width, self.vocab - 1), dim=1, largest=True, sorted=True)
+                # Copy to the host at once
+                scores = tensor2np(torch.cat([scores_blank.unsqueeze(1), scores_label], dim=1))
+                scores_blank, scores_label = scores[:, 0], scores[:, 1:]
+                topk_ids = tensor2np(topk_ids)
+
+                # Extend hypotheses and merge the ones with the same label sequence and frame
+                new_hyps = {}
+                for j, hyp in enumerate(hyps):
+                    # blank: move to the next frame
+                    self._add_hyp(new_hyps, {'hyp': hyp['hyp'],
+                                             't': hyp['t'] + 1,
+                                             'score': hyp['score'] + float(scores_blank[j]),
+                                             'score_lm': hyp['score_lm'],
+                                             'state': hyp['state']})
+                    if len(hyp['hyp']) - 1 >= ymax:
+                        continue
+                    # label: stay in the same frame
+                    for k in range(topk_ids.shape[1]):
+                        idx = int(topk_ids[j, k])
+                        if idx == self.blank or scores_label[j, k] <= LOG_0:
+                            continue
+                        score_lm = hyp['score_lm']
+                        if lm is not None:
+                            score_lm += float(hyp['state']['lm_log_probs_np'][idx]) * lm_weight
+                        self._add_hyp(new_hyps, {'hyp': hyp['hyp'] + (idx,),
+                                                 't': hyp['t'],
+                                                 'score': hyp['score'] + float(scores_label[j, k]),
+                                                 'score_lm': score_lm,
+                                                 'state': None,
+                                                 'parent_state': hyp['state']})
 
                 # Remove complete hypotheses
-                new_hyps = []
-                for hyp in new_hyps_tmp:
-                    if oracle:
-                        if t == len(refs_id[b]):
-                            end_hyps += [hyp]
-                        else:
-                            new_hyps += [hyp]
+                hyps = []
+                for hyp in new_hyps.values():
+                    if hyp['t'] == xmax or (self.end_pointing and hyp['hyp'][-1] == self.eos and len(hyp['hyp']) > 1):
+                        if oracle and len(hyp['hyp']) - 1 < len(ref):
+                            continue
+                        self._add_hyp(end_hyps, hyp)
                     else:
-                        if self.end_pointing and hyp['hyp'][-1] == self.eos:
-                            end_hyps += [hyp]
-                        else:
-                            new_hyps += [hyp]
-                if len(end_hyps) >= beam_width:
-                    end_hyps = end_hyps[:beam_width]
-                    logger.info('End-pointed at %d / %d frames' % (t, elens[b]))
+                        hyps.append(hyp)
+
+                # Pruning
+                hyps = sorted(hyps, key=lambda x: x['score'], reverse=True)[:beam_width]
+
+                # Stop when no active hypothesis can outperform the N-best complete hypotheses
+                end_scores = sorted([hyp['score'] for hyp in end_hyps.values()], reverse=True)
+                if len(hyps) == 0 or (len(end_scores) >= beam_width and end_scores[beam_width - 1] >= hyps[0]['score']):
                     break
-                hyps = new_hyps[:]
 
-            # Rescoing lattice
-            if lm_weight > 0 and lm is not None and lm_usage == 'rescoring':
-                new_hyps = []
+                # Update prediction network (and LM) only for new label sequences
+                new_ys, parents = [], []
                 for hyp in hyps:
-                    ys = [np2tensor(np.fromiter(hyp['hyp'], dtype=np.int64), self.device_id)]
-                    ys_pad = pad_list(ys, lm.pad)
-                    _, _, lm_log_probs = lm.predict(ys_pad, None)
-                    score_ctc = 0  # TODO(hirofumi):
-                    score_lm = lm_log_probs.sum() * lm_weight
-                    new_hyps.append({'hyp': hyp['hyp'],
-                                     'score': hyp['score'] + score_lm,
-                                     'score_ctc': score_ctc,
-                                     'score_lm': score_lm
-                                     })
-                hyps = sorted(new_hyps, key=lambda x: x['score'], reverse=True)
-
-            # Exclude <eos>
-            if False and exclude_eos and self.end_pointing and hyps[0]['hyp'][-1] == self.eos:
-                best_hyps.append([hyps[0]['hyp'][1:-1]])
+                    if hyp['state'] is None:
+                        hyp['state'] = self._get_state_cache(hyp['hyp'])
+                        if hyp['state'] is None:
+                            new_ys.append(hyp['hyp'])
+                            parents.append(hyp['parent_state'])
+                if len(new_ys) > 0:
+                    states = dict(zip(new_ys, self._update_states(new_ys, parents, lm, eouts)))
+                    for hyp in hyps:
+                        if hyp['state'] is None:
+                            hyp['state'] = states[hyp['hyp']]
+
+            ended = len(end_hyps) > 0
+            if not ended:
+                end_hyps = {(hyp['hyp'], hyp['t']): hyp for hyp in hyps}
+            end_hyps = sorted(end_hyps.values(), key=lambda x: x['score'], reverse=True)
+            if self.nbest_hyps_final is not None and ended:
+                # all complete hypotheses including the ones beyond the beam
+                lattice = [{'hyp': hyp['hyp'][1:],
+                            'ended': True,
+                            'score': hyp['score'],
+                            'score_rnnt': hyp['score'] - hyp['score_lm'],
+                            'score_lm': hyp['score_lm'] / lm_weight if lm is not None else 0.}
+                           for hyp in end_hyps]
             else:
-                best_hyps.append([hyps[0]['hyp'][1:]])
+                lattice = None
+            end_hyps = end_hyps[:beam_width]
+
+            # forward second path LM rescoring
+            if lm_2nd is not None:
+                for hyp in end_hyps:
+                    hyp['hyp'] = list(hyp['hyp'])
+                self.lm_rescoring(end_hyps, lm_2nd, lm_weight_2nd, tag='2nd')
+                end_hyps = sorted(end_hyps, key=lambda x: x['score'], reverse=True)
 
-            # Reset state cache
-            self.state_cache = OrderedDict()
+            if self.nbest_hyps_final is not None:
+                self.store_nbest([{'hyp': hyp['hyp'][1:],
+                                   'ended': ended,
+                                   'score': hyp['score'],
+                                   'score_rnnt': hyp['score'] - hyp['score_lm'] - hyp.get('score_lm_2nd', 0.) * lm_weight_2nd,
+                                   'score_lm': hyp['score_lm'] / lm_weight if lm is not None else 0.}
+                                  for hyp in end_hyps], lattice=lattice)
+
+            nbest_hyps_idx += [[np.array(end_hyps[n]['hyp'][1:]) for n in range(min(nbest, len(end_hyps)))]]
+
+            if lm is not None and end_hyps[0]['state'] is not None:
+                self.lmstate_final = end_hyps[0]['state']['lmstate']
 
             if utt_ids is not None:
                 logger.info('Utt-id: %s' % utt_ids[b])
             if refs_id is not None and self.vocab == idx2token.vocab:
                 logger.info('Ref: %s' % idx2token(refs_id[b]))
-            logger.info('Hyp: %s' % idx2token(hyps[0]['hyp'][1:]))
-            logger.info('log prob (hyp): %.7f' % hyps[0]['score'])
-            if ctc_weight > 0 and ctc_log_probs is not None:
-                logger.info('log prob (hyp, ctc): %.7f' % (hyps[0]['score_ctc']))
-            # logger.info('log prob (lp): %.7f' % hyps[0]['score_lp'])
-            if lm_weight > 0 and lm is not None:
-                logger.info('log prob (hyp, lm): %.7f' % (hyps[0]['score_lm']))
-
-        return np.array(best_hyps), None, None
+            logger.info('Hyp: %s' % idx2token(list(end_hyps[0]['hyp'][1:])))
+            logger.info('log prob (hyp): %.7f' % end_hyps[0]['score'])
+            if lm is not None:
+                logger.info('log prob (hyp, lm): %.7f' % (end_hyps[0]['score_lm']))
+
+        return nbest_hyps_idx, None, None
+
+    def _add_hyp(self, hyps, hyp):
+        """Add a hypothesis to a table keyed by its label sequence and frame.
+
+        Scores of hypotheses with the same key are summed in the probability
+        scale except for the LM score, which only depends on the label sequence.
+
+        """
+        key = (hyp['hyp'], hyp['t'])
+        if key not in hyps:
+            hyps[key] = hyp
+            return
+        prev = hyps[key]
+        score_lm = prev['score_lm']
+        prev['score'] = float(np.logaddexp(prev['score'] - score_lm, hyp['score'] - score_lm)) + score_lm
+        if prev['state'] is None and hyp['state'] is not None:
+            prev['state'] = hyp['state']
+
+    def _get_state_cache(self, ys):
+        """Look up prediction network states of a label sequence in the LRU cache."""
+        state = self.state_cache.get(ys, None)
+        if state is not None:
+            self.state_cache.move_to_end(ys)
+        return state
+
+    def _update_states(self, ys, parents, lm, eouts):
+        """Update prediction network (and LM) states of new label sequences in a batch.
+
+        Args:
+            ys (list): A list of length `[N]`, which contains tuples of label ids
+            parents (list): A list of length `[N]`, which contains states of `ys[:-1]`
+            lm: LM for shallow fusion
+            eouts (FloatTensor): `[B, T, dec_n_units]`
+        Returns:
+            states (list): A list of length `[N]`, which contains dicts of
+                dout (FloatTensor): `[1, 1, dec_n_units]`
+                dstate (dict): prediction network state
+                lmstate (dict): LM state
+                lm_log_probs (FloatTensor): `[vocab]`
+
+        """
+        n = len(ys)
+        y = eouts.new_tensor([y_seq[-1] for y_seq in ys]).long().unsqueeze(1)  # `[N, 1]`
+
+        dstate = None
+        if parents[0]['dstate'] is not None:
+            dstate = {'hxs': torch.cat([p['dstate']['hxs'] for p in parents], dim=1), 'cxs': None}
+            if self.rnn_type == 'lstm_transducer':
+                dstate['cxs'] = torch.cat([p['dstate']['cxs'] for p in parents], dim=1)
+        douts, dstate = self.recurrency(self.dropout_emb(self.embed(y)), dstate)
+
+        lmstate, lm_log_probs = None, None
+        if lm is not None:
+            if parents[0]['lmstate'] is not None:
+                lmstate = {'hxs': torch.cat([p['lmstate']['hxs'] for p in parents], dim=1),
+                           'cxs': torch.cat([p['lmstate']['cxs'] for p in parents], dim=1)}
+            _, lmstate, lm_log_probs = lm.predict(y, lmstate)
+            lm_log_probs = lm_log_probs[:, 0]
+            lm_log_probs_np = tensor2np(lm_log_probs)
+
+        states = []
+        for i in range(n):
+            state = {'dout': douts[i:i + 1],
+                     'dstate': {'hxs': dstate['hxs'][:, i:i + 1],
+                                'cxs': dstate['cxs'][:, i:i + 1] if dstate['cxs'] is not None else None},
+                     'lmstate': {'hxs': lmstate['hxs'][:, i:i + 1],
+                                 'cxs': lmstate['cxs'][:, i:i + 1]} if lmstate is not None else None,
+                     'lm_log_probs': lm_log_probs[i] if lm is not None else None,
+                     'lm_log_probs_np': lm_log_probs_np[i] if lm is not None else None}
+            states.append(state)
+
+            # to cache
+            self.state_cache[ys[i]] = state
+            if len(self.state_cache) > self.state_cache_size:
+                self.state_cache.popitem(last=False)
+        return states
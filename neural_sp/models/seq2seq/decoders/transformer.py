@@ -24,7 +24,7 @@ from neural_sp.models.lm.rnnlm import RNNLM
 from neural_sp.models.modules.transformer import PositionalEncoding
 from neural_sp.models.modules.transformer import TransformerDecoderBlock
 from neural_sp.models.seq2seq.decoders.ctc import CTC
-from neural_sp.models.seq2seq.decoders.ctc import CTCPrefixScore
+from neural_sp.models.seq2seq.decoders.ctc import CTCPrefixScoreTH
 from neural_sp.models.seq2seq.decoders.decoder_base import DecoderBase
 from neural_sp.models.torch_utils import append_sos_eos
 from neural_sp.models.torch_utils import compute_accuracy
@@ -40,6 +40,8 @@ random.seed(1)
 
 logger = logging.getLogger(__name__)
 
+NEG_INF = float(np.finfo(np.float32).min)
+
 
 class TransformerDecoder(DecoderBase):
     """Transformer decoder.
@@ -371,7 +373,8 @@ class TransformerDecoder(DecoderBase):
                     lm=None, lm_2nd=None, lm_2nd_rev=None, ctc_log_probs=None,
                     nbest=1, exclude_eos=False,
                     refs_id=None, utt_ids=None, speakers=None,
-                    ensmbl_eouts=None, ensmbl_elens=None, ensmbl_decs=[], cache_states=False):
+                    ensmbl_eouts=None, ensmbl_elens=None, ensmbl_decs=[], cache_states=False,
+                    shortlist=None):
         """Beam search decoding.
 
         Args:
@@ -385,6 +388,13 @@ class TransformerDecoder(DecoderBase):
                 recog_coverage_penalty (float): coverage penalty
                 recog_coverage_threshold (float): threshold for coverage penalty
                 recog_lm_weight (float): weight of LM score
+                recog_ctc_weight (float): weight of CTC score
+                recog_ctc_window_margin (int): number of frames around attention peaks
+                    to compute CTC prefix scores
+                recog_beam_threshold (float): prune hypotheses whose score is lower
+                    than the best one by this value (0 disables)
+                recog_early_termination (bool): stop when no active hypothesis can
+                    outperform the best complete hypothesis
             idx2token (): converter from index to token
             lm: firsh path LM
             lm_2nd: second path LM
@@ -398,6 +408,8 @@ class TransformerDecoder(DecoderBase):
             ensmbl_eouts (list): list of FloatTensor
             ensmbl_elens (list) list of list
             ensmbl_decs (list): list of torch.nn.Module
+            shortlist (LongTensor): `[B, K]`, tokens the output layer is restricted to
+                (see `ctc_shortlist`). <eos> must be placed at the first position.
         Returns:
             nbest_hyps_idx (list): A list of length `[B]`, which contains list of N hypotheses
             aws (list): A list of length `[B]`, which contains arrays of size `[L, T]`
@@ -411,16 +423,20 @@ class TransformerDecoder(DecoderBase):
         beam_width = params['recog_beam_width']
         assert 1 <= nbest <= beam_width
         ctc_weight = params['recog_ctc_weight']
+        ctc_window_margin = params['recog_ctc_window_margin']
         max_len_ratio = params['recog_max_len_ratio']
         min_len_ratio = params['recog_min_len_ratio']
         lp_weight = params['recog_length_penalty']
         length_norm = params['recog_length_norm']
         lm_weight = params['recog_lm_weight']
+        lm_normalizer_size = params['recog_lm_normalizer_size']
         lm_weight_2nd = params['recog_lm_second_weight']
         lm_weight_2nd_rev = params['recog_lm_rev_weight']
         eos_threshold = params['recog_eos_threshold']
         lm_state_carry_over = params['recog_lm_state_carry_over']
         softmax_smoothing = params['recog_softmax_smoothing']
+        beam_threshold = params['recog_beam_threshold']
+        early_termination = params['recog_early_termination'] and not oracle
 
         # TODO:
         # - aws
@@ -436,30 +452,34 @@ class TransformerDecoder(DecoderBase):
         if lm_2nd_rev is not None:
             assert lm_weight_2nd_rev > 0
             lm_2nd_rev.eval()
-
-        nbest_hyps_idx, aws, scores = [], [], []
-        eos_flags = []
+        self.nbest_hyps_final = [] if params['recog_nbest_export'] else None
+
+        if lm_state_carry_over and speakers is not None:
+            assert bs == 1, 'State carry over is supported only when recog_batch_size == 1.'
+
+        # For joint CTC-Attention decoding
+        ctc_prefix_scorer = None
+        if ctc_log_probs is not None:
+            assert ctc_weight > 0
+            ctc_prefix_scorer = CTCPrefixScoreTH(ctc_log_probs, elens, self.blank, self.eos,
+                                                 flip=self.bwd, margin=ctc_window_margin)
+            ctc_states_init = ctc_prefix_scorer.initial_state()
+
+        # Restrict the output layer to the shortlisted tokens of each utterance
+        output_sl = None
+        eos_pos = self.eos  # position of <eos> in the output layer
+        if shortlist is not None:
+            if shortlist.size(1) < beam_width:
+                shortlist = torch.cat([shortlist, shortlist.new_full(
+                    (bs, beam_width - shortlist.size(1)), self.pad)], dim=1)
+            output_sl = self.slice_output(shortlist)
+            eos_pos = 0
+
+        # Initialization per utterance
+        hyps, end_hyps, ytimes = [], [], []
         for b in range(bs):
-            # Initialization per utterance
             lmstate = None
-            y_seq = eouts.new_zeros(bs, 1).fill_(self.eos).long()
-
-            # For joint CTC-Attention decoding
-            if ctc_log_probs is not None:
-                assert ctc_weight > 0
-                if self.bwd:
-                    ctc_prefix_score = CTCPrefixScore(
-                        tensor2np(ctc_log_probs)[b][::-1], self.blank, self.eos)
-                else:
-                    ctc_prefix_score = CTCPrefixScore(
-                        tensor2np(ctc_log_probs)[b], self.blank, self.eos)
-
-            # Ensemble initialization
-            ensmbl_dstate, ensmbl_cv = [], []
-            if n_models > 1:
-                for dec in ensmbl_decs:
-                    ensmbl_dstate += [dec.zero_state(1)]
-                    ensmbl_cv += [eouts.new_zeros(1, 1, dec.enc_n_units)]
+            y_seq = eouts.new_zeros(1, 1).fill_(self.eos).long()
 
             if speakers is not None:
                 if speakers[b] == self.prev_spk:
@@ -467,223 +487,304 @@ class TransformerDecoder(DecoderBase):
                         lmstate = self.lmstate_final
                 self.prev_spk = speakers[b]
 
-            end_hyps = []
-            hyps = [{'hyp': [self.eos],
-                     'y_seq': y_seq,
-                     'cache': None,
-                     'score': 0.,
-                     'score_attn': 0.,
-                     'score_ctc': 0.,
-                     'score_lm': 0.,
-                     'aws': [None],
-                     'lmstate': lmstate,
-                     'ensmbl_aws':[[None]] * (n_models - 1),
-                     'ctc_state': ctc_prefix_score.initial_state() if ctc_log_probs is not None else None}]
+            hyps.append([{'hyp': [self.eos],
+                          'y_seq': y_seq,
+                          'cache': None,
+                          'score': 0.,
+                          'score_attn': 0.,
+                          'score_ctc': 0.,
+                          'score_lm': 0.,
+                          'aws': [None],
+                          'lmstate': lmstate,
+                          'ensmbl_aws': [[None]] * (n_models - 1),
+                          'ctc_state': ctc_states_init[:, :, b] if ctc_log_probs is not None else None}])
+            end_hyps.append([])
             if oracle:
                 assert refs_id is not None
-                ytime = len(refs_id[b]) + 1
+                ytimes.append(len(refs_id[b]) + 1)
             else:
-                ytime = int(math.floor(elens[b] * max_len_ratio)) + 1
-            for t in range(ytime):
-                # preprocess for batch decoding
-                y_seq = eouts.new_zeros(len(hyps), t + 1).long()
-                for j, beam in enumerate(hyps):
-                    y_seq[j, :] = beam['y_seq']
-                cache = [None] * self.n_layers
-                if cache_states and t > 0:
-                    for l in range(self.n_layers):
-                        cache[l] = torch.cat([beam['cache'][l] for beam in hyps], dim=0)
-
-                if lm is not None and beam['lmstate'] is not None:
-                    lm_hxs = torch.cat([beam['lmstate']['hxs'] for beam in hyps], dim=1)
-                    lm_cxs = torch.cat([beam['lmstate']['cxs'] for beam in hyps], dim=1)
-                    lmstate = {'hxs': lm_hxs, 'cxs': lm_cxs}
-                else:
-                    lmstate = None
+                ytimes.append(int(math.floor(elens[b] * max_len_ratio)) + 1)
+
+        active_utts = list(range(bs))
+        n_hyps_total, n_steps_total = 0, 0
+        for t in range(max(ytimes)):
+            # Flatten hypotheses of all active utterances into a single batch.
+            # Each utterance is padded to the same number of rows with copies of its
+            # first hypothesis so that the encoder outputs are broadcast over
+            # the hypotheses of each utterance in the source-target attention.
+            n_act = len(active_utts)
+            n_hyps_total += sum([len(hyps[b]) for b in active_utts])
+            n_steps_total += n_act
+            n_rows = max([len(hyps[b]) for b in active_utts])
+            beams = []
+            for b in active_utts:
+                beams += hyps[b] + [hyps[b][0]] * (n_rows - len(hyps[b]))
+            utt_of_rows = [b for b in active_utts for _ in range(n_rows)]
+            elens_act = elens[active_utts]
+            eouts_act = eouts[active_utts, :max(elens_act)]
+
+            # preprocess for batch decoding
+            y_seq = torch.cat([beam['y_seq'] for beam in beams], dim=0)
+            cache = [None] * self.n_layers
+            if cache_states and t > 0:
+                for l in range(self.n_layers):
+                    cache[l] = torch.cat([beam['cache'][l] for beam in beams], dim=0)
 
-                lmout, scores_lm = None, None
-                if lm is not None:
-                    # Update LM states for shallow fusion
-                    lmout, lmstate, scores_lm = lm.predict(y_seq[:, -1:], lmstate)
+            if lm is not None and beams[0]['lmstate'] is not None:
+                lm_hxs = torch.cat([beam['lmstate']['hxs'] for beam in beams], dim=1)
+                lm_cxs = torch.cat([beam['lmstate']['cxs'] for beam in beams], dim=1)
+                lmstate = {'hxs': lm_hxs, 'cxs': lm_cxs}
+            else:
+                lmstate = None
 
-                # for the main model
-                subsequent_mask = eouts.new_ones(t + 1, t + 1).byte()
-                subsequent_mask = torch.tril(subsequent_mask, out=subsequent_mask).unsqueeze(
-                    0).repeat([y_seq.size(0), 1, 1])
+            # for the main model
+            subsequent_mask = eouts.new_ones(t + 1, t + 1).byte()
+            subsequent_mask = torch.tril(subsequent_mask, out=subsequent_mask).unsqueeze(
+                0).repeat([y_seq.size(0), 1, 1])
+            src_mask = make_pad_mask(elens_act, self.device_id).unsqueeze(1).repeat(
+                [1, 1 if cache[0] is not None else t + 1, 1])
 
-                dout = self.pos_enc(self.embed(y_seq))
-                eouts_b = eouts[b:b + 1, :elens[b]].repeat([y_seq.size(0), 1, 1])
-                new_cache = [None] * self.n_layers
-                for l in range(self.n_layers):
-                    dout, _, xy_aws = self.layers[l](dout, subsequent_mask, eouts_b, None,
-                                                     cache=cache[l])
-                    new_cache[l] = dout
-
-                dout = self.norm_out(dout)  # `[beam_width, L, d_model]`
-                probs = torch.softmax(self.output(dout)[:, -1] * softmax_smoothing, dim=1)
-
-                # for the ensemble
-                ensmbl_dstate, ensmbl_cv, ensmbl_aws = [], [], []
-                # if n_models > 1:
-                #     for i_e, dec in enumerate(ensmbl_decs):
-                #         cv_e = torch.cat([beam['ensmbl_cv'][i_e] for beam in hyps], dim=0)
-                #         aw_e = torch.cat([beam['ensmbl_aws'][i_e][-1] for beam in hyps], dim=0) if t > 0 else None
-                #         hxs_e = torch.cat([beam['ensmbl_dstate'][i_e]['dstate'][0] for beam in hyps], dim=1)
-                #         if self.rnn_type == 'lstm':
-                #             cxs_e = torch.cat([beam['dstates'][i_e]['dstate'][1] for beam in hyps], dim=1)
-                #         dstates_e = {'dstate': (hxs_e, cxs_e)}
-                #
-                #         dstate_e, cv_e, aw_e, attn_v_e = dec.decode_step(
-                #             ensmbl_eouts[i_e][b:b + 1, :ensmbl_elens[i_e][b]].repeat([cv_e.size(0), 1, 1]),
-                #             dstates_e, cv_e, dec.dropout_emb(dec.embed(y)), None, aw_e, lmout)
-                #
-                #         ensmbl_dstate += [{'dstate': (beam['dstates'][i_e]['dstate'][0][:, j:j + 1],
-                #                                       beam['dstates'][i_e]['dstate'][1][:, j:j + 1])}]
-                #         ensmbl_cv += [cv_e[j:j + 1]]
-                #         ensmbl_aws += [beam['ensmbl_aws'][i_e] + [aw_e[j:j + 1]]]
-                #         probs += torch.softmax(dec.output(attn_v_e).squeeze(1), dim=1)
-                #         # NOTE: sum in the probability scale (not log-scale)
-
-                # Ensemble in log-scale
-                scores_attn = torch.log(probs) / n_models
+            dout = self.pos_enc(self.embed(y_seq))
+            new_cache = [None] * self.n_layers
+            for l in range(self.n_layers):
+                dout, _, xy_aws = self.layers[l](dout, subsequent_mask, eouts_act, src_mask,
+                                                 cache=cache[l])
+                new_cache[l] = dout
 
-                new_hyps = []
-                for j, beam in enumerate(hyps):
-                    # Attention scores
-                    total_scores_attn = beam['score_attn'] + scores_attn[j:j + 1]
-                    total_scores = total_scores_attn * (1 - ctc_weight)
-
-                    # Add LM score <after> top-K selection
-                    total_scores_topk, topk_ids = torch.topk(
-                        total_scores, k=beam_width, dim=1, largest=True, sorted=True)
-                    if lm is not None:
-                        total_scores_lm = beam['score_lm'] + scores_lm[j, -1, topk_ids[0]]
-                        total_scores_topk += total_scores_lm * lm_weight
-                    else:
-                        total_scores_lm = eouts.new_zeros(beam_width)
+            dout = self.norm_out(dout)  # `[n_rows * B, L, d_model]`
+            if shortlist is None:
+                logits = self.output(dout[:, -1])
+            else:
+                logits = self.shortlist_logits(dout[:, -1], output_sl, active_utts)
+            probs = torch.softmax(logits * softmax_smoothing, dim=1)
+
+            # for the ensemble
+            ensmbl_aws = []
+            # if n_models > 1:
+            #     for i_e, dec in enumerate(ensmbl_decs):
+            #         cv_e = torch.cat([beam['ensmbl_cv'][i_e] for beam in hyps], dim=0)
+            #         aw_e = torch.cat([beam['ensmbl_aws'][i_e][-1] for beam in hyps], dim=0) if t > 0 else None
+            #         hxs_e = torch.cat([beam['ensmbl_dstate'][i_e]['dstate'][0] for beam in hyps], dim=1)
+            #         if self.rnn_type == 'lstm':
+            #             cxs_e = torch.cat([beam['dstates'][i_e]['dstate'][1] for beam in hyps], dim=1)
+            #         dstates_e = {'dstate': (hxs_e, cxs_e)}
+            #
+            #         dstate_e, cv_e, aw_e, attn_v_e = dec.decode_step(
+            #             ensmbl_eouts[i_e][b:b + 1, :ensmbl_elens[i_e][b]].repeat([cv_e.size(0), 1, 1]),
+            #             dstates_e, cv_e, dec.dropout_emb(dec.embed(y)), None, aw_e, lmout)
+            #
+            #         ensmbl_dstate += [{'dstate': (beam['dstates'][i_e]['dstate'][0][:, j:j + 1],
+            #                                       beam['dstates'][i_e]['dstate'][1][:, j:j + 1])}]
+            #         ensmbl_cv += [cv_e[j:j + 1]]
+            #         ensmbl_aws += [beam['ensmbl_aws'][i_e] + [aw_e[j:j + 1]]]
+            #         probs += torch.softmax(dec.output(attn_v_e).squeeze(1), dim=1)
+            #         # NOTE: sum in the probability scale (not log-scale)
+
+            # Ensemble in log-scale
+            scores_attn = torch.log(probs) / n_models
+
+            # Score all candidates of all hypotheses at once
+            n_hyps = len(beams)
+            is_valid = eouts.new_tensor([j % n_rows < len(hyps[b]) for j, b in enumerate(utt_of_rows)]).bool()
+            hyp_lens = eouts.new_tensor([len(beam['hyp']) - 1 for beam in beams])
+
+            # Attention scores
+            total_scores_attn = eouts.new_tensor([beam['score_attn'] for beam in beams]).unsqueeze(1) + scores_attn
+            total_scores = total_scores_attn * (1 - ctc_weight)
+
+            # Add LM score <after> top-K selection
+            total_scores_topk, topk_pos = torch.topk(
+                total_scores, k=beam_width, dim=1, largest=True, sorted=True)
+            # positions in the output layer -> token IDs
+            topk_ids = topk_pos if shortlist is None else shortlist[utt_of_rows].gather(1, topk_pos)
+            if lm is not None:
+                # Update LM states for shallow fusion and score only the top-K candidates
+                _, lmstate, scores_lm = lm.predict_candidates(y_seq[:, -1:], lmstate, topk_ids, lm_normalizer_size)
+                total_scores_lm = eouts.new_tensor([beam['score_lm'] for beam in beams]).unsqueeze(1) + scores_lm
+                total_scores_topk += total_scores_lm * lm_weight
+            else:
+                total_scores_lm = eouts.new_zeros(n_hyps, beam_width)
 
-                    # Add length penalty
-                    if lp_weight > 0:
-                        total_scores_topk += (len(beam['hyp'][1:]) + 1) * lp_weight
+            # Add length penalty
+            if lp_weight > 0:
+                total_scores_topk += (hyp_lens.unsqueeze(1) + 1) * lp_weight
 
-                    # CTC score
-                    if ctc_log_probs is not None:
-                        ctc_scores, ctc_states = ctc_prefix_score(
-                            beam['hyp'], tensor2np(topk_ids[0]), beam['ctc_state'])
-                        total_scores_ctc = torch.from_numpy(ctc_scores)
-                        if self.device_id >= 0:
-                            total_scores_ctc = total_scores_ctc.cuda(self.device_id)
-                        total_scores_topk += total_scores_ctc * ctc_weight
-                        # Sort again
-                        total_scores_topk, joint_ids_topk = torch.topk(
-                            total_scores_topk, k=beam_width, dim=1, largest=True, sorted=True)
-                        topk_ids = topk_ids[:, joint_ids_topk[0]]
-                    else:
-                        total_scores_ctc = eouts.new_zeros(beam_width)
-
-                    for k in range(beam_width):
-                        idx = topk_ids[0, k].item()
-                        length_norm_factor = 1.
-                        if length_norm:
-                            length_norm_factor = len(beam['hyp'][1:]) + 1
-                        total_score = total_scores_topk[0, k].item() / length_norm_factor
-
-                        if idx == self.eos:
-                            # Exclude short hypotheses
-                            if len(beam['hyp']) - 1 < elens[b] * min_len_ratio:
-                                continue
-                            # EOS threshold
-                            max_score_no_eos = scores_attn[j, :idx].max(0)[0].item()
-                            max_score_no_eos = max(max_score_no_eos, scores_attn[j, idx + 1:].max(0)[0].item())
-                            if scores_attn[j, idx].item() <= eos_threshold * max_score_no_eos:
-                                continue
-
-                        y_seq = torch.cat([beam['y_seq'], eouts.new_zeros(1, 1).fill_(idx).long()], dim=-1)
-
-                        new_hyps.append(
-                            {'hyp': beam['hyp'] + [idx],
-                             'y_seq': y_seq,
-                             'cache': [new_cache_l[j:j + 1] for new_cache_l in new_cache] if cache_states else cache,
-                             'score': total_score,
-                             'score_attn': total_scores_attn[0, idx].item(),
-                             'score_ctc': total_scores_ctc[k].item(),
-                             'score_lm': total_scores_lm[k].item(),
-                             # 'aws': beam['aws'] + [aw[j:j + 1]],
-                             'lmstate': {'hxs': lmstate['hxs'][:, j:j + 1], 'cxs': lmstate['cxs'][:, j:j + 1]} if lmstate is not None else None,
-                             'ctc_state': ctc_states[joint_ids_topk[0, k]] if ctc_log_probs is not None else None,
-                             'ensmbl_aws': ensmbl_aws})
-
-                # Local pruning
-                new_hyps_sorted = sorted(new_hyps, key=lambda x: x['score'], reverse=True)[:beam_width]
+            # CTC score
+            if ctc_log_probs is not None:
+                total_scores_ctc, ctc_states = ctc_prefix_scorer(
+                    [beam['hyp'] for beam in beams], topk_ids,
+                    torch.stack([beam['ctc_state'] for beam in beams], dim=2),
+                    topk_ids.new_tensor(utt_of_rows), aw=xy_aws[:, :, -1].sum(1))
+                total_scores_topk += total_scores_ctc * ctc_weight
+                # Sort again
+                total_scores_topk, joint_ids_topk = torch.topk(
+                    total_scores_topk, k=beam_width, dim=1, largest=True, sorted=True)
+                topk_ids = topk_ids.gather(1, joint_ids_topk)
+                topk_pos = topk_pos.gather(1, joint_ids_topk)
+                total_scores_lm = total_scores_lm.gather(1, joint_ids_topk)
+                total_scores_ctc = total_scores_ctc.gather(1, joint_ids_topk)
+            else:
+                total_scores_ctc = eouts.new_zeros(n_hyps, beam_width)
+
+            if length_norm:
+                total_scores_topk /= (hyp_lens.unsqueeze(1) + 1)
+
+            # Exclude short hypotheses and <eos> below the EOS threshold
+            eos_ok = hyp_lens >= elens_act.float().repeat_interleave(n_rows).to(hyp_lens.device) * min_len_ratio
+            max_scores_no_eos = scores_attn.index_fill(1, topk_ids.new_tensor([eos_pos]), NEG_INF).max(1)[0]
+            eos_ok &= scores_attn[:, eos_pos] > eos_threshold * max_scores_no_eos
+            is_valid = is_valid.unsqueeze(1) & ((topk_ids != self.eos) | eos_ok.unsqueeze(1))
+            if shortlist is not None:
+                is_valid &= topk_ids != self.pad
+            total_scores_topk = total_scores_topk.masked_fill(~is_valid, NEG_INF)
+
+            # Local pruning over candidates of each utterance
+            total_scores_topk, ids_utt = torch.topk(
+                total_scores_topk.view(n_act, n_rows * beam_width), k=beam_width, dim=1, largest=True, sorted=True)
+            ids_utt_all = ids_utt + torch.arange(n_act, device=ids_utt.device).unsqueeze(1) * n_rows * beam_width
+            total_scores_attn = total_scores_attn.gather(1, topk_pos)
+            # Copy only the selected candidates to the host at once
+            sel_scores = tensor2np(torch.stack([
+                total_scores_topk,
+                total_scores_attn.view(-1)[ids_utt_all],
+                total_scores_ctc.view(-1)[ids_utt_all],
+                total_scores_lm.view(-1)[ids_utt_all]], dim=0))
+            sel_ids = tensor2np(torch.stack([
+                ids_utt_all // beam_width,
+                topk_ids.view(-1)[ids_utt_all],
+                is_valid.view(-1)[ids_utt_all].long()], dim=0))
+            if ctc_log_probs is not None:
+                ctc_states = ctc_states[:, :, ids_utt_all // beam_width,
+                                        joint_ids_topk.view(-1)[ids_utt_all]]  # `[T, 2, n_act, beam_width]`
+
+            for i_b, b in enumerate(active_utts):
+                new_hyps_sorted = []
+                for k in range(beam_width):
+                    j, idx, valid = [int(v) for v in sel_ids[:, i_b, k]]
+                    if not valid:
+                        continue
+                    beam = beams[j]
+                    y_seq = torch.cat([beam['y_seq'], eouts.new_zeros(1, 1).fill_(idx).long()], dim=-1)
+                    new_hyps_sorted.append(
+                        {'hyp': beam['hyp'] + [idx],
+                         'y_seq': y_seq,
+                         'cache': [new_cache_l[j:j + 1] for new_cache_l in new_cache] if cache_states else cache,
+                         'score': float(sel_scores[0, i_b, k]),
+                         'score_attn': float(sel_scores[1, i_b, k]),
+                         'score_ctc': float(sel_scores[2, i_b, k]),
+                         'score_lm': float(sel_scores[3, i_b, k]),
+                         # 'aws': beam['aws'] + [aw[j:j + 1]],
+                         'lmstate': {'hxs': lmstate['hxs'][:, j:j + 1], 'cxs': lmstate['cxs'][:, j:j + 1]} if lmstate is not None else None,
+                         'ctc_state': ctc_states[:, :, i_b, k] if ctc_log_probs is not None else None,
+                         'ensmbl_aws': ensmbl_aws})
 
                 # Remove complete hypotheses
                 new_hyps = []
                 for hyp in new_hyps_sorted:
                     if oracle:
                         if t == len(refs_id[b]):
-                            end_hyps += [hyp]
+                            end_hyps[b] += [hyp]
                         else:
                             new_hyps += [hyp]
                     else:
                         if len(hyp['hyp']) > 1 and hyp['hyp'][-1] == self.eos:
-                            end_hyps += [hyp]
+                            end_hyps[b] += [hyp]
                         else:
                             new_hyps += [hyp]
-                if len(end_hyps) >= beam_width:
-                    end_hyps = end_hyps[:beam_width]
-                    break
-                hyps = new_hyps[:]
 
+                # Score-threshold pruning relative to the best candidate
+                if beam_threshold > 0 and not oracle and len(new_hyps_sorted) > 0:
+                    new_hyps = [hyp for hyp in new_hyps
+                                if hyp['score'] >= new_hyps_sorted[0]['score'] - beam_threshold]
+
+                # Stop when no active hypothesis can outperform the best complete hypothesis
+                if early_termination and len(end_hyps[b]) > 0 and len(new_hyps) > 0:
+                    best_end_score = max([hyp['score'] for hyp in end_hyps[b]])
+                    if all(self.score_upper_bound(hyp, ytimes[b] - 1 - t, lp_weight, 0., ctc_weight, lm_weight,
+                                                  length_norm, False) <= best_end_score for hyp in new_hyps):
+                        new_hyps = []
+
+                if len(end_hyps[b]) >= beam_width:
+                    end_hyps[b] = end_hyps[b][:beam_width]
+                else:
+                    hyps[b] = new_hyps[:]
+
+            # Per-utterance end detection
+            active_utts = [b for b in active_utts
+                           if len(end_hyps[b]) < beam_width and len(hyps[b]) > 0 and t < ytimes[b] - 1]
+            if len(active_utts) == 0:
+                break
+
+        logger.info('Average number of active hypotheses per step: %.2f' %
+                    (n_hyps_total / max(n_steps_total, 1)))
+
+        nbest_hyps_idx, aws, scores = [], [], []
+        eos_flags = []
+        for b in range(bs):
             # Global pruning
-            if len(end_hyps) == 0:
-                end_hyps = hyps[:]
-            elif len(end_hyps) < nbest and nbest > 1:
-                end_hyps.extend(hyps[:nbest - len(end_hyps)])
+            if len(end_hyps[b]) == 0:
+                end_hyps[b] = hyps[b][:]
+            elif len(end_hyps[b]) < nbest and nbest > 1:
+                end_hyps[b].extend(hyps[b][:nbest - len(end_hyps[b])])
 
-            # forward second path LM rescoring
-            if lm_2nd is not None:
-                self.lm_rescoring(end_hyps, lm_2nd, lm_weight_2nd, tag='2nd')
+        # N-best lists of all utterances are rescored in a single batch per LM
+        # forward second path LM rescoring
+        if lm_2nd is not None:
+            self.lm_rescoring([hyp for b in range(bs) for hyp in end_hyps[b]],
+                              lm_2nd, lm_weight_2nd, tag='2nd')
 
-            # backward secodn path LM rescoring
-            if lm_2nd_rev is not None:
-                self.lm_rescoring(end_hyps, lm_2nd_rev, lm_weight_2nd_rev, tag='2nd_rev')
+        # backward secodn path LM rescoring
+        if lm_2nd_rev is not None:
+            self.lm_rescoring([hyp for b in range(bs) for hyp in end_hyps[b]],
+                              lm_2nd_rev, lm_weight_2nd_rev, reverse=True, tag='2nd_rev')
 
+        for b in range(bs):
             # Sort by score
-            end_hyps = sorted(end_hyps, key=lambda x: x['score'], reverse=True)
+            end_hyps[b] = sorted(end_hyps[b], key=lambda x: x['score'], reverse=True)
+            end_hyps_b = end_hyps[b]
+
+            if self.nbest_hyps_final is not None:
+                self.store_nbest([{'hyp': hyp['hyp'][1:][::-1] if self.bwd else hyp['hyp'][1:],
+                                   'score': hyp['score'],
+                                   'score_attn': hyp['score_attn'],
+                                   'score_ctc': hyp['score_ctc'],
+                                   'score_lm': hyp['score_lm'],
+                                   'score_lp': (len(hyp['hyp']) - 1) * lp_weight}
+                                  for hyp in end_hyps_b])
 
             if utt_ids is not None:
                 logger.info('Utt-id: %s' % utt_ids[b])
             if refs_id is not None and idx2token is not None and self.vocab == idx2token.vocab:
                 logger.info('Ref: %s' % idx2token(refs_id[b]))
             if idx2token is not None:
-                for k in range(len(end_hyps)):
+                for k in range(len(end_hyps_b)):
                     logger.info('Hyp: %s' % idx2token(
-                        end_hyps[k]['hyp'][1:][::-1] if self.bwd else end_hyps[k]['hyp'][1:]))
-                    logger.info('log prob (hyp): %.7f' % end_hyps[k]['score'])
-                    logger.info('log prob (hyp, att): %.7f' % (end_hyps[k]['score_attn'] * (1 - ctc_weight)))
+                        end_hyps_b[k]['hyp'][1:][::-1] if self.bwd else end_hyps_b[k]['hyp'][1:]))
+                    logger.info('log prob (hyp): %.7f' % end_hyps_b[k]['score'])
+                    logger.info('log prob (hyp, att): %.7f' % (end_hyps_b[k]['score_attn'] * (1 - ctc_weight)))
                     if ctc_log_probs is not None:
-                        logger.info('log prob (hyp, ctc): %.7f' % (end_hyps[k]['score_ctc'] * ctc_weight))
+                        logger.info('log prob (hyp, ctc): %.7f' % (end_hyps_b[k]['score_ctc'] * ctc_weight))
                     if lm is not None:
-                        logger.info('log prob (hyp, first-path lm): %.7f' % (end_hyps[k]['score_lm'] * lm_weight))
+                        logger.info('log prob (hyp, first-path lm): %.7f' % (end_hyps_b[k]['score_lm'] * lm_weight))
                     if lm_2nd is not None:
                         logger.info('log prob (hyp, second-path lm): %.7f' %
-                                    (end_hyps[k]['score_lm_2nd'] * lm_weight))
+                                    (end_hyps_b[k]['score_lm_2nd'] * lm_weight))
                     if lm_2nd_rev is not None:
                         logger.info('log prob (hyp, second-path lm, reverse): %.7f' %
-                                    (end_hyps[k]['score_lm_2nd_rev'] * lm_weight))
+                                    (end_hyps_b[k]['score_lm_2nd_rev'] * lm_weight))
 
             # N-best list
             if self.bwd:
                 # Reverse the order
-                nbest_hyps_idx += [[np.array(end_hyps[n]['hyp'][1:][::-1]) for n in range(nbest)]]
-                # aws += [tensor2np(torch.stack(end_hyps[0]['aws'][1:][::-1], dim=1).squeeze(0))]
+                nbest_hyps_idx += [[np.array(end_hyps_b[n]['hyp'][1:][::-1]) for n in range(nbest)]]
+                # aws += [tensor2np(torch.stack(end_hyps_b[0]['aws'][1:][::-1], dim=1).squeeze(0))]
             else:
-                nbest_hyps_idx += [[np.array(end_hyps[n]['hyp'][1:]) for n in range(nbest)]]
-                # aws += [tensor2np(torch.stack(end_hyps[0]['aws'][1:], dim=1).squeeze(0))]
-            scores += [[end_hyps[n]['score_attn'] for n in range(nbest)]]
+                nbest_hyps_idx += [[np.array(end_hyps_b[n]['hyp'][1:]) for n in range(nbest)]]
+                # aws += [tensor2np(torch.stack(end_hyps_b[0]['aws'][1:], dim=1).squeeze(0))]
+            scores += [[end_hyps_b[n]['score_attn'] for n in range(nbest)]]
 
             # Check <eos>
-            eos_flags.append([(end_hyps[n]['hyp'][-1] == self.eos) for n in range(nbest)])
+            eos_flags.append([(end_hyps_b[n]['hyp'][-1] == self.eos) for n in range(nbest)])
 
         # Exclude <eos> (<sos> in case of the backward decoder)
         if exclude_eos:
@@ -695,7 +796,7 @@ class TransformerDecoder(DecoderBase):
                                    else nbest_hyps_idx[b][n] for n in range(nbest)] for b in range(bs)]
 
         # Store ASR/LM state
-        if len(end_hyps) > 0:
-            self.lmstate_final = end_hyps[0]['lmstate']
+        if len(end_hyps[-1]) > 0:
+            self.lmstate_final = end_hyps[-1][0]['lmstate']
 
         return nbest_hyps_idx, aws, scores
@@ -302,6 +302,9 @@ class RNNEncoder(EncoderBase):
 
         if not use_cache:
             self.reset_cache()
+        else:
+            # Cached states are stored in the original order of utterances
+            self.fwd_states = [permute_state(state, perm_ids) for state in self.fwd_states]
 
         if self.latency_controlled:
             # Flip the layer and time loop
@@ -341,6 +344,7 @@ class RNNEncoder(EncoderBase):
 
         # Unsort
         xs = xs[perm_ids_unsort]
+        self.fwd_states = [permute_state(state, perm_ids_unsort) for state in self.fwd_states]
         xlens = xlens[perm_ids_unsort]
 
         if task in ['all', 'ys']:
@@ -438,6 +442,23 @@ class RNNEncoder(EncoderBase):
         return xs_sub, xlens_sub
 
 
+def permute_state(state, perm_ids):
+    """Permute RNN states along the batch dimension.
+
+    Args:
+        state (tuple or FloatTensor): (h_n, c_n) or h_n of size `[n_layers * n_dirs, B, n_units]`
+        perm_ids (LongTensor): `[B]`
+    Returns:
+        state (tuple or FloatTensor): (h_n, c_n) or h_n of size `[n_layers * n_dirs, B, n_units]`
+
+    """
+    if state is None:
+        return None
+    if isinstance(state, tuple):
+        return tuple([s[:, perm_ids] for s in state])
+    return state[:, perm_ids]
+
+
 class Padding(nn.Module):
     """Padding variable length of sequences."""
 
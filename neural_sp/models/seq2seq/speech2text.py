@@ -10,8 +10,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import copy
+from functools import partial
 import logging
+import math
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import torch
 import torch.nn as nn
@@ -29,6 +31,7 @@ from neural_sp.models.seq2seq.frontends.gaussian_noise import add_gaussian_noise
 from neural_sp.models.seq2seq.frontends.sequence_summary import SequenceSummaryNetwork
 from neural_sp.models.seq2seq.frontends.spec_augment import SpecAugment
 from neural_sp.models.seq2seq.frontends.splicing import splice
+from neural_sp.models.seq2seq.streaming import StreamingRecognizer
 from neural_sp.models.torch_utils import np2tensor
 from neural_sp.models.torch_utils import tensor2np
 from neural_sp.models.torch_utils import pad_list
@@ -346,7 +349,7 @@ class Speech2Text(ModelBase):
 
         return loss, observation
 
-    def encode(self, xs, task='all', flip=False, use_cache=False, streaming=False):
+    def encode(self, xs, task='all', flip=False, use_cache=False, streaming=False, input_cache=None):
         """Encode acoustic or text features.
 
         Args:
@@ -355,26 +358,13 @@ class Speech2Text(ModelBase):
             flip (bool): if True, flip acoustic features in the time-dimension
             use_cache (bool): use the cached forward encoder state in the previous chunk as the initial state
             streaming (bool): streaming encoding
+            input_cache (dict): padded acoustic features shared among models with the same frontend
         Returns:
             eout_dict (dict):
 
         """
         if self.input_type == 'speech':
-            # Frame stacking
-            if self.n_stacks > 1:
-                xs = [stack_frame(x, self.n_stacks, self.n_skips) for x in xs]
-
-            # Splicing
-            if self.n_splices > 1:
-                xs = [splice(x, self.n_splices, self.n_stacks) for x in xs]
-            xlens = torch.IntTensor([len(x) for x in xs])
-
-            # Flip acoustic features in the reverse order
-            if flip:
-                xs = [torch.from_numpy(np.flip(x, axis=0).copy()).float().cuda(self.device_id) for x in xs]
-            else:
-                xs = [np2tensor(x, self.device_id).float() for x in xs]
-            xs = pad_list(xs, 0.)
+            xs, xlens = self.speech_inputs(xs, flip, input_cache)
 
             # SpecAugment
             if self.use_specaug and self.training:
@@ -382,11 +372,12 @@ class Speech2Text(ModelBase):
 
             # Gaussian noise injection
             if self.gaussian_noise:
-                xs = add_gaussian_noise(xs)
+                # NOTE: noise is added in-place
+                xs = add_gaussian_noise(xs if input_cache is None else xs.clone())
 
             # Sequence summary network
             if self.ssn is not None:
-                xs += self.ssn(xs, xlens)
+                xs = xs + self.ssn(xs, xlens)
 
         elif self.input_type == 'text':
             xlens = torch.IntTensor([len(x) for x in xs])
@@ -405,6 +396,64 @@ class Speech2Text(ModelBase):
 
         return eout_dict
 
+    def speech_inputs(self, xs, flip=False, input_cache=None):
+        """Stack, splice, flip and pad acoustic features.
+
+        Args:
+            xs (list): A list of length `[B]`, which contains arrays of size `[T, input_dim]`
+            flip (bool): if True, flip acoustic features in the time-dimension
+            input_cache (dict): padded acoustic features shared among models with the same frontend
+        Returns:
+            xs (FloatTensor): `[B, T, input_dim]`
+            xlens (IntTensor): `[B]`
+
+        """
+        key = (self.n_stacks, self.n_skips, self.n_splices, flip, self.device_id)
+        if input_cache is not None and key in input_cache:
+            return input_cache[key]
+
+        # Frame stacking
+        if self.n_stacks > 1:
+            xs = [stack_frame(x, self.n_stacks, self.n_skips) for x in xs]
+
+        # Splicing
+        if self.n_splices > 1:
+            xs = [splice(x, self.n_splices, self.n_stacks) for x in xs]
+        xlens = torch.IntTensor([len(x) for x in xs])
+
+        # Flip acoustic features in the reverse order
+        if flip:
+            xs = [np2tensor(np.flip(x, axis=0).copy(), self.device_id).float() for x in xs]
+        else:
+            xs = [np2tensor(x, self.device_id).float() for x in xs]
+        xs = pad_list(xs, 0.)
+
+        if input_cache is not None:
+            input_cache[key] = (xs, xlens)
+        return xs, xlens
+
+    def encode_parallel(self, models, flips, xs, task='all'):
+        """Encode input features with multiple models concurrently.
+
+        Acoustic features (including flipped ones) are prepared once and shared
+        among the models with the same frontend before encoding.
+
+        Args:
+            models (list): A list of Speech2Text classes
+            flips (list): flip acoustic features for each model
+            xs (list): A list of length `[B]`, which contains arrays of size `[T, input_dim]`
+            task (str): all/ys*/ys_sub1*/ys_sub2*
+        Returns:
+            eout_dicts (list): A list of `eout_dict` for each model
+
+        """
+        input_cache = {}
+        for model, flip in zip(models, flips):
+            if model.input_type == 'speech':
+                model.speech_inputs(xs, flip, input_cache)
+        return run_in_threads([partial(model.encode, xs, task, flip=flip, input_cache=input_cache)
+                               for model, flip in zip(models, flips)])
+
     def get_ctc_probs(self, xs, task='ys', temperature=1, topk=None):
         self.eval()
         with torch.no_grad():
@@ -425,6 +474,43 @@ class Speech2Text(ModelBase):
                 eout_dict[task]['xs'], temperature, topk)
             return tensor2np(ctc_probs), tensor2np(indices_topk), eout_dict[task]['xlens']
 
+    def ctc_probs_chunkwise(self, xs, chunk_size, batch_size=1, task='ys'):
+        """Compute CTC probabilities of long recordings chunk by chunk.
+
+        Each recording is split into chunks of a fixed size, which are encoded
+        independently in batches. This is used for segmentation, where the
+        context beyond the chunk boundary is not necessary.
+
+        Args:
+            xs (list): A list of length `[B]`, which contains arrays of size `[T, input_dim]`
+            chunk_size (int): number of input frames per chunk
+            batch_size (int): number of chunks encoded at once
+            task (str): ys* or ys_sub1* or ys_sub2*
+        Returns:
+            ctc_probs (list): A list of length `[B]`, which contains arrays of size `[T // factor, vocab]`
+            factor (int): number of input frames per frame of CTC probabilities
+
+        """
+        factor = self.n_skips * self.enc.subsampling_factor()
+        chunk_size = max(chunk_size // factor, 1) * factor
+        chunks = [(b, t) for b, x in enumerate(xs) for t in range(0, len(x), chunk_size)]
+        task = task.split('.')[0]
+        dir = 'fwd' if task == 'ys' else 'fwd_' + task.split('_')[-1]
+
+        ctc_probs = [[] for _ in xs]
+        self.eval()
+        with torch.no_grad():
+            for i in range(0, len(chunks), batch_size):
+                x_chunks = [xs[b][t:t + chunk_size] for b, t in chunks[i:i + batch_size]]
+                eout_dict = self.encode(x_chunks, task)
+                probs = tensor2np(getattr(self, 'dec_' + dir).ctc_probs(eout_dict[task]['xs']))
+                for j, (b, t) in enumerate(chunks[i:i + batch_size]):
+                    # NOTE: some encoders do not return lengths excluding padded frames
+                    xlen = min(eout_dict[task]['xlens'][j].item(), int(math.ceil(len(x_chunks[j]) / factor)))
+                    ctc_probs[b].append(probs[j, :xlen])
+        return [np.concatenate(p, axis=0) if len(p) > 0 else np.zeros((0, self.vocab), dtype=np.float32)
+                for p in ctc_probs], factor
+
     def plot_attention(self):
         if 'transformer' in self.enc_type:
             self.enc._plot_attention(self.save_path)
@@ -432,180 +518,72 @@ class Speech2Text(ModelBase):
             self.dec_fwd._plot_attention(self.save_path)
 
     def decode_streaming(self, xs, params, idx2token, exclude_eos=False, task='ys'):
-        # check configurations
+        """Streaming decoding of a whole utterance as a single stream of `StreamingRecognizer`.
+
+        Args:
+            xs (list): A list of length `[1]`, which contains an array of size `[T, input_dim]`
+            params (dict): hyper-parameters for decoding
+            idx2token (): converter from index to token
+            exclude_eos (bool): exclude <eos> from hypothesis
+            task (str): ys only
+        Returns:
+            best_hyps_id (list): A list of length `[1]`, which contains arrays of size `[L]`
+            aws: dummy
+
+        """
         assert task == 'ys'
-        assert self.input_type == 'speech'
-        assert self.ctc_weight > 0
-        assert self.fwd_weight > 0
         assert len(xs) == 1  # batch size
-        assert params['recog_length_norm']
-        global_params = copy.deepcopy(params)
-        global_params['recog_max_len_ratio'] = 1.0
-        offline_decoding = not params['recog_chunk_sync']  # offline decoding after CTC-VAD
-
-        # hyper parameters
-        ctc_vad = params['recog_ctc_vad']
-        BLANK_THRESHOLD = params['recog_ctc_vad_blank_threshold']
-        SPIKE_THRESHOLD = params['recog_ctc_vad_spike_threshold']
-        MAX_N_ACCUM_FRAMES = params['recog_ctc_vad_n_accum_frames']
-
-        cs_l = self.enc.lc_chunk_size_left
-        cs_r = self.enc.lc_chunk_size_right
-        factor = self.enc.subsampling_factor()
-        BLANK_THRESHOLD /= factor
-        x_whole = xs[0]  # `[T, input_dim]`
-        # self.enc.turn_off_ceil_mode(self.enc)
 
-        self.eval()
-        with torch.no_grad():
-            lm = getattr(self, 'lm_fwd', None)
-            lm_2nd = getattr(self, 'lm_2nd', None)
-
-            eout_chunks = []
-            ctc_probs_chunks = []
-            t = 0  # global time offset
-            n_blanks = 0
-            n_accum_frames = 0
-            boundary_offset = -1  # boudnary offset in each chunk (after subsampling)
-            is_reset = True   # for the first step
-            hyps_segment = None
-            best_hyp_id_stream = []
-            while True:
-                # Encode input features chunk by chunk
-                x_chunk = x_whole[t:t + (cs_l + cs_r)]
-                eout_dict_chunk = self.encode([x_chunk], task,
-                                              use_cache=not is_reset,
-                                              streaming=True)
-                eout_chunk = eout_dict_chunk[task]['xs']
-                boundary_offset = -1  # reset
-                is_reset = False  # detect the first boundary in the same chunk
-                n_accum_frames += eout_chunk.size(1) * factor
-
-                # CTC-based VAD
-                ctc_log_probs_chunk = None
-                if ctc_vad:
-                    ctc_probs_chunk = self.dec_fwd.ctc_probs(eout_chunk)
-                    if params['recog_ctc_weight'] > 0:
-                        ctc_log_probs_chunk = torch.log(ctc_probs_chunk)
-
-                    # Segmentation strategy 1:
-                    # If any segmentation points are not found in the current chunk,
-                    # encoder states will be carried over to the next chunk.
-                    # Otherwise, the current chunk is segmented at the point where
-                    # n_blanks surpasses the threshold.
-                    if n_accum_frames >= MAX_N_ACCUM_FRAMES:
-                        _, topk_ids_chunk = torch.topk(ctc_probs_chunk, k=1, dim=-1, largest=True, sorted=True)
-                        ctc_probs_chunks.append(ctc_probs_chunk)
-                        for j in range(ctc_probs_chunk.size(1)):
-                            if topk_ids_chunk[0, j, 0] == self.blank:
-                                n_blanks += 1
-                                # print('CTC (T:%d): <blank>' % (t + j * factor))
-                            elif ctc_probs_chunk[0, j, topk_ids_chunk[0, j, 0]] < SPIKE_THRESHOLD:
-                                n_blanks += 1
-                                # print('CTC (T:%d): <blank>' % (t + j * factor))
-                            else:
-                                n_blanks = 0
-                                # print('CTC (T:%d): %s' % (t + j * factor, idx2token([topk_ids_chunk[0, j, 0].item()])))
-                            if not is_reset and n_blanks > BLANK_THRESHOLD:
-                                boundary_offset = j  # select the most right blank offset
-                                is_reset = True
-
-                # Truncate the most right frames
-                if is_reset:
-                    eout_chunk = eout_chunk[:, :boundary_offset + 1]
-                eout_chunks.append(eout_chunk)
-
-                # Chunk-synchronous attention decoding
-                if not offline_decoding:
-                    end_hyps, hyps_segment = self.dec_fwd.beam_search_chunk_sync(
-                        eout_chunk, params, idx2token, lm, lm_2nd,
-                        ctc_log_probs=ctc_log_probs_chunk,
-                        hyps_segment=hyps_segment,
-                        state_carry_over=False)
-                    merged_hyps = sorted(end_hyps + hyps_segment, key=lambda x: x['score'], reverse=True)
-                    best_hyp_id_prefix = np.array(merged_hyps[0]['hyp'][1:])
-                    if len(best_hyp_id_prefix) > 0 and best_hyp_id_prefix[-1] == self.eos:
-                        # reset beam if <eos> is generated from the best hypothesis
-                        best_hyp_id_prefix = best_hyp_id_prefix[:-1]  # exclude <eos>
-                        # Segmentation strategy 2:
-                        # If <eos> is emitted from the decoder (not CTC),
-                        # the current chunk is segmented.
-                        if not is_reset:
-                            boundary_offset = eout_chunk.size(1) - 1
-                            is_reset = True
-
-                    # print('Sync MoChA (T:%d, offset:%d, blank:%d frames): %s' %
-                    #       (t + eout_chunk.size(1) * factor,
-                    #        self.dec_fwd.n_frames * factor,
-                    #        n_blanks * factor, idx2token(best_hyp_id_prefix)))
-                    # print('-' * 50)
-
-                if is_reset:
-                    # Global decoding over the segmented region
-                    if offline_decoding:
-                        eout = torch.cat(eout_chunks, dim=1)
-                        elens = torch.IntTensor([eout.size(1)])
-                        ctc_log_probs = None
-                        if params['recog_ctc_weight'] > 0:
-                            ctc_log_probs = torch.log(self.dec_fwd.ctc_probs(eout))
-                        nbest_hyps_id_offline, _, _ = self.dec_fwd.beam_search(
-                            eout, elens, global_params, idx2token, lm, lm_2nd,
-                            ctc_log_probs=ctc_log_probs)
-                        # print('Offline MoChA (T:%d): %s' %
-                        #       (t + eout_chunk.size(1) * factor,
-                        #        idx2token(nbest_hyps_id_offline[0][0])))
-
-                    # pick up the best hyp from ended and active hyps
-                    if offline_decoding:
-                        if len(nbest_hyps_id_offline[0][0]) > 0:
-                            best_hyp_id_stream.extend(nbest_hyps_id_offline[0][0])
-                    else:
-                        if len(best_hyp_id_prefix) > 0:
-                            best_hyp_id_stream.extend(best_hyp_id_prefix)
-                        # print('Final Sync MoChA (T:%d, segment:%d frames): %s' %
-                        #       (t + eout_chunk.size(1) * factor,
-                        #        self.dec_fwd.n_frames * factor,
-                        #        idx2token(best_hyp_id_prefix)))
-                        # print('-' * 50)
-                        # for test
-                        # eos_hyp = np.zeros(1, dtype=np.int32)
-                        # eos_hyp[0] = self.eos
-                        # best_hyp_id_stream.extend(eos_hyp)
-
-                    # reset
-                    eout_chunks = []
-                    ctc_probs_chunks = []
-                    n_blanks = 0
-                    n_accum_frames = 0
-                    hyps_segment = None
-
-                    # next chunk will start from the frame next to the boundary
-                    if 0 <= boundary_offset * factor < cs_l - 1:
-                        delta = 0
-                        t -= x_chunk[boundary_offset * factor:cs_l].shape[0]
-                        t -= delta
-                        # print('Back %d frames' % (x_chunk[boundary_offset * factor:cs_l].shape[0] - delta))
-
-                t += cs_l
-                if t >= x_whole.shape[0] - 1:
-                    break
-
-            # Global decoding over the last chunk
-            if offline_decoding and len(eout_chunks) > 0:
-                eout = torch.cat(eout_chunks, dim=1)
-                elens = torch.IntTensor([eout.size(1)])
-                nbest_hyps_id_offline, _, _ = self.dec_fwd.beam_search(
-                    eout, elens, global_params, idx2token, lm, lm_2nd, None)
-                # print('MoChA: ' + idx2token(nbest_hyps_id_offline[0][0]))
-                # print('*' * 50)
-                if len(nbest_hyps_id_offline[0][0]) > 0:
-                    best_hyp_id_stream.extend(nbest_hyps_id_offline[0][0])
-
-            # pick up the best hyp
-            if not is_reset and not offline_decoding and len(best_hyp_id_prefix) > 0:
-                best_hyp_id_stream.extend(best_hyp_id_prefix)
-
-            return [np.stack(best_hyp_id_stream, axis=0)], [None]
+        latency = getattr(self, 'latency_recorder', None)
+        if latency is not None:
+            latency.start(xs[0].shape[0])
+        recognizer = StreamingRecognizer(self, params, idx2token, latency_recorder=latency)
+        recognizer.add_stream(0)
+        recognizer.feed(0, xs[0])
+        recognizer.close(0)
+        best_hyp_id_stream = []
+        while recognizer.has_work():
+            for res in recognizer.step():
+                for hyp_id in res['final']:
+                    best_hyp_id_stream.extend(hyp_id)
+        if latency is not None:
+            latency.end(len(best_hyp_id_stream))
+
+        return [np.array(best_hyp_id_stream, dtype=np.int64)], [None]
+
+    def decode_streaming_iter(self, x_chunks, params, idx2token):
+        """Streaming decoding of input features which arrive incrementally.
+
+        Results are yielded after each chunk of the encoder is processed,
+        so that partial hypotheses are available before the end of the input.
+        Both this and `decode_streaming` run a single stream of `StreamingRecognizer`,
+        so finalized segments do not depend on how the input is split into `x_chunks`.
+
+        Args:
+            x_chunks (iterable): arrays of size `[T, input_dim]` of an arbitrary length,
+                which are concatenated as a single input stream
+            params (dict): hyper-parameters for decoding
+            idx2token (): converter from index to token
+        Yields:
+            result (dict):
+                final (list): A list of token IDs of segments finalized after the last result
+                segments (list): A list of tuples of (start, end) input frames of the finalized segments
+                partial (list): token IDs of the best prefix in the current segment
+                offset (int): number of processed input frames
+                done (bool): True if the whole input has been processed
+
+        """
+        recognizer = StreamingRecognizer(self, params, idx2token)
+        recognizer.add_stream(0)
+        for x in x_chunks:
+            recognizer.feed(0, x)
+            while recognizer.has_work():
+                for res in recognizer.step():
+                    yield res
+        recognizer.close(0)
+        while recognizer.has_work():
+            for res in recognizer.step():
+                yield res
 
     def decode(self, xs, params, idx2token, exclude_eos=False,
                refs_id=None, refs=None, utt_ids=None, speakers=None,
@@ -648,14 +626,36 @@ class Speech2Text(ModelBase):
 
         self.eval()
         with torch.no_grad():
+            use_ctc = (self.fwd_weight == 0 and self.bwd_weight == 0) or \
+                (self.ctc_weight > 0 and params['recog_ctc_weight'] == 1)
+            use_greedy = params['recog_beam_width'] == 1 and not params['recog_fwd_bwd_attention']
+            n_models = len(ensemble_models) + 1
+
             # Encode input features
-            if self.input_type == 'speech' and self.mtl_per_batch and 'bwd' in dir:
-                eout_dict = self.encode(xs, task, flip=True)
+            # NOTE: the main and ensemble models (in both directions) are encoded concurrently
+            if use_ctc or use_greedy:
+                flip = self.input_type == 'speech' and self.mtl_per_batch and 'bwd' in dir
+                eout_dict = self.encode(xs, task, flip=flip)
+            elif params['recog_fwd_bwd_attention']:
+                flip = self.input_type == 'speech' and self.mtl_per_batch
+                models = [self] + ensemble_models + ensemble_models
+                flips = [False] * n_models + [flip] * (n_models - 1)
+                if flip:
+                    models += [self]
+                    flips += [True]
+                eout_dicts = self.encode_parallel(models, flips, xs, task)
+                eout_dict = eout_dicts[0]
+                eout_dicts_fwd = eout_dicts[1:n_models]
+                eout_dicts_bwd = eout_dicts[n_models:2 * n_models - 1]
+                enc_outs_bwd = eout_dicts[-1] if flip else eout_dict
             else:
-                eout_dict = self.encode(xs, task, flip=False)
+                flips = [model.input_type == 'speech' and model.mtl_per_batch and 'bwd' in dir
+                         for model in [self] + ensemble_models]
+                eout_dicts = self.encode_parallel([self] + ensemble_models, flips, xs, task)
+                eout_dict = eout_dicts[0]
 
             # CTC
-            if (self.fwd_weight == 0 and self.bwd_weight == 0) or (self.ctc_weight > 0 and params['recog_ctc_weight'] == 1):
+            if use_ctc:
                 lm = getattr(self, 'lm_' + dir, None)
                 lm_2nd = getattr(self, 'lm_2nd', None)
                 lm_2nd_rev = None  # TODO
@@ -663,74 +663,60 @@ class Speech2Text(ModelBase):
                 best_hyps_id = getattr(self, 'dec_' + dir).decode_ctc(
                     eout_dict[task]['xs'], eout_dict[task]['xlens'], params, idx2token,
                     lm, lm_2nd, lm_2nd_rev, 1, refs_id, utt_ids, speakers)
+                if params['recog_beam_width'] > 1:
+                    self._export_nbest(getattr(self, 'dec_' + dir).ctc, utt_ids)
                 return best_hyps_id, None
 
             # Attention
-            elif params['recog_beam_width'] == 1 and not params['recog_fwd_bwd_attention']:
+            elif use_greedy:
+                kwargs = {}
+                if isinstance(getattr(self, 'dec_' + dir), RNNTransducer):
+                    kwargs['max_symbols_per_frame'] = params['recog_max_symbols_per_frame']
                 best_hyps_id, aws = getattr(self, 'dec_' + dir).greedy(
                     eout_dict[task]['xs'], eout_dict[task]['xlens'],
                     params['recog_max_len_ratio'], idx2token,
                     exclude_eos,  params['recog_oracle'],
-                    refs_id, utt_ids, speakers)
+                    refs_id, utt_ids, speakers, **kwargs)
             else:
-                assert params['recog_batch_size'] == 1
-
                 ctc_log_probs = None
                 if params['recog_ctc_weight'] > 0:
                     ctc_log_probs = self.dec_fwd.ctc_log_probs(eout_dict[task]['xs'])
 
+                # CTC-based vocabulary shortlist for the attention decoder
+                kwargs = {}
+                if params['recog_ctc_shortlist_threshold'] > 0:
+                    assert self.ctc_weight > 0
+                    assert not isinstance(getattr(self, 'dec_' + dir), RNNTransducer)
+                    kwargs['shortlist'] = self.dec_fwd.ctc_shortlist(
+                        eout_dict[task]['xs'], eout_dict[task]['xlens'], params['recog_ctc_shortlist_threshold'])
+
                 # forward-backward decoding
                 if params['recog_fwd_bwd_attention']:
                     lm_fwd = getattr(self, 'lm_fwd', None)
                     lm_bwd = getattr(self, 'lm_bwd', None)
 
-                    # ensemble (forward)
-                    ensmbl_eouts_fwd = []
-                    ensmbl_elens_fwd = []
-                    ensmbl_decs_fwd = []
-                    if len(ensemble_models) > 0:
-                        for i_e, model in enumerate(ensemble_models):
-                            enc_outs_e_fwd = model.encode(xs, task, flip=False)
-                            ensmbl_eouts_fwd += [enc_outs_e_fwd[task]['xs']]
-                            ensmbl_elens_fwd += [enc_outs_e_fwd[task]['xlens']]
-                            ensmbl_decs_fwd += [model.dec_fwd]
-                            # NOTE: only support for the main task now
-
-                    # forward decoder
-                    nbest_hyps_id_fwd, aws_fwd, scores_fwd = self.dec_fwd.beam_search(
-                        eout_dict[task]['xs'], eout_dict[task]['xlens'],
-                        params, idx2token, lm_fwd, None, lm_bwd, ctc_log_probs,
-                        params['recog_beam_width'], False, refs_id, utt_ids, speakers,
-                        ensmbl_eouts_fwd, ensmbl_elens_fwd, ensmbl_decs_fwd)
-
-                    # ensemble (backward)
-                    ensmbl_eouts_bwd = []
-                    ensmbl_elens_bwd = []
-                    ensmbl_decs_bwd = []
-                    if len(ensemble_models) > 0:
-                        for i_e, model in enumerate(ensemble_models):
-                            if self.input_type == 'speech' and self.mtl_per_batch:
-                                enc_outs_e_bwd = model.encode(xs, task, flip=True)
-                            else:
-                                enc_outs_e_bwd = model.encode(xs, task, flip=False)
-                            ensmbl_eouts_bwd += [enc_outs_e_bwd[task]['xs']]
-                            ensmbl_elens_bwd += [enc_outs_e_bwd[task]['xlens']]
-                            ensmbl_decs_bwd += [model.dec_bwd]
-                            # NOTE: only support for the main task now
-                            # TODO(hirofumi): merge with the forward for the efficiency
-
-                    # backward decoder
-                    flip = False
-                    if self.input_type == 'speech' and self.mtl_per_batch:
-                        flip = True
-                        enc_outs_bwd = self.encode(xs, task, flip=True)
-                    else:
-                        enc_outs_bwd = eout_dict
-                    nbest_hyps_id_bwd, aws_bwd, scores_bwd, _ = self.dec_bwd.beam_search(
-                        enc_outs_bwd[task]['xs'], eout_dict[task]['xlens'],
-                        params, idx2token, lm_bwd, None, lm_fwd, ctc_log_probs,
-                        params['recog_beam_width'], False, refs_id, utt_ids, speakers,
-                        ensmbl_eouts_bwd, ensmbl_elens_bwd, ensmbl_decs_bwd)
+                    # ensemble
+                    # NOTE: only support for the main task now
+                    ensmbl_eouts_fwd = [eout_dict_e[task]['xs'] for eout_dict_e in eout_dicts_fwd]
+                    ensmbl_elens_fwd = [eout_dict_e[task]['xlens'] for eout_dict_e in eout_dicts_fwd]
+                    ensmbl_decs_fwd = [model.dec_fwd for model in ensemble_models]
+                    ensmbl_eouts_bwd = [eout_dict_e[task]['xs'] for eout_dict_e in eout_dicts_bwd]
+                    ensmbl_elens_bwd = [eout_dict_e[task]['xlens'] for eout_dict_e in eout_dicts_bwd]
+                    ensmbl_decs_bwd = [model.dec_bwd for model in ensemble_models]
+
+                    # forward and backward decoders run concurrently
+                    (nbest_hyps_id_fwd, aws_fwd, scores_fwd), (nbest_hyps_id_bwd, aws_bwd, scores_bwd) = \
+                        run_in_threads([
+                            partial(self.dec_fwd.beam_search,
+                                    eout_dict[task]['xs'], eout_dict[task]['xlens'],
+                                    params, idx2token, lm_fwd, None, lm_bwd, ctc_log_probs,
+                                    params['recog_beam_width'], False, refs_id, utt_ids, speakers,
+                                    ensmbl_eouts_fwd, ensmbl_elens_fwd, ensmbl_decs_fwd, **kwargs),
+                            partial(self.dec_bwd.beam_search,
+                                    enc_outs_bwd[task]['xs'], eout_dict[task]['xlens'],
+                                    params, idx2token, lm_bwd, None, lm_fwd, ctc_log_probs,
+                                    params['recog_beam_width'], False, refs_id, utt_ids, speakers,
+                                    ensmbl_eouts_bwd, ensmbl_elens_bwd, ensmbl_decs_bwd, **kwargs)])
 
                     # forward-backward attention
                     best_hyps_id = fwd_bwd_attention(
@@ -741,17 +727,10 @@ class Speech2Text(ModelBase):
                     aws = None
                 else:
                     # ensemble
-                    ensmbl_eouts, ensmbl_elens, ensmbl_decs = [], [], []
-                    if len(ensemble_models) > 0:
-                        for i_e, model in enumerate(ensemble_models):
-                            if model.input_type == 'speech' and model.mtl_per_batch and 'bwd' in dir:
-                                enc_outs_e = model.encode(xs, task, flip=True)
-                            else:
-                                enc_outs_e = model.encode(xs, task, flip=False)
-                            ensmbl_eouts += [enc_outs_e[task]['xs']]
-                            ensmbl_elens += [enc_outs_e[task]['xlens']]
-                            ensmbl_decs += [getattr(model, 'dec_' + dir)]
-                            # NOTE: only support for the main task now
+                    # NOTE: only support for the main task now
+                    ensmbl_eouts = [eout_dict_e[task]['xs'] for eout_dict_e in eout_dicts[1:]]
+                    ensmbl_elens = [eout_dict_e[task]['xlens'] for eout_dict_e in eout_dicts[1:]]
+                    ensmbl_decs = [getattr(model, 'dec_' + dir) for model in ensemble_models]
 
                     lm = getattr(self, 'lm_' + dir, None)
                     lm_2nd = getattr(self, 'lm_2nd', None)
@@ -761,7 +740,57 @@ class Speech2Text(ModelBase):
                         eout_dict[task]['xs'], eout_dict[task]['xlens'],
                         params, idx2token, lm, lm_2nd, lm_2nd_rev, ctc_log_probs,
                         1, exclude_eos, refs_id, utt_ids, speakers,
-                        ensmbl_eouts, ensmbl_elens, ensmbl_decs)
+                        ensmbl_eouts, ensmbl_elens, ensmbl_decs, **kwargs)
                     best_hyps_id = [hyp[0] for hyp in nbest_hyps_id]
+                    self._export_nbest(getattr(self, 'dec_' + dir), utt_ids)
 
             return best_hyps_id, aws
+
+    def _export_nbest(self, dec, utt_ids):
+        """Write N-best lists kept by the last beam search to `nbest_writer` if attached."""
+        writer = getattr(self, 'nbest_writer', None)
+        records = getattr(dec, 'nbest_hyps_final', None)
+        if writer is None or records is None:
+            return
+        for b, record in enumerate(records):
+            utt_id = utt_ids[b] if utt_ids is not None else str(writer.n_utts)
+            writer.write(utt_id, record['nbest'], record['lattice'])
+        dec.nbest_hyps_final = None
+
+
+# worker threads of `run_in_threads`, which are reused across calls
+_pool = None
+_pool_size = 0
+
+
+def run_in_threads(fns):
+    """Run functions concurrently with intra-op threads partitioned among them.
+
+    Args:
+        fns (list): A list of functions without arguments
+    Returns:
+        results (list): return values of `fns`
+
+    """
+    global _pool, _pool_size
+    if len(fns) == 1:
+        return [fns[0]()]
+    if _pool_size < len(fns):
+        if _pool is not None:
+            _pool.close()
+        _pool = ThreadPool(len(fns))
+        _pool_size = len(fns)
+    n_threads = torch.get_num_threads()
+    grad_enabled = torch.is_grad_enabled()
+
+    def run(fn):
+        # NOTE: grad mode is thread-local
+        with torch.set_grad_enabled(grad_enabled):
+            return fn()
+
+    # NOTE: the number of intra-op threads is shared by the whole process
+    torch.set_num_threads(max(1, n_threads // len(fns)))
+    try:
+        return _pool.map(run, fns)
+    finally:
+        torch.set_num_threads(n_threads)
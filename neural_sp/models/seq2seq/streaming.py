@@ -0,0 +1,396 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Streaming recognition of multiple streams with cross-stream batching."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import logging
+import numpy as np
+import torch
+
+from neural_sp.models.seq2seq.decoders.ctc_vad import blank_frames
+from neural_sp.models.seq2seq.decoders.ctc_vad import detect_boundary
+from neural_sp.models.torch_utils import pad_list
+
+logger = logging.getLogger(__name__)
+
+
+class Stream(object):
+    """Streaming state of a single input stream.
+
+    All the states carried over between chunks are held here instead of
+    the caches of the encoder and decoder modules.
+
+    """
+
+    def __init__(self, stream_id):
+        self.id = stream_id
+        self.x = None  # buffered input features `[T, input_dim]`
+        self.t = 0  # offset of the next chunk in `self.x`
+        self.n_trimmed = 0  # number of input frames dropped from `self.x`
+        self.n_chunks = 0
+        self.closed = False  # no more input features
+        self.done = False
+
+        # encoder
+        self.enc_states = None  # A list of forward RNN states per layer
+        self.is_reset = True  # for the first step
+
+        # CTC-based VAD
+        self.n_blanks = 0
+        self.n_accum_frames = 0
+        self.segment_start = 0  # input frame where the current segment starts
+        self.segment_end = 0
+
+        # decoder
+        self.dec_state = {'hyps': None, 'ctc_prefix_score': None, 'n_frames': 0}
+        self.eout_chunks = []  # for offline decoding of each segment
+        self.best_hyp_id_prefix = []
+        self.n_tokens = 0  # number of finalized tokens
+
+    @property
+    def offset(self):
+        """Global offset of the next chunk in input frames."""
+        return self.n_trimmed + self.t
+
+    def append(self, x):
+        self.x = x if self.x is None else np.concatenate([self.x, x], axis=0)
+
+    def trim(self):
+        """Drop input features which will never be used again."""
+        if self.x is not None and self.t > 0:
+            self.x = self.x[self.t:]
+            self.n_trimmed += self.t
+            self.t = 0
+
+
+class StreamingRecognizer(object):
+    """Chunk-wise recognition of multiple streams in a batch.
+
+    The encoder forward of the current chunks, CTC posteriors, CTC-based VAD
+    and chunk-synchronous MoChA decoding (or offline decoding of segments
+    when `recog_chunk_sync` is False) are computed over all streams which
+    have a chunk ready at each step. `Speech2Text.decode_streaming` is
+    a single stream of this class.
+
+    Args:
+        model (Speech2Text): model with a latency-controlled RNN encoder
+        params (dict): hyper-parameters for decoding
+        idx2token (): converter from index to token
+        latency_recorder (StreamingLatency): recorder of compute time per chunk,
+            which is available only for a single stream
+
+    """
+
+    def __init__(self, model, params, idx2token, latency_recorder=None):
+        assert model.input_type == 'speech'
+        assert model.ctc_weight > 0
+        assert model.fwd_weight > 0
+        assert getattr(model.enc, 'latency_controlled', False)
+        assert params['recog_length_norm']
+
+        self.model = model
+        self.params = params
+        self.global_params = copy.deepcopy(params)
+        self.global_params['recog_max_len_ratio'] = 1.0
+        self.idx2token = idx2token
+        self.offline_decoding = not params['recog_chunk_sync']
+
+        self.ctc_vad = params['recog_ctc_vad']
+        self.cs_l = model.enc.lc_chunk_size_left
+        self.cs_r = model.enc.lc_chunk_size_right
+        self.factor = model.enc.subsampling_factor()
+        self.blank_threshold = params['recog_ctc_vad_blank_threshold'] / self.factor
+        self.spike_threshold = params['recog_ctc_vad_spike_threshold']
+        self.max_n_accum_frames = params['recog_ctc_vad_n_accum_frames']
+
+        self.lm = getattr(model, 'lm_fwd', None)
+        self.lm_2nd = getattr(model, 'lm_2nd', None)
+        self.latency = latency_recorder
+
+        self.streams = {}
+
+    def add_stream(self, stream_id):
+        assert stream_id not in self.streams
+        assert self.latency is None or len(self.streams) == 0
+        self.streams[stream_id] = Stream(stream_id)
+
+    def remove_stream(self, stream_id):
+        self.streams.pop(stream_id, None)
+
+    def feed(self, stream_id, x):
+        """Append input features to a stream.
+
+        Args:
+            stream_id: ID of the stream
+            x (np.ndarray): `[T, input_dim]`
+
+        """
+        stream = self.streams[stream_id]
+        assert not stream.closed
+        stream.append(x)
+
+    def close(self, stream_id):
+        """Mark the end of input features of a stream."""
+        self.streams[stream_id].closed = True
+
+    def _is_ready(self, stream):
+        if stream.done or stream.x is None:
+            return False
+        n_remains = len(stream.x) - stream.t
+        if n_remains >= self.cs_l + self.cs_r:
+            return True
+        # the last chunk of the stream
+        return stream.closed and (n_remains > 1 or (stream.n_chunks == 0 and n_remains > 0))
+
+    def has_work(self):
+        return any([self._is_ready(s) or (s.closed and not s.done) for s in self.streams.values()])
+
+    def step(self):
+        """Process the current chunk of all ready streams in a batch.
+
+        Returns:
+            results (list): A list of dicts for streams processed in this step
+                stream_id: ID of the stream
+                final (list): A list of token IDs of segments finalized in this step
+                segments (list): A list of tuples of (start, end) input frames of the finalized segments
+                partial (list): token IDs of the best prefix in the current segment
+                offset (int): number of processed input frames
+                done (bool): True if the whole stream has been processed
+
+        """
+        streams = [s for s in self.streams.values() if self._is_ready(s)]
+        results = {}
+        self.model.eval()
+        with torch.no_grad():
+            if self.latency is not None:
+                self.latency.tic()
+            if len(streams) > 0:
+                self._step_chunks(streams, results)
+            streams_end = [s for s in self.streams.values()
+                           if s.closed and not s.done and not self._is_ready(s)]
+            if len(streams_end) > 0:
+                self._finish(streams_end, results)
+        return [results[s.id] for s in self.streams.values() if s.id in results]
+
+    def _result(self, results, stream):
+        if stream.id not in results:
+            results[stream.id] = {'stream_id': stream.id, 'final': [], 'segments': [], 'partial': [],
+                                  'offset': 0, 'done': False}
+        return results[stream.id]
+
+    def _finalize(self, results, stream, hyp_id):
+        res = self._result(results, stream)
+        res['final'].append(hyp_id)
+        stream.n_tokens += len(hyp_id)
+        res['segments'].append((stream.segment_start, stream.segment_end))
+
+    def _encode(self, streams, x_chunks):
+        """Encode chunks of streams with the same length in a batch.
+
+        Args:
+            streams (list): A list of length `[S]`, which contains Stream classes
+            x_chunks (list): A list of length `[S]`, which contains arrays of size `[T, input_dim]`
+        Returns:
+            eouts (FloatTensor): `[S, T', enc_n_units]`
+
+        """
+        enc = self.model.enc
+        fwd_states = []
+        for l in range(enc.n_layers):
+            states = [None if s.is_reset or s.enc_states is None else s.enc_states[l] for s in streams]
+            ref = [state for state in states if state is not None]
+            if len(ref) == 0:
+                fwd_states.append(None)
+                continue
+            if isinstance(ref[0], tuple):
+                zero = tuple([torch.zeros_like(h) for h in ref[0]])
+            else:
+                zero = torch.zeros_like(ref[0])
+            states = [zero if state is None else state for state in states]
+            if isinstance(zero, tuple):
+                fwd_states.append(tuple([torch.cat(hs, dim=1) for hs in zip(*states)]))
+            else:
+                fwd_states.append(torch.cat(states, dim=1))
+
+        # NOTE: the encoder cache is used only to pass the states of the streams
+        enc.fwd_states = fwd_states
+        eouts = self.model.encode(x_chunks, 'ys', use_cache=True, streaming=True)['ys']['xs']
+        for i, s in enumerate(streams):
+            s.enc_states = [tuple([h[:, i:i + 1] for h in state]) if isinstance(state, tuple)
+                            else state[:, i:i + 1] for state in enc.fwd_states]
+        enc.reset_cache()
+        return eouts
+
+    def _step_chunks(self, streams, results):
+        dec = self.model.dec_fwd
+        cs_l, cs_r = self.cs_l, self.cs_r
+        chunk_offsets = [s.offset for s in streams]
+        n_tokens_prev = [s.n_tokens for s in streams]
+
+        # Encode input features chunk by chunk
+        x_chunks = [s.x[s.t:s.t + (cs_l + cs_r)] for s in streams]
+        eout_chunks = [None] * len(streams)
+        # NOTE: only chunks with the same length are batched since the latency-controlled
+        # encoder does not mask the right context
+        for xlen in sorted(set([len(x) for x in x_chunks])):
+            ids = [i for i, x in enumerate(x_chunks) if len(x) == xlen]
+            eouts = self._encode([streams[i] for i in ids], [x_chunks[i] for i in ids])
+            for i_b, i in enumerate(ids):
+                eout_chunks[i] = eouts[i_b:i_b + 1]
+        if self.latency is not None:
+            self.latency.lap('encoder')
+
+        boundary_offsets = [-1] * len(streams)
+        for s, eout_chunk in zip(streams, eout_chunks):
+            s.is_reset = False  # detect the first boundary in the same chunk
+            s.n_accum_frames += eout_chunk.size(1) * self.factor
+            s.n_chunks += 1
+
+        # CTC-based VAD
+        ctc_probs = None
+        ctc_log_probs = None
+        if self.ctc_vad:
+            ctc_probs = dec.ctc_probs(pad_list([eout[0] for eout in eout_chunks], 0.))
+            if self.params['recog_ctc_weight'] > 0:
+                ctc_log_probs = torch.log(ctc_probs)
+            is_blank = blank_frames(ctc_probs, dec.blank, self.spike_threshold)
+            for i, s in enumerate(streams):
+                # Segmentation strategy 1:
+                # If any segmentation points are not found in the current chunk,
+                # encoder states will be carried over to the next chunk.
+                # Otherwise, the current chunk is segmented at the point where
+                # n_blanks surpasses the threshold.
+                if s.n_accum_frames >= self.max_n_accum_frames:
+                    boundary_offsets[i], s.n_blanks = detect_boundary(
+                        is_blank[i, :eout_chunks[i].size(1)], s.n_blanks, self.blank_threshold)
+                    if boundary_offsets[i] >= 0:
+                        s.is_reset = True
+        is_vad_boundary = [s.is_reset for s in streams]
+        if self.latency is not None:
+            self.latency.lap('vad')
+
+        # Truncate the most right frames
+        # NOTE: CTC posteriors of the whole chunks are used in chunk-synchronous decoding
+        ctc_lens = torch.IntTensor([eout.size(1) for eout in eout_chunks])
+        for i, s in enumerate(streams):
+            if s.is_reset:
+                eout_chunks[i] = eout_chunks[i][:, :boundary_offsets[i] + 1]
+            if self.offline_decoding:
+                s.eout_chunks.append(eout_chunks[i])
+
+        # Chunk-synchronous attention decoding
+        ids = [i for i in range(len(streams)) if eout_chunks[i].size(1) > 0]
+        if not self.offline_decoding and len(ids) > 0:
+            elens = torch.IntTensor([eout.size(1) for eout in eout_chunks])
+            eouts = pad_list([eout_chunks[i][0] for i in ids], 0.)
+            outputs = dec.beam_search_chunk_sync_streams(
+                eouts, elens[ids], self.params, self.idx2token,
+                [streams[i].dec_state for i in ids], self.lm, self.lm_2nd,
+                ctc_log_probs=ctc_log_probs[ids] if ctc_log_probs is not None else None,
+                ctc_lens=ctc_lens[ids])
+            for i, (end_hyps, hyps) in zip(ids, outputs):
+                s = streams[i]
+                merged_hyps = sorted(end_hyps + hyps, key=lambda x: x['score'], reverse=True)
+                s.best_hyp_id_prefix = merged_hyps[0]['hyp'][1:] if len(merged_hyps) > 0 else []
+                if len(s.best_hyp_id_prefix) > 0 and s.best_hyp_id_prefix[-1] == dec.eos:
+                    # reset beam if <eos> is generated from the best hypothesis
+                    s.best_hyp_id_prefix = s.best_hyp_id_prefix[:-1]  # exclude <eos>
+                    # Segmentation strategy 2:
+                    # If <eos> is emitted from the decoder (not CTC),
+                    # the current chunk is segmented.
+                    if not s.is_reset:
+                        boundary_offsets[i] = eout_chunks[i].size(1) - 1
+                        s.is_reset = True
+                self._result(results, s)['partial'] = s.best_hyp_id_prefix[:]
+
+        for i, s in enumerate(streams):
+            if s.is_reset:
+                s.segment_end = s.offset + int(min((boundary_offsets[i] + 1) * self.factor, len(x_chunks[i])))
+
+        # Global decoding over the segmented regions
+        streams_reset = [s for s in streams if s.is_reset]
+        if self.offline_decoding and len(streams_reset) > 0:
+            self._decode_segments(streams_reset, results)
+
+        for i, s in enumerate(streams):
+            if s.is_reset:
+                if not self.offline_decoding and len(s.best_hyp_id_prefix) > 0:
+                    self._finalize(results, s, s.best_hyp_id_prefix)
+                self._reset_segment(s)
+
+                # next chunk will start from the frame next to the boundary
+                if 0 <= boundary_offsets[i] * self.factor < cs_l - 1:
+                    s.t -= x_chunks[i][boundary_offsets[i] * self.factor:cs_l].shape[0]
+
+            # NOTE: the last chunk may be shorter than `cs_l`
+            s.t = min(s.t + cs_l, len(s.x))
+            s.trim()
+            self._result(results, s)['offset'] = s.offset
+
+        if self.latency is not None:
+            self.latency.lap('decoder')
+            s = streams[0]
+            self.latency.next_chunk(chunk_offsets[0] + len(x_chunks[0]), s.n_tokens + len(s.best_hyp_id_prefix))
+            if is_vad_boundary[0] and s.n_tokens > n_tokens_prev[0]:
+                # the boundary is the first frame where consecutive blank frames surpass the threshold
+                speech_end = boundary_offsets[0] - int(self.blank_threshold)
+                self.latency.endpoint(chunk_offsets[0] + speech_end * self.factor)
+
+    def _reset_segment(self, stream):
+        stream.segment_start = stream.segment_end
+        stream.eout_chunks = []
+        stream.n_blanks = 0
+        stream.n_accum_frames = 0
+        stream.dec_state = {'hyps': None, 'ctc_prefix_score': None, 'n_frames': 0}
+        stream.best_hyp_id_prefix = []
+
+    def _decode_segments(self, streams, results):
+        """Decode the buffered segments of streams in a batch.
+
+        Args:
+            streams (list): A list of Stream classes
+            results (dict):
+
+        """
+        dec = self.model.dec_fwd
+        eouts = [torch.cat(s.eout_chunks, dim=1)[0] for s in streams]
+        elens = torch.IntTensor([len(eout) for eout in eouts])
+        eouts = pad_list(eouts, 0.)
+        ctc_log_probs = None
+        if self.params['recog_ctc_weight'] > 0:
+            ctc_log_probs = torch.log(dec.ctc_probs(eouts))
+        nbest_hyps_id, _, _ = dec.beam_search(
+            eouts, elens, self.global_params, self.idx2token, self.lm, self.lm_2nd,
+            ctc_log_probs=ctc_log_probs)
+        for s, nbest_hyps_id_s in zip(streams, nbest_hyps_id):
+            if len(nbest_hyps_id_s[0]) > 0:
+                self._finalize(results, s, list(nbest_hyps_id_s[0]))
+
+    def _finish(self, streams, results):
+        """Finalize streams whose input features have been consumed."""
+        for s in streams:
+            s.segment_end = s.offset if s.x is None else s.n_trimmed + len(s.x)
+        if self.offline_decoding:
+            streams_remain = [s for s in streams if len(s.eout_chunks) > 0]
+            if len(streams_remain) > 0:
+                self._decode_segments(streams_remain, results)
+        for s in streams:
+            # pick up the best hyp
+            if not self.offline_decoding and not s.is_reset and len(s.best_hyp_id_prefix) > 0:
+                self._finalize(results, s, s.best_hyp_id_prefix)
+            self._reset_segment(s)
+            s.done = True
+            res = self._result(results, s)
+            res['partial'] = []
+            res['offset'] = s.segment_end
+            res['done'] = True
+        if self.latency is not None:
+            self.latency.lap('decoder')